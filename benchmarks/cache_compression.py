@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+"""Compare compression codecs for cached data sets.
+
+The synthetic development data set is saved and loaded once for each
+HDF5 compression codec as well as for the memory-mapped cache format,
+and the durations and file sizes are reported.
+"""
+
+import argparse
+import os
+import tempfile
+from time import time
+
+import scipy.sparse
+
+from scvae.data import internal_io
+from scvae.data.loaders import _create_development_data_set
+from scvae.utilities import format_duration, suppress_stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--number-of-examples",
+        type=int,
+        default=10000,
+        help="number of examples in the development data set"
+    )
+    parser.add_argument(
+        "--number-of-features",
+        type=int,
+        default=25,
+        help="number of features in the development data set"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=10,
+        help="number of times the examples are repeated to enlarge data set"
+    )
+    parser.add_argument(
+        "--number-of-threads",
+        type=int,
+        help="number of threads for compression (defaults to all cores)"
+    )
+    arguments = parser.parse_args()
+
+    data_dictionary = _create_development_data_set(
+        n_examples=arguments.number_of_examples,
+        n_features=arguments.number_of_features
+    )
+    values = scipy.sparse.csr_matrix(data_dictionary["values"])
+    data_dictionary["values"] = scipy.sparse.vstack(
+        [values] * arguments.repeats, format="csr")
+    for key in ["labels", "example names"]:
+        data_dictionary[key] = data_dictionary[key].repeat(arguments.repeats)
+
+    values = data_dictionary["values"]
+    print("Development data set: {} examples, {} features, {} non-zeros."
+          .format(values.shape[0], values.shape[1], values.nnz))
+    print()
+
+    cases = [
+        ("hdf5", compression)
+        for compression in internal_io.HDF5_COMPRESSION_FILTERS
+    ]
+    cases.append(("memmap", None))
+
+    print("{:12}{:>12}{:>12}{:>12}".format(
+        "codec", "save", "load", "size (MB)"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for cache_format, compression in cases:
+
+            name = compression or cache_format
+            path = os.path.join(directory, name) + (
+                internal_io.CACHE_FORMAT_EXTENSIONS[cache_format])
+
+            with suppress_stdout():
+                start_time = time()
+                internal_io.save_data_dictionary(
+                    data_dictionary,
+                    path,
+                    compression=compression,
+                    number_of_threads=arguments.number_of_threads
+                )
+                saving_duration = time() - start_time
+
+                start_time = time()
+                loaded_data_dictionary = internal_io.load_data_dictionary(
+                    path, number_of_threads=arguments.number_of_threads)
+                loaded_data_dictionary["values"].sum()
+                loading_duration = time() - start_time
+
+            print("{:12}{:>12}{:>12}{:>12.1f}".format(
+                name,
+                format_duration(saving_duration),
+                format_duration(loading_duration),
+                _size(path) / 1e6
+            ))
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for directory, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+if __name__ == "__main__":
+    main()
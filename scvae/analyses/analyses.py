@@ -119,7 +119,11 @@ def analyse_data(data_sets,
                     }.items()
                 ])
             data_set_statistics.append(metrics.summary_statistics(
-                data_set.values, name=data_set.kind, tolerance=0.5))
+                data_set.values,
+                name=data_set.kind,
+                tolerance=0.5,
+                number_of_threads=data_set.number_of_processing_threads
+            ))
 
         metrics_duration = time() - metrics_time_start
         print("Metrics calculated ({}).".format(
@@ -875,7 +879,12 @@ def analyse_results(evaluation_set, reconstructed_evaluation_set,
 
         evaluation_set_statistics = [
             metrics.summary_statistics(
-                data_set.values, name=data_set.version, tolerance=0.5)
+                data_set.values,
+                name=data_set.version,
+                tolerance=0.5,
+                number_of_threads=(
+                    evaluation_set.number_of_processing_threads)
+            )
             for data_set in [evaluation_set, reconstructed_evaluation_set]
         ]
 
@@ -168,7 +168,12 @@ FEATURE_REPLACEMENTS = {
         "features with variance above {}".format(
             int(float(match.group(1)))),
     r"keep_highest_variances_([\d.]+)": lambda match:
-        "{} most varying features".format(int(float(match.group(1))))
+        "{} most varying features".format(int(float(match.group(1)))),
+    r"keep_dispersions_above_([\d.]+)": lambda match:
+        "features with normalised dispersion above {}".format(
+            float(match.group(1))),
+    r"keep_highest_dispersions_([\d.]+)": lambda match:
+        "{} most dispersed features".format(int(float(match.group(1))))
 }
 EXAMPLE_FEATURE_REPLACEMENTS = {
     "macosko": "Macosko",
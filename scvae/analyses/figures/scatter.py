@@ -428,10 +428,6 @@ def plot_variable_label_correlations(variable_vector, variable_name,
     figure_name = saving.build_figure_name(name)
     n_examples = variable_vector.shape[0]
 
-    class_names_to_class_ids = numpy.vectorize(
-        lambda class_name:
-        colouring_data_set.class_name_to_class_id[class_name]
-    )
     class_ids_to_class_names = numpy.vectorize(
         lambda class_name:
         colouring_data_set.class_id_to_class_name[class_name]
@@ -455,7 +451,8 @@ def plot_variable_label_correlations(variable_vector, variable_name,
     variable_vector = variable_vector[shuffled_indices]
 
     labels = labels[shuffled_indices]
-    label_ids = numpy.expand_dims(class_names_to_class_ids(labels), axis=-1)
+    label_ids = numpy.expand_dims(
+        colouring_data_set.label_index.label_ids[shuffled_indices], axis=-1)
     colours = [class_palette[label] for label in labels]
 
     unique_class_ids = numpy.unique(label_ids)
@@ -156,8 +156,9 @@ def _exclude_classes_from_label_set(*label_sets, excluded_classes=None):
     labels = label_sets[0]
     other_label_sets = list(label_sets[1:])
 
-    for excluded_class in excluded_classes:
-        included_indices = labels != excluded_class
+    if len(excluded_classes) > 0:
+        included_indices = numpy.isin(
+            labels, excluded_classes, invert=True)
         labels = labels[included_indices]
         for i in range(len(other_label_sets)):
             other_label_sets[i] = other_label_sets[i][included_indices]
@@ -16,33 +16,117 @@
 #
 # ======================================================================== #
 
-import numpy
-
-from scvae.data.sparse import sparsity
-from scvae.data.utilities import standard_deviation
-
-MAXIMUM_NUMBER_OF_VALUES_FOR_NORMAL_STATISTICS_COMPUTATION = 5e8
-
-
-def summary_statistics(x, name="", tolerance=1e-3, skip_sparsity=False):
+import itertools
 
-    batch_size = None
-
-    if x.size > MAXIMUM_NUMBER_OF_VALUES_FOR_NORMAL_STATISTICS_COMPUTATION:
-        batch_size = 1000
+import numpy
+import scipy.sparse
+
+from scvae.data.sparse import ChunkedSparseRowMatrix
+from scvae.utilities import map_in_threads
+
+# Number of values to compute summary statistics for at a time
+SUMMARY_STATISTICS_BLOCK_SIZE = 2 ** 16
+
+
+def summary_statistics(x, name="", tolerance=1e-3, skip_sparsity=False,
+                       number_of_threads=None):
+    """Compute summary statistics of all values in one pass.
+
+    Stored values are summarised in blocks small enough to stay in the
+    processor cache, in parallel threads, by default as many as there are
+    processors, and the means and sums of squared deviations of blocks are
+    combined pairwise. Values not stored in sparse matrices are summarised
+    together as zeros. Sparsity is the fraction of values below
+    `tolerance`.
+    """
+
+    if isinstance(x, ChunkedSparseRowMatrix):
+        value_sets = (
+            x.chunk(chunk_index).data
+            for chunk_index in range(x.number_of_chunks)
+        )
+        number_of_implicit_zeros = x.size - x.nnz
+    elif scipy.sparse.issparse(x):
+        x = scipy.sparse.csr_matrix(x)
+        value_sets = [x.data[:x.nnz]]
+        number_of_implicit_zeros = x.shape[0] * x.shape[1] - x.nnz
+    else:
+        value_sets = [numpy.asarray(x).reshape(-1)]
+        number_of_implicit_zeros = 0
 
-    x_mean = x.mean()
-    x_std = standard_deviation(x, ddof=1, batch_size=batch_size)
+    blocks = (
+        values[start:start + SUMMARY_STATISTICS_BLOCK_SIZE]
+        for values in value_sets
+        for start in range(0, values.size, SUMMARY_STATISTICS_BLOCK_SIZE)
+    )
 
-    x_min = x.min()
-    x_max = x.max()
+    def block_statistics(values):
+
+        size = values.size
+        values = values.astype(numpy.float64, copy=False)
+
+        mean = values.sum() / size
+        squared_deviation_sum = numpy.square(values - mean).sum()
+
+        if skip_sparsity:
+            number_of_non_sparse_values = 0
+        else:
+            number_of_non_sparse_values = numpy.count_nonzero(
+                values >= tolerance)
+
+        return (
+            size, mean, squared_deviation_sum, values.min(), values.max(),
+            number_of_non_sparse_values
+        )
+
+    block_statistics_sets = map_in_threads(
+        block_statistics, blocks, number_of_threads)
+
+    if number_of_implicit_zeros:
+        block_statistics_sets = itertools.chain(
+            block_statistics_sets,
+            [(
+                number_of_implicit_zeros, 0., 0., 0., 0.,
+                number_of_implicit_zeros if 0 >= tolerance else 0
+            )]
+        )
+
+    x_size = 0
+    x_mean = 0.
+    x_squared_deviation_sum = 0.
+    x_min = numpy.inf
+    x_max = -numpy.inf
+    number_of_non_sparse_values = 0
+
+    for (block_size, block_mean, block_squared_deviation_sum,
+            block_minimum, block_maximum,
+            block_number_of_non_sparse_values) in block_statistics_sets:
+
+        # Combine means and sums of squared deviations pairwise
+        combined_size = x_size + block_size
+        mean_difference = block_mean - x_mean
+        x_mean += mean_difference * block_size / combined_size
+        x_squared_deviation_sum += (
+            block_squared_deviation_sum
+            + mean_difference ** 2 * x_size * block_size / combined_size
+        )
+        x_size = combined_size
+
+        x_min = min(x_min, block_minimum)
+        x_max = max(x_max, block_maximum)
+        number_of_non_sparse_values += block_number_of_non_sparse_values
+
+    if x_size > 1:
+        x_std = numpy.sqrt(x_squared_deviation_sum / (x_size - 1))
+    else:
+        x_std = numpy.nan
 
     x_dispersion = x_std**2 / x_mean
 
     if skip_sparsity:
         x_sparsity = numpy.nan
     else:
-        x_sparsity = sparsity(x, tolerance=tolerance, batch_size=batch_size)
+        x_sparsity = 1 - number_of_non_sparse_values / x_size
 
     statistics = {
         "name": name,
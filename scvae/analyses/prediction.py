@@ -19,7 +19,6 @@
 from time import time
 
 import numpy
-import scipy.stats
 from sklearn.cluster import KMeans, MiniBatchKMeans
 
 from scvae.defaults import defaults
@@ -54,48 +53,16 @@ def predict_labels(training_set, evaluation_set, specifications=None,
     prediction_time_start = time()
 
     if evaluation_set.has_labels:
-
-        class_names_to_class_ids = numpy.vectorize(
-            lambda class_name:
-            evaluation_set.class_name_to_class_id[class_name]
-        )
-        class_ids_to_class_names = numpy.vectorize(
-            lambda class_id:
-            evaluation_set.class_id_to_class_name[class_id]
-        )
-
-        evaluation_label_ids = class_names_to_class_ids(
-            evaluation_set.labels)
-
-        if evaluation_set.excluded_classes:
-            excluded_class_ids = class_names_to_class_ids(
-                evaluation_set.excluded_classes)
-        else:
-            excluded_class_ids = []
+        evaluation_label_ids = evaluation_set.label_index.label_ids
+        excluded_class_ids = evaluation_set.label_index.class_ids(
+            evaluation_set.excluded_classes)
 
     if evaluation_set.has_superset_labels:
-
-        superset_class_names_to_superset_class_ids = numpy.vectorize(
-            lambda superset_class_name:
-            evaluation_set.superset_class_name_to_superset_class_id[
-                superset_class_name]
-        )
-        superset_class_ids_to_superset_class_names = numpy.vectorize(
-            lambda superset_class_id:
-            evaluation_set.superset_class_id_to_superset_class_name[
-                superset_class_id]
-        )
-
         evaluation_superset_label_ids = (
-            superset_class_names_to_superset_class_ids(
-                evaluation_set.superset_labels))
-
-        if evaluation_set.excluded_superset_classes:
-            excluded_superset_class_ids = (
-                superset_class_names_to_superset_class_ids(
-                    evaluation_set.excluded_superset_classes))
-        else:
-            excluded_superset_class_ids = []
+            evaluation_set.superset_label_index.label_ids)
+        excluded_superset_class_ids = (
+            evaluation_set.superset_label_index.class_ids(
+                evaluation_set.excluded_superset_classes))
 
     cluster_ids, predicted_labels, predicted_superset_labels = predict(
         training_set=training_set,
@@ -111,7 +78,8 @@ def predict_labels(training_set, evaluation_set, specifications=None,
                 cluster_ids,
                 excluded_class_ids
             )
-            predicted_labels = class_ids_to_class_names(predicted_label_ids)
+            predicted_labels = numpy.array(
+                evaluation_set.class_names)[predicted_label_ids]
 
         if (predicted_superset_labels is None
                 and evaluation_set.has_superset_labels):
@@ -120,9 +88,9 @@ def predict_labels(training_set, evaluation_set, specifications=None,
                 cluster_ids,
                 excluded_superset_class_ids
             )
-            predicted_superset_labels = (
-                superset_class_ids_to_superset_class_names(
-                    predicted_superset_label_ids))
+            predicted_superset_labels = numpy.array(
+                evaluation_set.superset_class_names)[
+                    predicted_superset_label_ids]
 
     prediction_duration = time() - prediction_time_start
     print("Labels predicted ({}).".format(
@@ -133,16 +101,36 @@ def predict_labels(training_set, evaluation_set, specifications=None,
 
 def map_cluster_ids_to_label_ids(label_ids, cluster_ids,
                                  excluded_class_ids=[]):
-    unique_cluster_ids = numpy.unique(cluster_ids).tolist()
-    predicted_label_ids = numpy.zeros_like(cluster_ids)
-    for unique_cluster_id in unique_cluster_ids:
-        indices = cluster_ids == unique_cluster_id
-        index_labels = label_ids[indices]
-        for excluded_class_id in excluded_class_ids:
-            index_labels = index_labels[index_labels != excluded_class_id]
-        if len(index_labels) == 0:
-            continue
-        predicted_label_ids[indices] = scipy.stats.mode(index_labels)[0]
+    """Map each cluster to the most frequent label ID in the cluster.
+
+    Label IDs are counted for all clusters at once, excluding the
+    excluded class IDs and label IDs of labels without a class name,
+    and ties are resolved by the lowest label ID.
+    Clusters with only excluded class IDs are mapped to label ID 0.
+    """
+
+    label_ids = numpy.asarray(label_ids).reshape(-1)
+    cluster_ids = numpy.asarray(cluster_ids)
+
+    unique_cluster_ids, cluster_indices = numpy.unique(
+        cluster_ids.reshape(-1), return_inverse=True)
+    number_of_clusters = unique_cluster_ids.shape[0]
+    number_of_label_ids = max(int(label_ids.max(initial=-1)) + 1, 1)
+
+    included = (label_ids >= 0) & numpy.isin(
+        label_ids, excluded_class_ids, invert=True)
+    label_counts = numpy.bincount(
+        cluster_indices[included] * number_of_label_ids
+        + label_ids[included],
+        minlength=number_of_clusters * number_of_label_ids
+    ).reshape(number_of_clusters, number_of_label_ids)
+
+    cluster_label_ids = numpy.where(
+        label_counts.any(axis=1), label_counts.argmax(axis=1), 0)
+
+    predicted_label_ids = cluster_label_ids[cluster_indices].reshape(
+        cluster_ids.shape).astype(cluster_ids.dtype)
+
     return predicted_label_ids
 
 
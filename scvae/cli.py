@@ -18,13 +18,14 @@
 
 import argparse
 import os
+import time
 
 import scvae
 from scvae import analyses
 from scvae.analyses.prediction import (
     PredictionSpecifications, predict_labels
 )
-from scvae.data import DataSet
+from scvae.data import DataSet, caching
 from scvae.data.utilities import (
     build_directory_path, indices_for_evaluation_subset
 )
@@ -45,7 +46,9 @@ from scvae.utilities import (
 
 
 def analyse(data_set_file_or_name, data_format=None, data_directory=None,
-            map_features=None, feature_selection=None, example_filter=None,
+            cache_format=None, cache_compression=None, cache_budget=None,
+            number_of_processing_threads=None, map_features=None,
+            feature_selection=None, example_filter=None,
             preprocessing_methods=None, split_data_set=None,
             splitting_method=None, splitting_fraction=None,
             included_analyses=None, analysis_level=None,
@@ -69,6 +72,10 @@ def analyse(data_set_file_or_name, data_format=None, data_directory=None,
         data_set_file_or_name,
         data_format=data_format,
         directory=data_directory,
+        cache_format=cache_format,
+        cache_compression=cache_compression,
+        cache_budget=cache_budget,
+        number_of_processing_threads=number_of_processing_threads,
         map_features=map_features,
         feature_selection=feature_selection,
         example_filter=example_filter,
@@ -109,7 +116,9 @@ def analyse(data_set_file_or_name, data_format=None, data_directory=None,
 
 
 def train(data_set_file_or_name, data_format=None, data_directory=None,
-          map_features=None, feature_selection=None, example_filter=None,
+          cache_format=None, cache_compression=None, cache_budget=None,
+          number_of_processing_threads=None, map_features=None,
+          feature_selection=None, example_filter=None,
           noisy_preprocessing_methods=None, preprocessing_methods=None,
           split_data_set=None, splitting_method=None, splitting_fraction=None,
           model_type=None, latent_size=None, hidden_sizes=None,
@@ -122,12 +131,15 @@ def train(data_set_file_or_name, data_format=None, data_directory=None,
           number_of_reconstruction_classes=None, count_sum=None,
           proportion_of_free_nats_for_y_kl_divergence=None,
           minibatch_normalisation=None, batch_correction=None,
-          dropout_keep_probabilities=None,
+          dropout_keep_probabilities=None, sparse_input=None,
           number_of_warm_up_epochs=None, kl_weight=None,
           number_of_epochs=None, minibatch_size=None, learning_rate=None,
           run_id=None, new_run=False, reset_training=None,
           models_directory=None, caches_directory=None,
-          analyses_directory=None, **keyword_arguments):
+          analyses_directory=None, out_of_core=None, input_pipeline=None,
+          number_of_input_workers=None, training_evaluation=None,
+          training_evaluation_subsample_size=None, profile=None,
+          profile_trace_window=None, **keyword_arguments):
     """Train model on data set."""
     print("Train  Model on DATASET")
     if split_data_set is None:
@@ -153,17 +165,25 @@ def train(data_set_file_or_name, data_format=None, data_directory=None,
         data_set_file_or_name,
         data_format=data_format,
         directory=data_directory,
+        cache_format=cache_format,
+        cache_compression=cache_compression,
+        cache_budget=cache_budget,
+        number_of_processing_threads=number_of_processing_threads,
         map_features=map_features,
         feature_selection=feature_selection,
         example_filter=example_filter,
         preprocessing_methods=preprocessing_methods,
         binarise_values=binarise_values,
-        noisy_preprocessing_methods=noisy_preprocessing_methods
+        noisy_preprocessing_methods=noisy_preprocessing_methods,
+        out_of_core=out_of_core
     )
 
     if split_data_set:
         training_set, validation_set, __ = data_set.split(
-            method=splitting_method, fraction=splitting_fraction)
+            method=splitting_method,
+            fraction=splitting_fraction,
+            kinds=["training", "validation"]
+        )
     else:
         data_set.load()
         splitting_method = None
@@ -225,6 +245,7 @@ def train(data_set_file_or_name, data_format=None, data_directory=None,
         minibatch_normalisation=minibatch_normalisation,
         batch_correction=batch_correction,
         dropout_keep_probabilities=dropout_keep_probabilities,
+        sparse_input=sparse_input,
         number_of_warm_up_epochs=number_of_warm_up_epochs,
         kl_weight=kl_weight,
         models_directory=models_directory
@@ -256,7 +277,14 @@ def train(data_set_file_or_name, data_format=None, data_directory=None,
         new_run=new_run,
         reset_training=reset_training,
         analyses_directory=analyses_directory,
-        temporary_log_directory=model_caches_directory
+        temporary_log_directory=model_caches_directory,
+        input_pipeline=input_pipeline,
+        number_of_input_workers=number_of_input_workers,
+        training_evaluation=training_evaluation,
+        training_evaluation_subsample_size=(
+            training_evaluation_subsample_size),
+        profile=profile,
+        profile_trace_window=profile_trace_window
     )
     print("done training model")
     # Remove temporary directories created and emptied during training
@@ -267,7 +295,9 @@ def train(data_set_file_or_name, data_format=None, data_directory=None,
 
 
 def evaluate(data_set_file_or_name, data_format=None, data_directory=None,
-             map_features=None, feature_selection=None, example_filter=None,
+             cache_format=None, cache_compression=None, cache_budget=None,
+             number_of_processing_threads=None, map_features=None,
+             feature_selection=None, example_filter=None,
              noisy_preprocessing_methods=None, preprocessing_methods=None,
              split_data_set=None, splitting_method=None,
              splitting_fraction=None,
@@ -281,7 +311,7 @@ def evaluate(data_set_file_or_name, data_format=None, data_directory=None,
              number_of_reconstruction_classes=None, count_sum=None,
              proportion_of_free_nats_for_y_kl_divergence=None,
              minibatch_normalisation=None, batch_correction=None,
-             dropout_keep_probabilities=None,
+             dropout_keep_probabilities=None, sparse_input=None,
              number_of_warm_up_epochs=None, kl_weight=None,
              minibatch_size=None, run_id=None, models_directory=None,
              included_analyses=None, analysis_level=None,
@@ -333,6 +363,10 @@ def evaluate(data_set_file_or_name, data_format=None, data_directory=None,
         data_set_file_or_name,
         data_format=data_format,
         directory=data_directory,
+        cache_format=cache_format,
+        cache_compression=cache_compression,
+        cache_budget=cache_budget,
+        number_of_processing_threads=number_of_processing_threads,
         map_features=map_features,
         feature_selection=feature_selection,
         example_filter=example_filter,
@@ -346,7 +380,10 @@ def evaluate(data_set_file_or_name, data_format=None, data_directory=None,
 
     if split_data_set:
         training_set, validation_set, test_set = data_set.split(
-            method=splitting_method, fraction=splitting_fraction)
+            method=splitting_method,
+            fraction=splitting_fraction,
+            kinds=[evaluation_set_kind, prediction_training_set_kind]
+        )
         data_subsets = [data_set, training_set, validation_set, test_set]
         for data_subset in data_subsets:
             clear_data_subset = True
@@ -409,6 +446,7 @@ def evaluate(data_set_file_or_name, data_format=None, data_directory=None,
         minibatch_normalisation=minibatch_normalisation,
         batch_correction=batch_correction,
         dropout_keep_probabilities=dropout_keep_probabilities,
+        sparse_input=sparse_input,
         number_of_warm_up_epochs=number_of_warm_up_epochs,
         kl_weight=kl_weight,
         models_directory=models_directory
@@ -600,6 +638,54 @@ def cross_analyse(analyses_directory,
     return 0
 
 
+def cache(action, data_directory=None, cache_budget=None,
+          **keyword_arguments):
+    """List, verify, or prune cached data sets."""
+
+    if data_directory is None:
+        data_directory = defaults["data"]["directory"]
+    if cache_budget is None:
+        cache_budget = defaults["data"]["cache_budget"]
+
+    action = normalise_string(action)
+
+    if action == "list":
+        entries = caching.cache_entries(data_directory)
+        total_size = 0
+        for entry in entries:
+            print("{}: {} ({:.1f} MB, last used {})".format(
+                entry["path"],
+                entry["description"],
+                entry["size"] / 1e6,
+                time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(entry["accessed"]))
+            ))
+            total_size += entry["size"]
+        print("{} cached data sets using {:.1f} MB.".format(
+            len(entries), total_size / 1e6))
+
+    elif action == "verify":
+        problems = caching.verify_cache_entries(data_directory)
+        for path, problem in problems:
+            print("{}: {}".format(path, problem))
+        print("{} problems found with cached data sets.".format(
+            len(problems)))
+        if problems:
+            return 1
+
+    elif action == "prune":
+        removed_paths = caching.prune_cache(
+            data_directory, budget=cache_budget)
+        for path in removed_paths:
+            print("Removed {}.".format(path))
+        print("{} cached data sets removed.".format(len(removed_paths)))
+
+    else:
+        raise ValueError("Cache action `{}` not found.".format(action))
+
+    return 0
+
+
 def _setup_model(data_set, model_type=None,
                  latent_size=None, hidden_sizes=None,
                  number_of_importance_samples=None,
@@ -612,7 +698,7 @@ def _setup_model(data_set, model_type=None,
                  number_of_reconstruction_classes=None, count_sum=None,
                  proportion_of_free_nats_for_y_kl_divergence=None,
                  minibatch_normalisation=None, batch_correction=None,
-                 dropout_keep_probabilities=None,
+                 dropout_keep_probabilities=None, sparse_input=None,
                  number_of_warm_up_epochs=None, kl_weight=None,
                  models_directory=None):
     print("setting up model")
@@ -646,6 +732,7 @@ def _setup_model(data_set, model_type=None,
             number_of_batches=number_of_batches,
             dropout_keep_probabilities=dropout_keep_probabilities,
             count_sum=count_sum,
+            sparse_input=sparse_input,
             number_of_warm_up_epochs=number_of_warm_up_epochs,
             kl_weight=kl_weight,
             log_directory=models_directory
@@ -680,6 +767,7 @@ def _setup_model(data_set, model_type=None,
             number_of_batches=number_of_batches,
             dropout_keep_probabilities=dropout_keep_probabilities,
             count_sum=count_sum,
+            sparse_input=sparse_input,
             number_of_warm_up_epochs=number_of_warm_up_epochs,
             kl_weight=kl_weight,
             log_directory=models_directory
@@ -749,6 +837,32 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_cross_analyse.set_defaults(func=cross_analyse)
 
+    parser_cache = subparsers.add_parser(
+        name="cache",
+        description="List, verify, or prune cached data sets.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_cache.set_defaults(func=cache)
+    parser_cache.add_argument(
+        dest="action",
+        choices=["list", "verify", "prune"],
+        help="list cached data sets with their sizes and last use, verify "
+             "that they can be read, or remove unreadable ones and enforce "
+             "the cache budget"
+    )
+    parser_cache.add_argument(
+        "--data-directory", "-D",
+        metavar="DIRECTORY",
+        default=_parse_default(defaults["data"]["directory"]),
+        help="directory where data are placed or copied"
+    )
+    parser_cache.add_argument(
+        "--cache-budget",
+        metavar="SIZE",
+        type=float,
+        default=_parse_default(defaults["data"]["cache_budget"]),
+        help="disk budget in gigabytes for cached data sets when pruning"
+    )
+
     for subparser in data_set_subparsers:
         subparser.add_argument(
             dest="data_set_file_or_name",
@@ -767,6 +881,45 @@ def main():
             default=_parse_default(defaults["data"]["directory"]),
             help="directory where data are placed or copied"
         )
+        subparser.add_argument(
+            "--cache-format",
+            metavar="FORMAT",
+            default=_parse_default(defaults["data"]["cache_format"]),
+            help=(
+                "format for caching loaded and preprocessed data sets: "
+                "hdf5 (compressed) or memmap (uncompressed, memory-mapped)"
+            )
+        )
+        subparser.add_argument(
+            "--cache-compression",
+            metavar="COMPRESSION",
+            default=_parse_default(defaults["data"]["cache_compression"]),
+            help=(
+                "compression for data sets cached in HDF5 format: "
+                "zlib, blosc_lz4, blosc_zstd, or none"
+            )
+        )
+        subparser.add_argument(
+            "--cache-budget",
+            metavar="SIZE",
+            type=float,
+            default=_parse_default(defaults["data"]["cache_budget"]),
+            help=(
+                "disk budget in gigabytes for cached data sets, beyond which "
+                "the least recently used ones are removed"
+            )
+        )
+        subparser.add_argument(
+            "--number-of-processing-threads",
+            metavar="NUMBER",
+            type=int,
+            default=_parse_default(
+                defaults["data"]["number_of_processing_threads"]),
+            help=(
+                "number of threads for preprocessing values and computing "
+                "statistics of them (default: number of processors)"
+            )
+        )
         subparser.add_argument(
             "--map-features",
             action="store_true",
@@ -987,6 +1140,15 @@ def main():
             default=_parse_default(defaults["models"]["count_sum"]),
             help="use count sum"
         )
+        subparser.add_argument(
+            "--sparse-input",
+            action="store_true",
+            default=_parse_default(defaults["models"]["sparse_input"]),
+            help=(
+                "feed minibatches of values to models as sparse tensors "
+                "without densifying them"
+            )
+        )
         subparser.add_argument(
             "--minibatch-size", "-B",
             metavar="SIZE",
@@ -1038,6 +1200,75 @@ def main():
             default=_parse_default(defaults["models"]["reset_training"]),
             help="reset already trained model"
         )
+        subparser.add_argument(
+            "--out-of-core",
+            action="store_true",
+            default=_parse_default(defaults["data"]["out_of_core"]),
+            help=(
+                "keep cached data set values on disk and only read "
+                "minibatches of them"
+            )
+        )
+        subparser.add_argument(
+            "--input-pipeline",
+            action="store_true",
+            default=_parse_default(defaults["models"]["input_pipeline"]),
+            help=(
+                "assemble minibatches for training in parallel in an input "
+                "pipeline"
+            )
+        )
+        subparser.add_argument(
+            "--number-of-input-workers",
+            metavar="NUMBER",
+            type=int,
+            default=_parse_default(
+                defaults["models"]["number_of_input_workers"]),
+            help=(
+                "number of parallel workers assembling minibatches in the "
+                "input pipeline (default: tuned automatically)"
+            )
+        )
+        subparser.add_argument(
+            "--training-evaluation",
+            type=str,
+            choices=["full", "streaming", "subsample"],
+            default=_parse_default(
+                defaults["models"]["training_evaluation"]),
+            help=(
+                "how to evaluate model on training set after each epoch: "
+                "in a full pass, streamed from the training steps, or on a "
+                "fixed random subsample"
+            )
+        )
+        subparser.add_argument(
+            "--training-evaluation-subsample-size",
+            metavar="SIZE",
+            type=int,
+            default=_parse_default(
+                defaults["models"]["training_evaluation_subsample_size"]),
+            help="number of examples in subsample for training evaluation"
+        )
+        subparser.add_argument(
+            "--profile",
+            action="store_true",
+            default=_parse_default(defaults["models"]["profile"]),
+            help=(
+                "profile training and evaluation steps and save summary in "
+                "log directory of model"
+            )
+        )
+        subparser.add_argument(
+            "--profile-trace-window",
+            metavar=("FIRST", "LAST"),
+            type=int,
+            nargs=2,
+            default=_parse_default(defaults["models"]["profile_trace_window"]),
+            help=(
+                "steps from FIRST up to, but not including, LAST for which "
+                "full traces are captured when profiling"
+            )
+        )
         subparser.add_argument(
             "--caches-directory", "-C",
             metavar="DIRECTORY",
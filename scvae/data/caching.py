@@ -0,0 +1,283 @@
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+import hashlib
+import json
+import os
+import shutil
+from time import time
+
+from scvae.data import internal_io
+
+CACHE_INDEX_FILENAME = "cache_index.json"
+CACHE_KEY_LENGTH = 16
+BYTES_PER_GIGABYTE = 1e9
+
+
+def source_fingerprint(urls, acquired_paths=None):
+    """Fingerprint the source files of a data set.
+
+    Source files are identified by their URL. Local source files, as
+    well as acquired copies of source files given by `acquired_paths`,
+    are also identified by their size and modification time, so that
+    changing or replacing them changes the fingerprint.
+    """
+
+    fingerprint = {}
+
+    if not urls:
+        return fingerprint
+
+    if acquired_paths is None:
+        acquired_paths = {}
+
+    for values_or_labels, kind_urls in sorted(urls.items()):
+        for kind, url in sorted(kind_urls.items()):
+            source = {"url": url}
+            if url and os.path.isfile(url):
+                source.update(_file_fingerprint(url))
+            acquired_path = acquired_paths.get(values_or_labels, {}).get(kind)
+            if acquired_path and os.path.isfile(acquired_path):
+                source["acquired"] = _file_fingerprint(acquired_path)
+            fingerprint["{} {}".format(values_or_labels, kind)] = source
+
+    return fingerprint
+
+
+def build_cache_path(directory, name, description, fingerprint,
+                     cache_format):
+
+    content = json.dumps(
+        {"description": description, "source": fingerprint},
+        sort_keys=True
+    )
+    key = hashlib.sha256(content.encode("UTF-8")).hexdigest()[
+        :CACHE_KEY_LENGTH]
+
+    filename = "{}-{}{}".format(
+        name, key, internal_io.CACHE_FORMAT_EXTENSIONS[cache_format])
+
+    return os.path.join(directory, filename)
+
+
+def register_cache_entry(path, description, fingerprint):
+
+    directory, filename = os.path.split(path)
+    index = _load_cache_index(directory)
+
+    timestamp = time()
+    index[filename] = {
+        "description": description,
+        "source": fingerprint,
+        "size": _path_size(path),
+        "created": timestamp,
+        "accessed": timestamp
+    }
+
+    _save_cache_index(index, directory)
+
+
+def record_cache_access(path):
+
+    directory, filename = os.path.split(path)
+    index = _load_cache_index(directory)
+
+    if filename in index:
+        index[filename]["accessed"] = time()
+        _save_cache_index(index, directory)
+
+
+def cache_entries(data_directory):
+    """List cache entries for all data sets in a data directory.
+
+    Entries are returned as dictionaries including their path and are
+    sorted from least to most recently accessed.
+    """
+
+    entries = []
+
+    for directory, _, filenames in os.walk(data_directory):
+        if CACHE_INDEX_FILENAME not in filenames:
+            continue
+        index = _load_cache_index(directory)
+        for filename, entry in index.items():
+            entry = dict(entry, path=os.path.join(directory, filename))
+            entries.append(entry)
+
+    entries.sort(key=lambda entry: entry["accessed"])
+
+    return entries
+
+
+def verify_cache_entries(data_directory):
+    """Find problems with cache entries in a data directory.
+
+    Returns a list of paths and problems for entries that are missing,
+    have changed in size, or cannot be opened, as well as for cached
+    data sets that are not in any cache index.
+    """
+
+    problems = []
+    indexed_paths = set()
+
+    for entry in cache_entries(data_directory):
+
+        path = entry["path"]
+        indexed_paths.add(path)
+
+        if not os.path.exists(path):
+            problems.append((path, "missing"))
+            continue
+
+        if _path_size(path) != entry["size"]:
+            problems.append((path, "changed in size"))
+            continue
+
+        try:
+            internal_io.LazyDataDictionary(path)
+        except Exception:
+            problems.append((path, "unreadable"))
+
+    for path in _cached_paths(data_directory):
+        if path not in indexed_paths:
+            problems.append((path, "not indexed"))
+
+    return problems
+
+
+def prune_cache(data_directory, budget=None):
+    """Remove invalid cache entries and enforce a disk budget.
+
+    Entries with problems found by `verify_cache_entries` are removed
+    first. If a budget in gigabytes is given, the least recently
+    accessed entries are then removed until the cache fits within it.
+    Returns the paths of the removed entries.
+    """
+
+    removed_paths = []
+
+    for path, _ in verify_cache_entries(data_directory):
+        _remove_cache_entry(path)
+        removed_paths.append(path)
+
+    if budget is not None:
+        removed_paths.extend(enforce_cache_budget(data_directory, budget))
+
+    return removed_paths
+
+
+def enforce_cache_budget(data_directory, budget, kept_paths=None):
+
+    if budget is None:
+        return []
+
+    kept_paths = set(kept_paths or [])
+    budget_in_bytes = budget * BYTES_PER_GIGABYTE
+
+    entries = cache_entries(data_directory)
+    total_size = sum(entry["size"] for entry in entries)
+
+    removed_paths = []
+
+    for entry in entries:
+        if total_size <= budget_in_bytes:
+            break
+        if entry["path"] in kept_paths:
+            continue
+        _remove_cache_entry(entry["path"])
+        removed_paths.append(entry["path"])
+        total_size -= entry["size"]
+
+    return removed_paths
+
+
+def _file_fingerprint(path):
+    status = os.stat(path)
+    return {"size": status.st_size, "modified": status.st_mtime_ns}
+
+
+def _remove_cache_entry(path):
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    directory, filename = os.path.split(path)
+    index = _load_cache_index(directory)
+
+    if filename in index:
+        index.pop(filename)
+        _save_cache_index(index, directory)
+
+
+def _cached_paths(data_directory):
+
+    cache_extensions = tuple(
+        internal_io.CACHE_FORMAT_EXTENSIONS.values())
+    partial_extensions = tuple(
+        extension + internal_io.MEMORY_MAP_PARTIAL_SUFFIX
+        for extension in cache_extensions
+    )
+
+    for directory, subdirectories, filenames in os.walk(data_directory):
+        for name in subdirectories + filenames:
+            if name.endswith(cache_extensions + partial_extensions):
+                yield os.path.join(directory, name)
+        subdirectories[:] = [
+            subdirectory for subdirectory in subdirectories
+            if not subdirectory.endswith(
+                cache_extensions + partial_extensions)
+        ]
+
+
+def _path_size(path):
+
+    if os.path.isdir(path):
+        size = 0
+        for directory, _, filenames in os.walk(path):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(directory, filename))
+    else:
+        size = os.path.getsize(path)
+
+    return size
+
+
+def _load_cache_index(directory):
+
+    index_path = os.path.join(directory, CACHE_INDEX_FILENAME)
+
+    if not os.path.exists(index_path):
+        return {}
+
+    with open(index_path, "r") as index_file:
+        index = json.load(index_file)
+
+    return index
+
+
+def _save_cache_index(index, directory):
+
+    index_path = os.path.join(directory, CACHE_INDEX_FILENAME)
+    temporary_index_path = index_path + ".tmp"
+
+    with open(temporary_index_path, "w") as index_file:
+        json.dump(index, index_file, indent="\t")
+
+    os.replace(temporary_index_path, index_path)
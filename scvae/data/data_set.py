@@ -18,19 +18,19 @@
 
 import os
 import re
-import shutil
 from time import time
 
 import numpy
 import seaborn
 
-from scvae.data import internal_io, loading, parsing, processing, sparse
+from scvae.data import (
+    caching, internal_io, loading, parsing, processing, sparse)
+from scvae.data.utilities import LabelIndex
 from scvae.defaults import defaults
 from scvae.utilities import format_duration, normalise_string
 
 PREPROCESS_SUFFIX = "preprocessed"
 ORIGINAL_SUFFIX = "original"
-PREPROCESSED_EXTENSION = ".sparse.h5"
 
 MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING = 30
 
@@ -143,16 +143,76 @@ class DataSet:
         # Directories and paths for data set
         if directory is None:
             directory = defaults["data"]["directory"]
+        self._data_directory = directory
         self._directory = os.path.join(directory, self.name)
         self._preprocess_directory = os.path.join(
             self._directory, PREPROCESS_SUFFIX)
         self._original_directory = os.path.join(
             self._directory, ORIGINAL_SUFFIX)
 
+        # Format of cached data sets
+        cache_format = kwargs.get("cache_format")
+        if cache_format is None:
+            cache_format = defaults["data"]["cache_format"]
+        cache_format = normalise_string(cache_format)
+        if cache_format not in internal_io.CACHE_FORMAT_EXTENSIONS:
+            raise ValueError(
+                "Cache format `{}` not found.".format(cache_format))
+        self.cache_format = cache_format
+
+        cache_compression = kwargs.get("cache_compression")
+        if cache_compression is None:
+            cache_compression = defaults["data"]["cache_compression"]
+        cache_compression = normalise_string(cache_compression)
+        if cache_compression not in internal_io.HDF5_COMPRESSION_FILTERS:
+            raise ValueError(
+                "Cache compression `{}` not found.".format(cache_compression))
+        self.cache_compression = cache_compression
+
+        # Disk budget in gigabytes for all cached data sets
+        cache_budget = kwargs.get("cache_budget")
+        if cache_budget is None:
+            cache_budget = defaults["data"]["cache_budget"]
+        self.cache_budget = cache_budget
+        self._cache_descriptions = {}
+
+        # Keep cached values on disk and only read minibatches of them
+        out_of_core = kwargs.get("out_of_core")
+        if out_of_core is None:
+            out_of_core = defaults["data"]["out_of_core"]
+        self.out_of_core = out_of_core
+
+        # Processes for loading data sets combined from several files, and
+        # whether to combine these in a fixed order
+        number_of_loading_processes = kwargs.get(
+            "number_of_loading_processes")
+        if number_of_loading_processes is None:
+            number_of_loading_processes = defaults["data"][
+                "number_of_loading_processes"]
+        self.number_of_loading_processes = number_of_loading_processes
+
+        # Threads for preprocessing values and computing statistics of them
+        number_of_processing_threads = kwargs.get(
+            "number_of_processing_threads")
+        if number_of_processing_threads is None:
+            number_of_processing_threads = defaults["data"][
+                "number_of_processing_threads"]
+        self.number_of_processing_threads = number_of_processing_threads
+
+        deterministic_loading = kwargs.get("deterministic_loading")
+        if deterministic_loading is None:
+            deterministic_loading = defaults["data"]["deterministic_loading"]
+        self.deterministic_loading = deterministic_loading
+
+        # Whether to store counts and sparse indices in the most compact
+        # exact data types
+        compact_dtypes = kwargs.get("compact_dtypes")
+        if compact_dtypes is None:
+            compact_dtypes = defaults["data"]["compact_dtypes"]
+        self.compact_dtypes = compact_dtypes
+
         # Save data set dictionary if necessary
         if data_set_dictionary:
-            if os.path.exists(self._directory):
-                shutil.rmtree(self._directory)
             parsing.save_data_set_dictionary_as_json_file(
                 data_set_dictionary,
                 self.name,
@@ -207,6 +267,7 @@ class DataSet:
         # Label super set for data set
         self.label_superset = self.specifications.get("label superset")
         self.superset_labels = None
+        self.superset_label_index = None
         self.number_of_superset_classes = None
 
         # Label palette for data set
@@ -245,6 +306,7 @@ class DataSet:
         self.preprocessed_values = None
         self.binarised_values = None
         self.labels = None
+        self.label_index = None
         self.example_names = None
         self.feature_names = None
         self.batch_indices = None
@@ -370,10 +432,26 @@ class DataSet:
         if self.noisy_preprocessing_methods:
             self.noisy_preprocess = processing.build_preprocessor(
                 self.noisy_preprocessing_methods,
-                noisy=True
+                noisy=True,
+                number_of_threads=self.number_of_processing_threads
+            )
+            (
+                self._deterministic_noisy_preprocess,
+                self.noisy_preprocess_minibatch
+            ) = processing.build_noisy_preprocessors(
+                self.noisy_preprocessing_methods,
+                number_of_threads=self.number_of_processing_threads
             )
         else:
             self.noisy_preprocess = None
+            self._deterministic_noisy_preprocess = None
+            self.noisy_preprocess_minibatch = None
+
+        if self.out_of_core and self._deterministic_noisy_preprocess:
+            raise NotImplementedError(
+                "For out-of-core data sets, noisy preprocessing must begin "
+                "with a stochastic method (such as binarise)."
+            )
 
         if self.kind == "full" and self.values is None:
 
@@ -428,29 +506,16 @@ class DataSet:
     @property
     def class_probabilities(self):
 
-        labels = self.labels
-        class_names = self.class_names
-        excluded_classes = self.excluded_classes
-
-        class_probabilities = {class_name: 0 for class_name in class_names}
-
-        total_count_sum = 0
-
-        for label in labels:
-            if label in excluded_classes:
-                continue
-            class_probabilities[label] += 1
-            total_count_sum += 1
+        class_counts = self.label_index.class_counts.copy()
+        class_counts[self.label_index.class_ids(self.excluded_classes)] = 0
 
-        class_names_with_zero_probability = []
+        total_count_sum = class_counts.sum()
 
-        for name, count in class_probabilities.items():
-            if count == 0:
-                class_names_with_zero_probability.append(name)
-            class_probabilities[name] = count / total_count_sum
-
-        for name in class_names_with_zero_probability:
-            class_probabilities.pop(name)
+        class_probabilities = {
+            class_name: float(count / total_count_sum)
+            for class_name, count in zip(self.class_names, class_counts)
+            if count > 0
+        }
 
         return class_probabilities
 
@@ -494,6 +559,19 @@ class DataSet:
     def has_predicted_cluster_ids(self):
         return self.predicted_cluster_ids is not None
 
+    @property
+    def values_for_noisy_preprocessing(self):
+        """Values to noisily preprocess for every minibatch.
+
+        The deterministic part of the noisy preprocessing is applied to
+        the values once, so only the stochastic part is left for
+        `noisy_preprocess_minibatch`.
+        """
+        if self._deterministic_noisy_preprocess:
+            return _as_sparse_row_matrix(
+                self._deterministic_noisy_preprocess(self.values))
+        return self.values
+
     @property
     def default_feature_parameters(self):
 
@@ -502,10 +580,12 @@ class DataSet:
         if self.feature_selection_method:
             feature_selection = normalise_string(self.feature_selection_method)
 
-            if feature_selection == "keep_variances_above":
+            if feature_selection in [
+                    "keep_variances_above", "keep_dispersions_above"]:
                 feature_selection_parameters = [0.5]
 
-            elif feature_selection == "keep_highest_variances":
+            elif feature_selection in [
+                    "keep_highest_variances", "keep_highest_dispersions"]:
                 if self.number_of_features is not None:
                     feature_selection_parameters = [
                         int(self.number_of_features / 2)
@@ -530,6 +610,9 @@ class DataSet:
 
         if values is not None:
 
+            if self.compact_dtypes:
+                values = sparse.compact_dtypes(values)
+
             self.values = values
 
             self.count_sum = self.values.sum(axis=1).reshape(-1, 1)
@@ -579,6 +662,9 @@ class DataSet:
                 self.example_names = example_names
                 self.feature_names = feature_names
 
+                self.number_of_examples = self.example_names.shape[0]
+                self.number_of_features = self.feature_names.shape[0]
+
         if labels is not None:
 
             if issubclass(labels.dtype.type, numpy.float):
@@ -600,6 +686,8 @@ class DataSet:
                 self.class_name_to_class_id[class_name] = i
                 self.class_id_to_class_name[i] = class_name
 
+            self.label_index = LabelIndex(self.labels, self.class_names)
+
             if not self.excluded_classes:
                 for excluded_class in DEFAULT_EXCLUDED_CLASSES:
                     if excluded_class in self.class_names:
@@ -632,6 +720,9 @@ class DataSet:
                     self.superset_class_id_to_superset_class_name[
                         i] = class_name
 
+                self.superset_label_index = LabelIndex(
+                    self.superset_labels, self.superset_class_names)
+
                 if not self.excluded_superset_classes:
                     for excluded_class in DEFAULT_EXCLUDED_CLASSES:
                         if excluded_class in self.superset_class_names:
@@ -752,10 +843,9 @@ class DataSet:
         print("LOADING DATA SET")
         sparse_path = self._build_preprocessed_path()
 
-        if os.path.isfile(sparse_path):
+        if os.path.exists(sparse_path):
             print("Loading data set.")
-            data_dictionary = internal_io.load_data_dictionary(
-                path=sparse_path)
+            data_dictionary = self._load_cache(sparse_path)
             print()
         else:
             urls = self.specifications.get("URLs", None)
@@ -765,32 +855,56 @@ class DataSet:
                 directory=self._original_directory
             )
 
+            # Acquired source files are part of the cache key
+            sparse_path = self._build_preprocessed_path()
+
+            loader_options = {}
+            if self.data_format == "loom":
+                loader_options["column_attribute_filters"] = (
+                    self.specifications.get("column attribute filters"))
+                loader_options["row_attribute_filters"] = (
+                    self.specifications.get("row attribute filters"))
+            elif self.data_format == "10x_combine":
+                loader_options["number_of_processes"] = (
+                    self.number_of_loading_processes)
+                loader_options["deterministic"] = self.deterministic_loading
+
             loading_time_start = time()
             data_dictionary = loading.load_original_data_set(
                 paths=original_paths,
-                data_format=self.data_format
+                data_format=self.data_format,
+                **loader_options
             )
             loading_duration = time() - loading_time_start
 
             print()
 
-            if loading_duration > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING:
-                if not os.path.exists(self._preprocess_directory):
-                    os.makedirs(self._preprocess_directory)
-
+            if (self.out_of_core or loading_duration
+                    > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING):
                 print("Saving data set.")
-                internal_io.save_data_dictionary(
-                    data_dictionary=data_dictionary,
-                    path=sparse_path
-                )
+                self._save_cache(data_dictionary, sparse_path)
 
                 print()
 
-        data_dictionary["values"] = sparse.SparseRowMatrix(
-            data_dictionary["values"])
+        self._update_from_original(data_dictionary)
+
+        # Original values are replaced by cached preprocessed values, so
+        # only read them, if these have not been cached
+        if not self._preprocessed_values_are_cached():
+            self.update(
+                values=_as_sparse_row_matrix(data_dictionary["values"]),
+                example_names=self.example_names,
+                feature_names=self.feature_names
+            )
+
+        self.preprocess()
+
+        if self.binarise_values:
+            self.binarise()
+
+    def _update_from_original(self, data_dictionary):
 
         self.update(
-            values=data_dictionary["values"],
             labels=data_dictionary["labels"],
             example_names=data_dictionary["example names"],
             feature_names=data_dictionary["feature names"],
@@ -806,11 +920,6 @@ class DataSet:
         if not self.feature_selection_parameters:
             self.feature_selection_parameters = self.default_feature_parameters
 
-        self.preprocess()
-
-        if self.binarise_values:
-            self.binarise()
-
     def preprocess(self):
 
         if (not self.map_features and not self.preprocessing_methods
@@ -818,166 +927,245 @@ class DataSet:
             self.update(preprocessed_values=None)
             return
 
-        sparse_path = self._build_preprocessed_path(
-            map_features=self.map_features,
-            preprocessing_methods=self.preprocessing_methods,
-            feature_selection_method=self.feature_selection_method,
-            feature_selection_parameters=self.feature_selection_parameters,
-            example_filter_method=self.example_filter_method,
-            example_filter_parameters=self.example_filter_parameters
-        )
+        stages = self._preprocessing_stages()
+
+        # Resume from the last stage, for which results have been cached
+        data_dictionary = None
+        number_of_cached_stages = 0
+
+        for stage_number in reversed(range(len(stages))):
+            stage_name, specification, _ = stages[stage_number]
+            sparse_path = self._build_preprocessed_path(**specification)
+            if os.path.exists(sparse_path):
+                print("Loading data set preprocessed until {}.".format(
+                    stage_name))
+                data_dictionary = dict(self._load_cache(sparse_path))
+                number_of_cached_stages = stage_number + 1
+                if self.map_features:
+                    self._update_for_mapped_features()
+                print()
+                break
 
-        if os.path.isfile(sparse_path):
-            print("Loading preprocessed data.")
-            data_dictionary = internal_io.load_data_dictionary(sparse_path)
-            if "preprocessed values" not in data_dictionary:
-                data_dictionary["preprocessed values"] = None
-            if self.map_features:
-                self.features_mapped = True
-                self.terms = _update_tag_for_mapped_features(self.terms)
-            print()
-        else:
+        if data_dictionary is None:
+            data_dictionary = {
+                "values": self.values,
+                "preprocessed values": None,
+                "feature names": self.feature_names,
+                "example names": self.example_names,
+                "labels": self.labels,
+                "batch indices": self.batch_indices
+            }
 
-            preprocessing_time_start = time()
+        for stage_name, specification, stage_function in (
+                stages[number_of_cached_stages:]):
 
-            values = self.values
-            example_names = self.example_names
-            feature_names = self.feature_names
+            stage_time_start = time()
 
-            if self.map_features and not self.features_mapped:
+            # Stages are computed in memory
+            for key in ["values", "preprocessed values"]:
+                if isinstance(data_dictionary.get(key),
+                              sparse.ChunkedSparseRowMatrix):
+                    data_dictionary[key] = (
+                        data_dictionary[key].to_sparse_row_matrix())
 
-                print(
-                    "Mapping {} original features to {} new features."
-                    .format(self.number_of_features, len(self.feature_mapping))
-                )
-                start_time = time()
+            data_dictionary = stage_function(data_dictionary)
 
-                values, feature_names = processing.map_features(
-                    values, feature_names, self.feature_mapping)
+            stage_duration = time() - stage_time_start
 
-                self.features_mapped = True
-                self.terms = _update_tag_for_mapped_features(self.terms)
+            if (self.out_of_core or stage_duration
+                    > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING):
+                sparse_path = self._build_preprocessed_path(**specification)
+                print("Saving data set preprocessed until {}.".format(
+                    stage_name))
+                self._save_cache(data_dictionary, sparse_path)
+                print()
 
-                duration = time() - start_time
-                print("Features mapped ({}).".format(format_duration(
-                    duration)))
+        values = data_dictionary["values"]
+        preprocessed_values = data_dictionary.get("preprocessed values")
 
-                print()
+        if preprocessed_values is None:
+            preprocessed_values = values
 
-            if not self.preprocessed and self.preprocessing_methods:
+        values = _as_sparse_row_matrix(values)
+        preprocessed_values = _as_sparse_row_matrix(preprocessed_values)
 
-                print("Preprocessing values.")
-                start_time = time()
+        self.update(
+            values=values,
+            preprocessed_values=preprocessed_values,
+            example_names=data_dictionary["example names"],
+            feature_names=data_dictionary["feature names"],
+            labels=data_dictionary["labels"],
+            batch_indices=data_dictionary["batch indices"]
+        )
 
-                preprocessing_function = processing.build_preprocessor(
-                    self.preprocessing_methods)
-                preprocessed_values = preprocessing_function(values)
+    def _preprocessing_stages(self):
+        """Build the stages of the preprocessing chain.
 
-                duration = time() - start_time
-                print(
-                    "Values preprocessed ({})."
-                    .format(format_duration(duration))
-                )
+        Each stage is given by its name, the specification of the
+        preprocessing up to and including it, which determines where its
+        results are cached, and a function computing its results from
+        those of the previous stage.
+        """
 
-                print()
+        stages = []
+        specification = {}
 
-            else:
-                preprocessed_values = None
-
-            if self.feature_selection:
-                values_dictionary, feature_names = processing.select_features(
-                    {"original": values,
-                     "preprocessed": preprocessed_values},
-                    self.feature_names,
-                    method=self.feature_selection_method,
-                    parameters=self.feature_selection_parameters
-                )
+        if self.map_features:
+            specification = dict(specification, map_features=True)
+            stages.append((
+                "feature mapping", specification, self._map_features_stage))
 
-                values = values_dictionary["original"]
-                preprocessed_values = values_dictionary["preprocessed"]
+        if self.preprocessing_methods:
+            specification = dict(
+                specification,
+                preprocessing_methods=self.preprocessing_methods
+            )
+            # Values of already preprocessed data sets are kept as is
+            if not self.preprocessed:
+                stages.append((
+                    "preprocessing", specification,
+                    self._preprocess_values_stage
+                ))
 
-                print()
+        if self.feature_selection:
+            specification = dict(
+                specification,
+                feature_selection_method=self.feature_selection_method,
+                feature_selection_parameters=(
+                    self.feature_selection_parameters)
+            )
+            stages.append((
+                "feature selection", specification,
+                self._select_features_stage
+            ))
 
-            if self.example_filter:
-                values_dictionary, example_names, labels, batch_indices = (
-                    processing.filter_examples(
-                        {"original": values,
-                         "preprocessed": preprocessed_values},
-                        self.example_names,
-                        method=self.example_filter_method,
-                        parameters=self.example_filter_parameters,
-                        labels=self.labels,
-                        excluded_classes=self.excluded_classes,
-                        superset_labels=self.superset_labels,
-                        excluded_superset_classes=(
-                            self.excluded_superset_classes),
-                        batch_indices=self.batch_indices,
-                        count_sum=self.count_sum
-                    )
-                )
+        if self.example_filter:
+            specification = dict(
+                specification,
+                example_filter_method=self.example_filter_method,
+                example_filter_parameters=self.example_filter_parameters
+            )
+            stages.append((
+                "example filtering", specification,
+                self._filter_examples_stage
+            ))
 
-                values = values_dictionary["original"]
-                preprocessed_values = values_dictionary["preprocessed"]
+        return stages
 
-                print()
+    def _map_features_stage(self, data_dictionary):
 
-            data_dictionary = {
-                "values": values,
-                "preprocessed values": preprocessed_values,
-            }
+        print(
+            "Mapping {} original features to {} new features."
+            .format(
+                len(data_dictionary["feature names"]),
+                len(self.feature_mapping)
+            )
+        )
+        start_time = time()
 
-            if self.features_mapped or self.feature_selection:
-                data_dictionary["feature names"] = feature_names
+        values, feature_names = processing.map_features(
+            data_dictionary["values"],
+            data_dictionary["feature names"],
+            self.feature_mapping,
+            compact=self.compact_dtypes
+        )
 
-            if self.example_filter:
-                data_dictionary["example names"] = example_names
-                data_dictionary["labels"] = labels
-                data_dictionary["batch indices"] = batch_indices
+        self._update_for_mapped_features()
 
-            preprocessing_duration = time() - preprocessing_time_start
+        duration = time() - start_time
+        print("Features mapped ({}).".format(format_duration(duration)))
 
-            if (preprocessing_duration
-                    > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING):
+        print()
 
-                if not os.path.exists(self._preprocess_directory):
-                    os.makedirs(self._preprocess_directory)
+        return dict(
+            data_dictionary, values=values, **{"feature names": feature_names})
 
-                print("Saving preprocessed data set.")
-                internal_io.save_data_dictionary(data_dictionary, sparse_path)
-                print()
+    def _preprocess_values_stage(self, data_dictionary):
 
-        values = data_dictionary["values"]
-        preprocessed_values = data_dictionary["preprocessed values"]
+        print("Preprocessing values.")
+        start_time = time()
 
-        if preprocessed_values is None:
-            preprocessed_values = values
+        preprocessing_function = processing.build_preprocessor(
+            self.preprocessing_methods,
+            number_of_threads=self.number_of_processing_threads
+        )
+        preprocessed_values = preprocessing_function(
+            data_dictionary["values"])
 
-        if self.features_mapped or self.feature_selection:
-            feature_names = data_dictionary["feature names"]
-        else:
-            feature_names = self.feature_names
+        duration = time() - start_time
+        print("Values preprocessed ({}).".format(format_duration(duration)))
 
-        if self.example_filter:
-            example_names = data_dictionary["example names"]
-            labels = data_dictionary["labels"]
-            batch_indices = data_dictionary["batch indices"]
-        else:
-            example_names = self.example_names
-            labels = self.labels
-            batch_indices = self.batch_indices
+        print()
 
-        values = sparse.SparseRowMatrix(values)
-        preprocessed_values = sparse.SparseRowMatrix(preprocessed_values)
+        return dict(
+            data_dictionary, **{"preprocessed values": preprocessed_values})
 
-        self.update(
-            values=values,
-            preprocessed_values=preprocessed_values,
-            example_names=example_names,
-            feature_names=feature_names,
+    def _select_features_stage(self, data_dictionary):
+
+        values_dictionary, feature_names = processing.select_features(
+            {"original": data_dictionary["values"],
+             "preprocessed": data_dictionary.get("preprocessed values")},
+            data_dictionary["feature names"],
+            method=self.feature_selection_method,
+            parameters=self.feature_selection_parameters,
+            number_of_threads=self.number_of_processing_threads
+        )
+
+        print()
+
+        return dict(
+            data_dictionary,
+            values=values_dictionary["original"],
+            **{
+                "preprocessed values": values_dictionary["preprocessed"],
+                "feature names": feature_names
+            }
+        )
+
+    def _filter_examples_stage(self, data_dictionary):
+
+        # Count sums are found from the values given to the stage, since
+        # the original values are not loaded when resuming from a cached
+        # stage
+        count_sum = numpy.asarray(
+            data_dictionary["values"].sum(axis=1)).reshape(-1, 1)
+
+        values_dictionary, example_names, labels, batch_indices = (
+            processing.filter_examples(
+                {"original": data_dictionary["values"],
+                 "preprocessed": data_dictionary.get("preprocessed values")},
+                data_dictionary["example names"],
+                method=self.example_filter_method,
+                parameters=self.example_filter_parameters,
+                labels=data_dictionary["labels"],
+                excluded_classes=self.excluded_classes,
+                superset_labels=self.superset_labels,
+                excluded_superset_classes=self.excluded_superset_classes,
+                batch_indices=data_dictionary["batch indices"],
+                count_sum=count_sum,
+                label_index=self.label_index,
+                superset_label_index=self.superset_label_index
+            )
+        )
+
+        print()
+
+        return dict(
+            data_dictionary,
+            values=values_dictionary["original"],
             labels=labels,
-            batch_indices=batch_indices
+            **{
+                "preprocessed values": values_dictionary["preprocessed"],
+                "example names": example_names,
+                "batch indices": batch_indices
+            }
         )
 
+    def _update_for_mapped_features(self):
+        if not self.features_mapped:
+            self.features_mapped = True
+            self.terms = _update_tag_for_mapped_features(self.terms)
+
     def binarise(self):
 
         if self.preprocessed_values is None:
@@ -988,18 +1176,11 @@ class DataSet:
 
         binarise_preprocessing = ["binarise"]
 
-        sparse_path = self._build_preprocessed_path(
-            map_features=self.map_features,
-            preprocessing_methods=binarise_preprocessing,
-            feature_selection_method=self.feature_selection_method,
-            feature_selection_parameters=self.feature_selection_parameters,
-            example_filter_method=self.example_filter_method,
-            example_filter_parameters=self.example_filter_parameters
-        )
+        sparse_path = self._build_binarised_path()
 
-        if os.path.isfile(sparse_path):
+        if os.path.exists(sparse_path):
             print("Loading binarised data.")
-            data_dictionary = internal_io.load_data_dictionary(sparse_path)
+            data_dictionary = self._load_cache(sparse_path)
 
         else:
 
@@ -1011,7 +1192,9 @@ class DataSet:
                 start_time = time()
 
                 binarisation_function = processing.build_preprocessor(
-                    binarise_preprocessing)
+                    binarise_preprocessing,
+                    number_of_threads=self.number_of_processing_threads
+                )
                 binarised_values = binarisation_function(self.values)
 
                 duration = time() - start_time
@@ -1032,19 +1215,27 @@ class DataSet:
 
             binarising_duration = time() - binarising_time_start
 
-            if binarising_duration > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING:
-
-                if not os.path.exists(self._preprocess_directory):
-                    os.makedirs(self._preprocess_directory)
-
+            if (self.out_of_core or binarising_duration
+                    > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING):
                 print("Saving binarised data set.")
-                internal_io.save_data_dictionary(data_dictionary, sparse_path)
+                self._save_cache(data_dictionary, sparse_path)
+
+        binarised_values = _as_sparse_row_matrix(
+            data_dictionary["preprocessed values"])
 
-        binarised_values = sparse.SparseRowMatrix(binarised_values)
+        self.update(binarised_values=binarised_values)
 
-        self.update(binarised_values=data_dictionary["preprocessed values"])
+    def _build_binarised_path(self):
+        return self._build_preprocessed_path(
+            map_features=self.map_features,
+            preprocessing_methods=["binarise"],
+            feature_selection_method=self.feature_selection_method,
+            feature_selection_parameters=self.feature_selection_parameters,
+            example_filter_method=self.example_filter_method,
+            example_filter_parameters=self.example_filter_parameters
+        )
 
-    def split(self, method=None, fraction=None):
+    def split(self, method=None, fraction=None, kinds=None):
         """Split data set into subsets.
 
         The data set is split into a training set to train a model, a
@@ -1056,6 +1247,10 @@ class DataSet:
                 ``"sequential"``.
             fraction (float, optional): The fraction to use for
                 training and, optionally, validation.
+            kinds (list(str), optional): The kinds of subsets to load:
+                ``"training"``, ``"validation"``, and/or ``"test"``.
+                Subsets of other kinds are returned without values.
+                Defaults to all three.
 
         Returns:
             Training, validation, and test sets.
@@ -1070,17 +1265,8 @@ class DataSet:
         if method == "default":
             method = self.default_splitting_method
 
-        sparse_path = self._build_preprocessed_path(
-            map_features=self.map_features,
-            preprocessing_methods=self.preprocessing_methods,
-            feature_selection_method=self.feature_selection_method,
-            feature_selection_parameters=self.feature_selection_parameters,
-            example_filter_method=self.example_filter_method,
-            example_filter_parameters=self.example_filter_parameters,
-            splitting_method=method,
-            splitting_fraction=fraction,
-            split_indices=self.split_indices
-        )
+        if kinds is None:
+            kinds = ["training", "validation", "test"]
 
         print("Splitting:")
         print("    method:", method)
@@ -1088,156 +1274,80 @@ class DataSet:
             print("    fraction: {:.1f} %".format(100 * fraction))
         print()
 
-        if os.path.isfile(sparse_path):
-            print("Loading split data sets.")
-            split_data_dictionary = internal_io.load_data_dictionary(
-                path=sparse_path)
-            if self.map_features:
-                self.features_mapped = True
-                self.terms = _update_tag_for_mapped_features(self.terms)
-            print()
+        if self.out_of_core:
+            split_data_dictionary = self._split_values(method, fraction)
         else:
+            split_data_dictionary = self._split_indices(
+                method, fraction, kinds)
+
+        subsets = {}
+
+        for subset_kind in ["training", "validation", "test"]:
+
+            if subset_kind in kinds:
+                subset_dictionary = split_data_dictionary[
+                    "{} set".format(subset_kind)]
+                subset_values = {}
+                for values_key in [
+                        "values", "preprocessed values", "binarised values"]:
+                    subset_values[values_key] = _as_sparse_row_matrix(
+                        subset_dictionary[values_key])
+                labels = subset_dictionary["labels"]
+                example_names = subset_dictionary["example names"]
+                batch_indices = subset_dictionary["batch indices"]
+            else:
+                subset_values = {}
+                labels = None
+                example_names = None
+                batch_indices = None
 
-            if self.values is None:
-                self.load()
-
-            data_dictionary = {
-                "values": self.values,
-                "preprocessed values": self.preprocessed_values,
-                "binarised values": self.binarised_values,
-                "labels": self.labels,
-                "example names": self.example_names,
-                "feature names": self.feature_names,
-                "batch indices": self.batch_indices,
-                "class names": self.class_names,
-                "split indices": self.split_indices
-            }
-
-            splitting_time_start = time()
-            split_data_dictionary = processing.split_data_set(
-                data_dictionary, method, fraction)
-            splitting_duration = time() - splitting_time_start
-
-            print()
-
-            if splitting_duration > MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING:
-
-                if not os.path.exists(self._preprocess_directory):
-                    os.makedirs(self._preprocess_directory)
-
-                print("Saving split data sets.")
-                internal_io.save_data_dictionary(
-                    data_dictionary=split_data_dictionary,
-                    parse=sparse_path
-                )
-                print()
-
-        for data_subset in split_data_dictionary:
-            if not isinstance(split_data_dictionary[data_subset], dict):
-                continue
-            for data_subset_key in split_data_dictionary[data_subset]:
-                if "values" in data_subset_key:
-                    values = split_data_dictionary[data_subset][
-                        data_subset_key]
-                    if values is not None:
-                        split_data_dictionary[data_subset][data_subset_key] = (
-                            sparse.SparseRowMatrix(values))
-
-        training_set = DataSet(
-            self.name,
-            title=self.title,
-            specifications=self.specifications,
-            values=split_data_dictionary["training set"]["values"],
-            preprocessed_values=(
-                split_data_dictionary["training set"]["preprocessed values"]),
-            binarised_values=(
-                split_data_dictionary["training set"]["binarised values"]),
-            labels=split_data_dictionary["training set"]["labels"],
-            example_names=(
-                split_data_dictionary["training set"]["example names"]),
-            feature_names=split_data_dictionary["feature names"],
-            batch_indices=(
-                split_data_dictionary["training set"]["batch indices"]),
-            batch_names=self.batch_names,
-            features_mapped=self.features_mapped,
-            class_names=split_data_dictionary["class names"],
-            feature_selection=self.feature_selection,
-            example_filter=self.example_filter,
-            preprocessing_methods=self.preprocessing_methods,
-            noisy_preprocessing_methods=self.noisy_preprocessing_methods,
-            kind="training"
-        )
-
-        validation_set = DataSet(
-            self.name,
-            title=self.title,
-            specifications=self.specifications,
-            values=split_data_dictionary["validation set"]["values"],
-            preprocessed_values=(
-                split_data_dictionary["validation set"]["preprocessed values"]
-            ),
-            binarised_values=(
-                split_data_dictionary["validation set"]["binarised values"]),
-            labels=split_data_dictionary["validation set"]["labels"],
-            example_names=(
-                split_data_dictionary["validation set"]["example names"]),
-            feature_names=split_data_dictionary["feature names"],
-            batch_indices=(
-                split_data_dictionary["training set"]["batch indices"]),
-            batch_names=self.batch_names,
-            features_mapped=self.features_mapped,
-            class_names=split_data_dictionary["class names"],
-            feature_selection=self.feature_selection,
-            example_filter=self.example_filter,
-            preprocessing_methods=self.preprocessing_methods,
-            noisy_preprocessing_methods=self.noisy_preprocessing_methods,
-            kind="validation"
-        )
-
-        test_set = DataSet(
-            self.name,
-            title=self.title,
-            specifications=self.specifications,
-            values=split_data_dictionary["test set"]["values"],
-            preprocessed_values=(
-                split_data_dictionary["test set"]["preprocessed values"]),
-            binarised_values=(
-                split_data_dictionary["test set"]["binarised values"]),
-            labels=split_data_dictionary["test set"]["labels"],
-            example_names=split_data_dictionary["test set"]["example names"],
-            feature_names=split_data_dictionary["feature names"],
-            batch_indices=(
-                split_data_dictionary["training set"]["batch indices"]),
-            batch_names=self.batch_names,
-            features_mapped=self.features_mapped,
-            class_names=split_data_dictionary["class names"],
-            feature_selection=self.feature_selection,
-            example_filter=self.example_filter,
-            preprocessing_methods=self.preprocessing_methods,
-            noisy_preprocessing_methods=self.noisy_preprocessing_methods,
-            kind="test"
-        )
+            subsets[subset_kind] = DataSet(
+                self.name,
+                title=self.title,
+                specifications=self.specifications,
+                values=subset_values.get("values"),
+                preprocessed_values=subset_values.get("preprocessed values"),
+                binarised_values=subset_values.get("binarised values"),
+                labels=labels,
+                example_names=example_names,
+                feature_names=split_data_dictionary["feature names"],
+                batch_indices=batch_indices,
+                batch_names=self.batch_names,
+                features_mapped=self.features_mapped,
+                class_names=split_data_dictionary["class names"],
+                feature_selection=self.feature_selection,
+                example_filter=self.example_filter,
+                preprocessing_methods=self.preprocessing_methods,
+                noisy_preprocessing_methods=self.noisy_preprocessing_methods,
+                out_of_core=self.out_of_core,
+                compact_dtypes=self.compact_dtypes,
+                number_of_processing_threads=(
+                    self.number_of_processing_threads),
+                kind=subset_kind
+            )
 
         print(
-            "Data sets with {} features{}{}:\n".format(
-                training_set.number_of_features,
+            "Data sets with {} features{}{}:".format(
+                len(split_data_dictionary["feature names"]),
                 (" and {} classes".format(self.number_of_classes)
                     if self.number_of_classes else ""),
                 (" ({} superset classes)".format(
                     self.number_of_superset_classes)
                     if self.number_of_superset_classes else "")
-            ) +
-            "    Training set: {} examples.\n".format(
-                training_set.number_of_examples) +
-            "    Validation set: {} examples.\n".format(
-                validation_set.number_of_examples) +
-            "    Test set: {} examples.".format(
-                test_set.number_of_examples)
+            )
         )
 
+        for subset_kind, subset in subsets.items():
+            if subset_kind in kinds:
+                print("    {} set: {} examples.".format(
+                    subset_kind.capitalize(), subset.number_of_examples))
+            else:
+                print("    {} set: not loaded.".format(
+                    subset_kind.capitalize()))
+
         print()
 
-        return training_set, validation_set, test_set
+        return subsets["training"], subsets["validation"], subsets["test"]
 
     def clear(self):
         """Clear data set."""
@@ -1250,6 +1360,7 @@ class DataSet:
         self.preprocessed_values = None
         self.binarised_values = None
         self.labels = None
+        self.label_index = None
         self.example_names = None
         self.feature_names = None
         self.batch_indices = None
@@ -1260,6 +1371,243 @@ class DataSet:
         self.number_of_features = None
         self.number_of_classes = None
 
+    def _split_indices(self, method, fraction, kinds):
+        """Split data set into subsets selecting rows of the data set.
+
+        Only the indices of the examples in each subset are cached, and
+        subsets of consecutive examples share values with the data set.
+        Rows are only selected for subsets of the kinds given. If the
+        data set has not been loaded, but the preprocessed data set has
+        been cached, only these rows are read.
+        """
+
+        values_dictionary = None
+
+        if self.values is None:
+            values_dictionary = self._open_cached_values()
+
+        if values_dictionary is None:
+            if self.values is None:
+                self.load()
+            values_dictionary = {
+                "values": self.values,
+                "preprocessed values": self.preprocessed_values,
+                "binarised values": self.binarised_values
+            }
+
+        indices_path = self._build_preprocessed_path(
+            map_features=self.map_features,
+            preprocessing_methods=self.preprocessing_methods,
+            feature_selection_method=self.feature_selection_method,
+            feature_selection_parameters=self.feature_selection_parameters,
+            example_filter_method=self.example_filter_method,
+            example_filter_parameters=self.example_filter_parameters,
+            splitting_method=method,
+            splitting_fraction=fraction,
+            split_indices=self.split_indices,
+            only_split_indices=True
+        )
+
+        if os.path.exists(indices_path):
+            print("Loading indices for split data sets.")
+            indices_dictionary = self._load_cache(indices_path)
+            subset_indices = dict(zip(
+                ["training", "validation", "test"],
+                numpy.split(
+                    indices_dictionary["example indices"],
+                    numpy.cumsum(indices_dictionary["subset sizes"])[:-1]
+                )
+            ))
+            print()
+        else:
+            subset_indices = processing.split_data_set_indices(
+                number_of_examples=self.number_of_examples,
+                method=method,
+                fraction=fraction,
+                split_indices=self.split_indices
+            )
+            # Indices are stored together, since empty arrays cannot be
+            # saved
+            example_indices = [
+                numpy.arange(self.number_of_examples)[subset_indices[kind]]
+                for kind in ["training", "validation", "test"]
+            ]
+            indices_dictionary = {
+                "example indices": numpy.concatenate(example_indices),
+                "subset sizes": numpy.array(
+                    [indices.size for indices in example_indices])
+            }
+            print("Saving indices for split data sets.")
+            self._save_cache(indices_dictionary, indices_path)
+            print()
+
+        split_data_dictionary = {
+            "feature names": self.feature_names,
+            "class names": self.class_names
+        }
+
+        for subset_kind, indices in subset_indices.items():
+
+            if subset_kind not in kinds:
+                continue
+
+            subset_dictionary = {}
+
+            for values_key, values in values_dictionary.items():
+                if (values is values_dictionary["values"]
+                        and values_key != "values"):
+                    subset_dictionary[values_key] = subset_dictionary[
+                        "values"]
+                else:
+                    subset_dictionary[values_key] = sparse.select_rows(
+                        values, indices)
+
+            subset_dictionary["labels"] = sparse.select_rows(
+                self.labels, indices)
+            subset_dictionary["example names"] = sparse.select_rows(
+                self.example_names, indices)
+            subset_dictionary["batch indices"] = sparse.select_rows(
+                self.batch_indices, indices)
+
+            split_data_dictionary["{} set".format(subset_kind)] = (
+                subset_dictionary)
+
+        return split_data_dictionary
+
+    def _open_cached_values(self):
+        """Open cached values of data set out of core.
+
+        The examples, features, and labels of the data set are read from
+        the cached preprocessed data set, but its values are opened as
+        chunked sparse matrices, so that rows of them are only read from
+        disk when selected. Returns the values, preprocessed values, and
+        binarised values by name, or `None`, if they have not all been
+        cached.
+        """
+
+        original_path = self._build_preprocessed_path()
+
+        if not os.path.exists(original_path):
+            return None
+
+        self._update_from_original(self._load_cache(original_path))
+
+        stages = self._preprocessing_stages()
+
+        if stages:
+            _, specification, _ = stages[-1]
+            sparse_path = self._build_preprocessed_path(**specification)
+        else:
+            sparse_path = original_path
+
+        if self.binarise_values:
+            binarised_path = self._build_binarised_path()
+        else:
+            binarised_path = None
+
+        if not os.path.exists(sparse_path) or (
+                binarised_path and not os.path.exists(binarised_path)):
+            return None
+
+        print("Opening preprocessed data set.")
+        data_dictionary = self._load_cache(sparse_path, out_of_core=True)
+        print()
+
+        if self.map_features:
+            self._update_for_mapped_features()
+
+        self.update(
+            example_names=data_dictionary["example names"],
+            feature_names=data_dictionary["feature names"],
+            labels=data_dictionary["labels"],
+            batch_indices=data_dictionary.get("batch indices")
+        )
+
+        values = data_dictionary["values"]
+        preprocessed_values = data_dictionary.get("preprocessed values")
+
+        # As in `preprocess`, values without any preprocessing are not
+        # also used as preprocessed values
+        if preprocessed_values is None and (
+                self.map_features or self.preprocessing_methods
+                or self.feature_selection or self.example_filter):
+            preprocessed_values = values
+
+        if binarised_path:
+            binarised_values = self._load_cache(
+                binarised_path, out_of_core=True)["preprocessed values"]
+        else:
+            binarised_values = None
+
+        return {
+            "values": values,
+            "preprocessed values": preprocessed_values,
+            "binarised values": binarised_values
+        }
+
+    def _split_values(self, method, fraction):
+        """Split data set into subsets copying rows of the data set.
+
+        The subsets are cached in full, so that their values can be read
+        out of core.
+        """
+
+        sparse_path = self._build_preprocessed_path(
+            map_features=self.map_features,
+            preprocessing_methods=self.preprocessing_methods,
+            feature_selection_method=self.feature_selection_method,
+            feature_selection_parameters=self.feature_selection_parameters,
+            example_filter_method=self.example_filter_method,
+            example_filter_parameters=self.example_filter_parameters,
+            splitting_method=method,
+            splitting_fraction=fraction,
+            split_indices=self.split_indices
+        )
+
+        if os.path.exists(sparse_path):
+            print("Loading split data sets.")
+            split_data_dictionary = self._load_cache(sparse_path)
+            if self.map_features:
+                self._update_for_mapped_features()
+            print()
+        else:
+
+            if self.values is None:
+                self.load()
+
+            data_dictionary = {
+                "values": self.values,
+                "preprocessed values": self.preprocessed_values,
+                "binarised values": self.binarised_values,
+                "labels": self.labels,
+                "example names": self.example_names,
+                "feature names": self.feature_names,
+                "batch indices": self.batch_indices,
+                "class names": self.class_names,
+                "split indices": self.split_indices
+            }
+
+            split_data_dictionary = processing.split_data_set(
+                data_dictionary, method, fraction)
+
+            print()
+            print("Saving split data sets.")
+            self._save_cache(split_data_dictionary, sparse_path)
+            print()
+
+        return split_data_dictionary
+
+    def _preprocessed_values_are_cached(self):
+
+        if (not self.map_features and not self.preprocessing_methods
+                and not self.feature_selection and not self.example_filter):
+            return False
+
+        return any(
+            os.path.exists(self._build_preprocessed_path(**specification))
+            for _, specification, _ in self._preprocessing_stages()
+        )
+
     def _build_preprocessed_path(
             self,
             map_features=None,
@@ -1270,11 +1618,10 @@ class DataSet:
             example_filter_parameters=None,
             splitting_method=None,
             splitting_fraction=None,
-            split_indices=None):
-
-        base_path = os.path.join(self._preprocess_directory, self.name)
+            split_indices=None,
+            only_split_indices=False):
 
-        filename_parts = [base_path]
+        filename_parts = []
 
         if map_features:
             filename_parts.append("features_mapped")
@@ -1310,10 +1657,78 @@ class DataSet:
                     splitting_fraction
                 ))
 
-        path = "-".join(filename_parts) + PREPROCESSED_EXTENSION
+            if only_split_indices:
+                filename_parts.append("indices")
+
+        description = "-".join(filename_parts) or "original"
+
+        path = caching.build_cache_path(
+            directory=self._preprocess_directory,
+            name=self.name,
+            description=description,
+            fingerprint=self._cache_source_fingerprint(),
+            cache_format=self.cache_format
+        )
+        self._cache_descriptions[path] = description
 
         return path
 
+    def _cache_source_fingerprint(self):
+        urls = self.specifications.get("URLs")
+        fingerprint = caching.source_fingerprint(
+            urls,
+            acquired_paths=loading.acquired_data_set_paths(
+                title=self.title,
+                urls=urls,
+                directory=self._original_directory
+            )
+        )
+        fingerprint["format"] = self.data_format
+        for attribute_filters_kind in [
+                "column attribute filters", "row attribute filters"]:
+            attribute_filters = self.specifications.get(
+                attribute_filters_kind)
+            if attribute_filters:
+                fingerprint[attribute_filters_kind] = attribute_filters
+        return fingerprint
+
+    def _load_cache(self, path, out_of_core=None):
+        if out_of_core is None:
+            out_of_core = self.out_of_core
+        caching.record_cache_access(path)
+        return internal_io.load_data_dictionary(
+            path=path, lazy=True, out_of_core=out_of_core)
+
+    def _save_cache(self, data_dictionary, path):
+
+        if not os.path.exists(self._preprocess_directory):
+            os.makedirs(self._preprocess_directory)
+
+        internal_io.save_data_dictionary(
+            data_dictionary=data_dictionary,
+            path=path,
+            compression=self.cache_compression
+        )
+
+        caching.register_cache_entry(
+            path=path,
+            description=self._cache_descriptions.get(path),
+            fingerprint=self._cache_source_fingerprint()
+        )
+        caching.enforce_cache_budget(
+            data_directory=self._data_directory,
+            budget=self.cache_budget,
+            kept_paths=[path]
+        )
+
+
+def _as_sparse_row_matrix(values):
+    if values is None or isinstance(
+            values,
+            (sparse.SparseRowMatrix, sparse.ChunkedSparseRowMatrix)):
+        return values
+    return sparse.SparseRowMatrix(values)
+
 
 def _postprocess_terms(terms):
     if "item" in terms and terms["item"]:
@@ -16,68 +16,206 @@
 #
 # ======================================================================== #
 
+import collections.abc
+import json
 import os
+import shutil
+from contextlib import contextmanager
 from time import time
 
 import numpy
 import scipy
 import tables
 
+from scvae.data.sparse import ChunkedSparseRowMatrix, SparseRowMatrix
 from scvae.utilities import normalise_string, format_duration
 
+CACHE_FORMAT_EXTENSIONS = {
+    "hdf5": ".sparse.h5",
+    "memmap": ".sparse.mmap"
+}
+DEFAULT_CACHE_FORMAT = "hdf5"
 
-def load_data_dictionary(path):
+HDF5_COMPRESSION_FILTERS = {
+    "zlib": {"complib": "zlib", "complevel": 5},
+    "blosc_lz4": {"complib": "blosc:lz4", "complevel": 5, "shuffle": True},
+    "blosc_zstd": {"complib": "blosc:zstd", "complevel": 5, "shuffle": True},
+    "none": {"complevel": 0}
+}
+DEFAULT_HDF5_COMPRESSION = "zlib"
+HDF5_CHUNK_SIZE_IN_BYTES = 2 ** 20
 
-    def load(tables_file, group=None):
+MEMORY_MAP_MANIFEST_FILENAME = "manifest.json"
+MEMORY_MAP_ARRAY_EXTENSION = ".npy"
+MEMORY_MAP_PARTIAL_SUFFIX = ".partial"
 
-        if not group:
-            group = tables_file.root
 
-        data_dictionary = {}
-
-        for node in tables_file.iter_nodes(group):
-            node_title = node._v_title
-            if node == group:
-                pass
-            elif isinstance(node, tables.Group):
-                if node_title.endswith("set"):
-                    data_dictionary[node_title] = load(
-                        tables_file, group=node)
-                elif node_title.endswith("values"):
-                    data_dictionary[node_title] = _load_sparse_matrix(
-                        tables_file, group=node)
-                elif node_title == "split indices":
-                    data_dictionary[node_title] = _load_split_indices(
-                        tables_file, group=node)
-                elif node_title == "feature mapping":
-                    data_dictionary[node_title] = _load_feature_mapping(
-                        tables_file, group=node)
-                else:
-                    raise NotImplementedError(
-                        "Loading group `{}` not implemented.".format(
-                            node_title)
-                    )
-            elif isinstance(node, tables.Array):
-                data_dictionary[node_title] = _load_array_or_other_type(node)
-            else:
-                raise NotImplementedError(
-                    "Loading node `{}` not implemented.".format(node_title)
-                )
+def cache_format_from_path(path):
+    for cache_format, cache_extension in CACHE_FORMAT_EXTENSIONS.items():
+        if path.endswith(cache_extension):
+            return cache_format
+    return DEFAULT_CACHE_FORMAT
+
 
-        return data_dictionary
+def load_data_dictionary(path, lazy=False, out_of_core=False,
+                         number_of_threads=None):
 
     start_time = time()
 
-    with tables.open_file(path, "r") as tables_file:
-        data_dictionary = load(tables_file)
+    if lazy or out_of_core:
+        lazy = True
+        data_dictionary = LazyDataDictionary(
+            path,
+            out_of_core=out_of_core,
+            number_of_threads=number_of_threads
+        )
+    elif cache_format_from_path(path) == "memmap":
+        data_dictionary = _load_memory_mapped_data_dictionary(path)
+    else:
+        with _blosc_threads(number_of_threads):
+            with tables.open_file(path, "r") as tables_file:
+                data_dictionary = _load_group(
+                    tables_file, group=tables_file.root)
 
     duration = time() - start_time
-    print("Data loaded ({}).".format(format_duration(duration)))
+
+    if lazy:
+        print("Data opened ({}).".format(format_duration(duration)))
+    else:
+        print("Data loaded ({}).".format(format_duration(duration)))
 
     return data_dictionary
 
 
-def save_data_dictionary(data_dictionary, path):
+class LazyDataDictionary(collections.abc.MutableMapping):
+    """Data dictionary loading each of its entries on first access.
+
+    Only the titles of the entries are read when the dictionary is
+    created. Each entry is then loaded from disk when it is first
+    accessed and kept afterwards, so entries that are never accessed are
+    never read. Nested data-set groups are themselves lazy. If out of
+    core, sparse matrices are not read, but opened as chunked sparse
+    matrices instead. Entries can be set and deleted as in an ordinary
+    dictionary without affecting the saved data dictionary.
+    """
+
+    def __init__(self, path, group_path=None, out_of_core=False,
+                 number_of_threads=None):
+
+        self.path = path
+        self.cache_format = cache_format_from_path(path)
+        self.out_of_core = out_of_core
+        self.number_of_threads = number_of_threads
+
+        self._group_path = group_path
+        self._locations = {}
+        self._values = {}
+
+        if self.cache_format == "memmap":
+            manifest_path = os.path.join(
+                self._directory, MEMORY_MAP_MANIFEST_FILENAME)
+            with open(manifest_path, "r") as manifest_file:
+                self._locations = json.load(manifest_file)
+        else:
+            with tables.open_file(path, "r") as tables_file:
+                if group_path:
+                    group = tables_file.get_node(group_path)
+                else:
+                    group = tables_file.root
+                for node in tables_file.iter_nodes(group):
+                    self._locations[node._v_title] = node._v_pathname
+
+    @property
+    def _directory(self):
+        if self._group_path:
+            return os.path.join(self.path, self._group_path)
+        else:
+            return self.path
+
+    def __getitem__(self, title):
+        if title not in self._values:
+            if title not in self._locations:
+                raise KeyError(title)
+            self._values[title] = self._load(title)
+        return self._values[title]
+
+    def __setitem__(self, title, value):
+        self._values[title] = value
+
+    def __delitem__(self, title):
+        if title not in self:
+            raise KeyError(title)
+        self._values.pop(title, None)
+        self._locations.pop(title, None)
+
+    def __contains__(self, title):
+        return title in self._locations or title in self._values
+
+    def __iter__(self):
+        yield from self._locations
+        for title in self._values:
+            if title not in self._locations:
+                yield title
+
+    def __len__(self):
+        return len(self._locations.keys() | self._values.keys())
+
+    def _load(self, title):
+
+        location = self._locations[title]
+
+        if self.cache_format == "memmap":
+            if location["kind"] == "group":
+                value = LazyDataDictionary(
+                    self.path,
+                    group_path=os.path.join(
+                        self._group_path or "", location["name"]),
+                    out_of_core=self.out_of_core,
+                    number_of_threads=self.number_of_threads
+                )
+            elif self.out_of_core and location["kind"] == "sparse matrix":
+                value = _open_memory_mapped_chunked_sparse_matrix(
+                    os.path.join(self._directory, location["name"]),
+                    shape=location["shape"]
+                )
+            else:
+                value = _load_memory_mapped_entry(
+                    title, location, self._directory)
+        else:
+            with _blosc_threads(self.number_of_threads):
+                with tables.open_file(self.path, "r") as tables_file:
+                    node = tables_file.get_node(location)
+                    if (isinstance(node, tables.Group)
+                            and title.endswith("set")):
+                        value = LazyDataDictionary(
+                            self.path,
+                            group_path=location,
+                            out_of_core=self.out_of_core,
+                            number_of_threads=self.number_of_threads
+                        )
+                    elif (self.out_of_core
+                            and isinstance(node, tables.Group)
+                            and title.endswith("values")):
+                        value = _open_chunked_sparse_matrix(
+                            self.path, tables_file, group=node,
+                            number_of_threads=self.number_of_threads
+                        )
+                    else:
+                        value = _load_node(tables_file, node)
+
+        return value
+
+
+def save_data_dictionary(data_dictionary, path, compression=None,
+                         number_of_threads=None):
+
+    if compression is None:
+        compression = DEFAULT_HDF5_COMPRESSION
+    compression = normalise_string(compression)
+
+    if compression not in HDF5_COMPRESSION_FILTERS:
+        raise ValueError(
+            "Compression `{}` not found.".format(compression))
 
     directory, filename = os.path.split(path)
 
@@ -114,10 +252,13 @@ def save_data_dictionary(data_dictionary, path):
 
     start_time = time()
 
-    filters = tables.Filters(complib="zlib", complevel=5)
-
-    with tables.open_file(path, "w", filters=filters) as tables_file:
-        save(data_dictionary, tables_file)
+    if cache_format_from_path(path) == "memmap":
+        _save_memory_mapped_data_dictionary(data_dictionary, path)
+    else:
+        filters = tables.Filters(**HDF5_COMPRESSION_FILTERS[compression])
+        with _blosc_threads(number_of_threads):
+            with tables.open_file(path, "w", filters=filters) as tables_file:
+                save(data_dictionary, tables_file)
 
     duration = time() - start_time
     print("Data saved ({}).".format(format_duration(duration)))
@@ -128,11 +269,10 @@ def _load_array_or_other_type(node):
     value = node.read()
 
     if value.dtype.char == "S":
-        decode = numpy.vectorize(lambda s: s.decode("UTF-8"))
-        value = decode(value).astype("U")
+        value = _decode_strings(value)
 
     elif value.dtype == numpy.uint8:
-        value = value.tostring().decode("UTF-8")
+        value = value.tobytes().decode("UTF-8")
 
         if value == "None":
             value = None
@@ -143,6 +283,43 @@ def _load_array_or_other_type(node):
     return value
 
 
+def _load_group(tables_file, group):
+
+    data_dictionary = {}
+
+    for node in tables_file.iter_nodes(group):
+        data_dictionary[node._v_title] = _load_node(tables_file, node)
+
+    return data_dictionary
+
+
+def _load_node(tables_file, node):
+
+    node_title = node._v_title
+
+    if isinstance(node, tables.Group):
+        if node_title.endswith("set"):
+            value = _load_group(tables_file, group=node)
+        elif node_title.endswith("values"):
+            value = _load_sparse_matrix(tables_file, group=node)
+        elif node_title == "split indices":
+            value = _load_split_indices(tables_file, group=node)
+        elif node_title == "feature mapping":
+            value = _load_feature_mapping(tables_file, group=node)
+        else:
+            raise NotImplementedError(
+                "Loading group `{}` not implemented.".format(node_title)
+            )
+    elif isinstance(node, tables.Array):
+        value = _load_array_or_other_type(node)
+    else:
+        raise NotImplementedError(
+            "Loading node `{}` not implemented.".format(node_title)
+        )
+
+    return value
+
+
 def _load_sparse_matrix(tables_file, group):
 
     arrays = {}
@@ -158,6 +335,25 @@ def _load_sparse_matrix(tables_file, group):
     return sparse_matrix
 
 
+def _open_chunked_sparse_matrix(path, tables_file, group,
+                                number_of_threads=None):
+
+    group_path = group._v_pathname
+    indptr = tables_file.get_node(group, "indptr").read()
+    shape = tables_file.get_node(group, "shape").read()
+    dtype = tables_file.get_node(group, "data").dtype
+
+    def read_values(start, stop):
+        with _blosc_threads(number_of_threads):
+            with tables.open_file(path, "r") as tables_file:
+                group = tables_file.get_node(group_path)
+                data = tables_file.get_node(group, "data")[start:stop]
+                indices = tables_file.get_node(group, "indices")[start:stop]
+        return data, indices
+
+    return ChunkedSparseRowMatrix(indptr, read_values, shape, dtype)
+
+
 def _load_split_indices(tables_file, group):
 
     split_indices = {}
@@ -174,39 +370,48 @@ def _load_feature_mapping(tables_file, group):
     feature_lists = {}
 
     for array in tables_file.iter_nodes(group, "Array"):
-        feature_lists[array.title] = array.read().tolist()
+        feature_lists[array.title] = array.read()
 
-    feature_names = feature_lists["feature_names"]
-    feature_counts = feature_lists["feature_counts"]
-    feature_ids = feature_lists["feature_ids"]
+    feature_names = _decode_strings(feature_lists["feature_names"]).tolist()
+    feature_ids = _decode_strings(feature_lists["feature_ids"]).tolist()
 
-    feature_mapping = {}
+    if "feature_offsets" in feature_lists:
+        feature_offsets = feature_lists["feature_offsets"]
+    else:
+        # Feature mappings cached before offsets were saved only have
+        # the number of IDs for each feature
+        feature_offsets = numpy.concatenate(
+            [[0], numpy.cumsum(feature_lists["feature_counts"])])
 
-    for feature_name, feature_count in zip(feature_names, feature_counts):
-        feature_name = feature_name.decode("UTF-8")
-        feature_id_set = [
-            feature_ids.pop(0).decode("UTF-8") for i in range(feature_count)
-        ]
-        feature_mapping[feature_name] = feature_id_set
+    feature_offsets = feature_offsets.tolist()
+
+    feature_mapping = {
+        feature_name: feature_ids[start:stop]
+        for feature_name, start, stop in zip(
+            feature_names, feature_offsets[:-1], feature_offsets[1:])
+    }
 
     return feature_mapping
 
 
-def _save_array(array, title, group, tables_file):
+def _save_array(array, title, group, tables_file, chunk_length=None):
     name = normalise_string(title)
     if isinstance(array, list):
         array = numpy.array(array)
         name += "_was_list"
     if array.dtype.char == "U":
-        encode = numpy.vectorize(lambda s: s.encode("UTF-8"))
-        array = encode(array).astype("S")
+        array = _encode_strings(array)
+    chunk_shape = None
+    if chunk_length and array.ndim == 1 and array.size > 0:
+        chunk_shape = (min(chunk_length, array.size),)
     atom = tables.Atom.from_dtype(array.dtype)
     data_store = tables_file.create_carray(
         group,
         name,
         atom,
         array.shape,
-        title
+        title,
+        chunkshape=chunk_shape
     )
     data_store[:] = array
 
@@ -221,9 +426,26 @@ def _save_sparse_matrix(sparse_matrix, title, group, tables_file):
     name = normalise_string(title)
     group = tables_file.create_group(group, name, title)
 
-    for attribute in ("data", "indices", "indptr", "shape"):
+    # Chunk arrays in blocks of whole rows of about the same size in
+    # bytes, so that compression and decompression of each chunk can
+    # be distributed across threads and row slices read few chunks
+    n_rows = sparse_matrix.shape[0]
+    mean_row_length = max(sparse_matrix.nnz / max(n_rows, 1), 1)
+    rows_per_chunk = max(int(
+        HDF5_CHUNK_SIZE_IN_BYTES
+        / (mean_row_length * sparse_matrix.data.itemsize)
+    ), 1)
+    chunk_lengths = {
+        "data": int(numpy.ceil(rows_per_chunk * mean_row_length)),
+        "indices": int(numpy.ceil(rows_per_chunk * mean_row_length)),
+        "indptr": rows_per_chunk + 1,
+        "shape": None
+    }
+
+    for attribute, chunk_length in chunk_lengths.items():
         array = numpy.array(getattr(sparse_matrix, attribute))
-        _save_array(array, attribute, group, tables_file)
+        _save_array(
+            array, attribute, group, tables_file, chunk_length=chunk_length)
 
 
 def _save_split_indices(split_indices, title, group, tables_file):
@@ -242,21 +464,248 @@ def _save_feature_mapping(feature_mapping, title, group, tables_file):
     name = normalise_string(title)
     group = tables_file.create_group(group, name, title)
 
-    feature_names = []
-    feature_counts = []
-    feature_ids = []
-
-    for feature_name, feature_id_set in feature_mapping.items():
-        feature_names.append(feature_name)
-        feature_counts.append(len(feature_id_set))
-        feature_ids.extend(feature_id_set)
+    # Feature IDs are saved as one flat array with offsets to where the
+    # IDs of each feature start, so they can be sliced when loading
+    feature_names = list(feature_mapping.keys())
+    feature_offsets = numpy.zeros(len(feature_names) + 1, dtype=numpy.int64)
+    numpy.cumsum(
+        [len(feature_id_set) for feature_id_set in feature_mapping.values()],
+        out=feature_offsets[1:]
+    )
+    feature_ids = [
+        feature_id
+        for feature_id_set in feature_mapping.values()
+        for feature_id in feature_id_set
+    ]
 
     feature_lists = {
         "feature_names": feature_names,
-        "feature_counts": feature_counts,
+        "feature_offsets": feature_offsets,
         "feature_ids": feature_ids
     }
 
     for feature_list_name, feature_list in feature_lists.items():
         feature_list_array = numpy.array(feature_list)
         _save_array(feature_list_array, feature_list_name, group, tables_file)
+
+
+def _encode_strings(array):
+    # Casting is much faster than encoding, but only handles ASCII
+    try:
+        return array.astype("S")
+    except UnicodeEncodeError:
+        return numpy.char.encode(array, "UTF-8")
+
+
+def _decode_strings(array):
+    try:
+        return array.astype("U")
+    except UnicodeDecodeError:
+        return numpy.char.decode(array, "UTF-8")
+
+
+@contextmanager
+def _blosc_threads(number_of_threads=None):
+    if number_of_threads is None:
+        number_of_threads = os.cpu_count() or 1
+    previous_number_of_threads = tables.set_blosc_max_threads(
+        number_of_threads)
+    try:
+        yield
+    finally:
+        tables.set_blosc_max_threads(previous_number_of_threads)
+
+
+def _load_memory_mapped_data_dictionary(directory):
+
+    manifest_path = os.path.join(directory, MEMORY_MAP_MANIFEST_FILENAME)
+
+    with open(manifest_path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    data_dictionary = {}
+
+    for title, entry in manifest.items():
+        data_dictionary[title] = _load_memory_mapped_entry(
+            title, entry, directory)
+
+    return data_dictionary
+
+
+def _load_memory_mapped_entry(title, entry, directory):
+
+    kind = entry["kind"]
+    entry_path = os.path.join(directory, entry.get("name", ""))
+
+    if kind == "group":
+        value = _load_memory_mapped_data_dictionary(entry_path)
+    elif kind == "sparse matrix":
+        value = _load_memory_mapped_sparse_matrix(
+            entry_path, shape=entry["shape"])
+    elif kind in ["array", "list"]:
+        value = _load_memory_mapped_array(entry_path)
+        if kind == "list":
+            value = value.tolist()
+    elif kind == "split indices":
+        value = {
+            subset_name: slice(start, stop)
+            for subset_name, (start, stop) in entry["slices"].items()
+        }
+    elif kind == "feature mapping":
+        value = entry["mapping"]
+    elif kind == "none":
+        value = None
+    else:
+        raise NotImplementedError(
+            "Loading entry `{}` of kind `{}` not implemented.".format(
+                title, kind)
+        )
+
+    return value
+
+
+def _save_memory_mapped_data_dictionary(data_dictionary, path):
+
+    # Save to a partial directory first, so that an interrupted save
+    # does not leave behind an incomplete cache
+    partial_path = path + MEMORY_MAP_PARTIAL_SUFFIX
+
+    if os.path.exists(partial_path):
+        shutil.rmtree(partial_path)
+
+    def save(data_dictionary, directory):
+
+        os.makedirs(directory)
+        manifest = {}
+
+        for title, value in data_dictionary.items():
+
+            name = normalise_string(title)
+            entry_path = os.path.join(directory, name)
+
+            if isinstance(value, scipy.sparse.csr_matrix):
+                _save_memory_mapped_sparse_matrix(value, entry_path)
+                entry = {
+                    "kind": "sparse matrix",
+                    "name": name,
+                    "shape": list(map(int, value.shape))
+                }
+            elif isinstance(value, (numpy.ndarray, list)):
+                kind = "list" if isinstance(value, list) else "array"
+                _save_memory_mapped_array(numpy.array(value), entry_path)
+                entry = {"kind": kind, "name": name}
+            elif title == "split indices":
+                entry = {
+                    "kind": "split indices",
+                    "slices": {
+                        subset_name: [
+                            _integer_or_none(subset_slice.start),
+                            _integer_or_none(subset_slice.stop)
+                        ]
+                        for subset_name, subset_slice in value.items()
+                    }
+                }
+            elif title == "feature mapping":
+                entry = {"kind": "feature mapping", "mapping": value}
+            elif value is None:
+                entry = {"kind": "none"}
+            elif title.endswith("set"):
+                save(value, entry_path)
+                entry = {"kind": "group", "name": name}
+            else:
+                raise NotImplementedError(
+                    "Saving type {} for title \"{}\" has not been implemented."
+                    .format(type(value), title)
+                )
+
+            manifest[title] = entry
+
+        manifest_path = os.path.join(directory, MEMORY_MAP_MANIFEST_FILENAME)
+
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    save(data_dictionary, partial_path)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    os.rename(partial_path, path)
+
+
+def _load_memory_mapped_array(path):
+    # Copy-on-write mapping: pages are read lazily from disk, and
+    # in-place modifications never reach the cache file
+    return numpy.load(path + MEMORY_MAP_ARRAY_EXTENSION, mmap_mode="c")
+
+
+def _save_memory_mapped_array(array, path):
+    if array.dtype == object:
+        array = array.astype("U")
+    numpy.save(path + MEMORY_MAP_ARRAY_EXTENSION, array, allow_pickle=False)
+
+
+def _load_memory_mapped_sparse_matrix(directory, shape):
+
+    arrays = {}
+
+    for attribute in ("data", "indices", "indptr"):
+        arrays[attribute] = _load_memory_mapped_array(
+            os.path.join(directory, attribute))
+
+    sparse_matrix = SparseRowMatrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(shape),
+        copy=False
+    )
+
+    return sparse_matrix
+
+
+def _open_memory_mapped_chunked_sparse_matrix(directory, shape):
+
+    arrays = {}
+
+    for attribute in ("data", "indices", "indptr"):
+        arrays[attribute] = _load_memory_mapped_array(
+            os.path.join(directory, attribute))
+
+    def read_values(start, stop):
+        return (
+            numpy.array(arrays["data"][start:stop]),
+            numpy.array(arrays["indices"][start:stop])
+        )
+
+    return ChunkedSparseRowMatrix(
+        numpy.array(arrays["indptr"]),
+        read_values,
+        shape=shape,
+        dtype=arrays["data"].dtype
+    )
+
+
+def _save_memory_mapped_sparse_matrix(sparse_matrix, directory):
+
+    os.makedirs(directory)
+
+    # Store indices with the index type SciPy would choose itself, so
+    # the mapped arrays can be used without conversion when loading
+    index_dtype = numpy.int64
+    if (max(sparse_matrix.shape) <= numpy.iinfo(numpy.int32).max
+            and sparse_matrix.nnz <= numpy.iinfo(numpy.int32).max):
+        index_dtype = numpy.int32
+
+    arrays = {
+        "data": sparse_matrix.data,
+        "indices": sparse_matrix.indices.astype(index_dtype, copy=False),
+        "indptr": sparse_matrix.indptr.astype(index_dtype, copy=False)
+    }
+
+    for attribute, array in arrays.items():
+        _save_memory_mapped_array(array, os.path.join(directory, attribute))
+
+
+def _integer_or_none(value):
+    if value is not None:
+        value = int(value)
+    return value
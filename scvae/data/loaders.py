@@ -16,6 +16,8 @@
 #
 # ======================================================================== #
 
+import concurrent.futures
+import csv
 import gzip
 import os
 import pickle
@@ -44,6 +46,17 @@ LIST_NAME_GUESSES = {
     ]
 }
 
+# Number of values to tokenise at a time, when loading tab-separated
+# matrices
+TAB_SEPARATED_MATRIX_BLOCK_SIZE = 2 ** 22
+
+# Number of non-zero values to parse at a time, when loading matrices in
+# Matrix Market format
+MATRIX_MARKET_BLOCK_SIZE = 2 ** 20
+
+# Number of values to read at a time, when loading Loom files
+LOOM_BLOCK_SIZE = 2 ** 22
+
 LOADERS = {}
 
 
@@ -149,63 +162,107 @@ def _load_h5_data_set(paths):
 
 
 @_register_loader("10x_combine")
-def _load_and_combine_10x_data_sets(paths):
+def _load_and_combine_10x_data_sets(paths, number_of_processes=None,
+                                    deterministic=True):
+    """Load and combine 10x data sets with samples as classes.
 
-    # Initialisation
-
-    value_sets = {}
-    example_name_sets = {}
-    feature_name_sets = {}
-    genome_names = {}
+    The data sets are loaded in parallel using a pool of processes. By
+    default, they are combined in the order of their class names, but
+    if `deterministic` is false, they are combined in the order they
+    finish loading.
+    """
 
     # Loading values from separate data sets
 
-    for class_name, path in paths["all"].items():
-        data_dictionary = _load_values_from_10x_data_set(path)
-        value_sets[class_name] = data_dictionary["values"]
-        example_name_sets[class_name] = data_dictionary["example names"]
-        feature_name_sets[class_name] = data_dictionary["feature names"]
-        genome_names[class_name] = data_dictionary["genome name"]
+    class_names = sorted(paths["all"])
+
+    if number_of_processes is None:
+        number_of_processes = os.cpu_count() or 1
+    number_of_processes = max(1, min(number_of_processes, len(class_names)))
+
+    data_dictionaries = []
+
+    if number_of_processes == 1:
+        for class_name in class_names:
+            data_dictionaries.append((
+                class_name,
+                _load_values_from_10x_data_set(paths["all"][class_name])
+            ))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=number_of_processes) as executor:
+            futures = {
+                executor.submit(
+                    _load_values_from_10x_data_set,
+                    paths["all"][class_name]
+                ): class_name
+                for class_name in class_names
+            }
+            if deterministic:
+                futures_in_order = sorted(futures, key=futures.get)
+            else:
+                futures_in_order = concurrent.futures.as_completed(futures)
+            for future in futures_in_order:
+                data_dictionaries.append((futures[future], future.result()))
 
     # Check for multiple genomes
 
-    class_name, genome_name = genome_names.popitem()
+    class_name, data_dictionary = data_dictionaries[0]
+    genome_name = data_dictionary["genome name"]
 
-    for other_class_name, other_genome_name in genome_names.items():
-        if not genome_name == other_genome_name:
+    for other_class_name, other_data_dictionary in data_dictionaries[1:]:
+        if not genome_name == other_data_dictionary["genome name"]:
             raise ValueError(
                 "The genome names for \"{}\" and \"{}\" do not match."
                 .format(class_name, other_class_name)
             )
 
-    # Infer labels
+    # Align features of data sets to the union of their features in the
+    # order they first appear
 
-    label_sets = {}
-
-    for class_name in example_name_sets:
-        label_sets[class_name] = numpy.array(
-            [class_name] * example_name_sets[class_name].shape[0]
-        )
-
-    # Combine data sets
-
-    def sort_values(d):
-        return [v for k, v in sorted(d.items())]
-
-    values = scipy.sparse.vstack(sort_values(value_sets))
-    example_names = numpy.concatenate(sort_values(example_name_sets))
-    labels = numpy.concatenate(sort_values(label_sets))
-
-    # Extract feature names and check for differences
-
-    class_name, feature_names = feature_name_sets.popitem()
-
-    for other_class_name, other_feature_names in feature_name_sets.items():
-        if not all(feature_names == other_feature_names):
-            raise ValueError(
-                "The feature names for \"{}\" and \"{}\" do not match."
-                .format(class_name, other_class_name)
+    feature_name_sets = [
+        data_dictionary["feature names"]
+        for _, data_dictionary in data_dictionaries
+    ]
+    feature_names = feature_name_sets[0]
+
+    if not all(
+            numpy.array_equal(feature_names, other_feature_names)
+            for other_feature_names in feature_name_sets[1:]):
+        feature_names = pandas.unique(
+            numpy.concatenate(feature_name_sets)).astype("U")
+
+    feature_index = pandas.Index(feature_names)
+    value_sets = []
+
+    for _, data_dictionary in data_dictionaries:
+        values = data_dictionary["values"].tocsr()
+        if not numpy.array_equal(
+                data_dictionary["feature names"], feature_names):
+            column_indices = feature_index.get_indexer(
+                data_dictionary["feature names"])
+            values = scipy.sparse.csr_matrix(
+                (values.data, column_indices[values.indices],
+                 values.indptr),
+                shape=(values.shape[0], len(feature_names))
             )
+            values.sort_indices()
+        value_sets.append(values)
+
+    # Combine data sets with labels inferred from class names
+
+    values = scipy.sparse.vstack(value_sets, format="csr")
+    example_names = numpy.concatenate([
+        data_dictionary["example names"]
+        for _, data_dictionary in data_dictionaries
+    ])
+    labels = numpy.concatenate([
+        numpy.full(
+            data_dictionary["example names"].shape[0], class_name,
+            dtype=numpy.array(class_name).dtype
+        )
+        for class_name, data_dictionary in data_dictionaries
+    ])
 
     # Return data
 
@@ -223,13 +280,12 @@ def _load_and_combine_10x_data_sets(paths):
 def _load_tcga_data_set(paths):
 
     # Values, example names, and feature names
-    print("I am fucken here   ")
     values, column_headers, row_indices = _load_tab_separated_matrix(
         paths["values"]["full"], numpy.float32)
-    print("I am fucken here again champ  ")
     values = values.T
-    values = numpy.power(2, values) - 1
-    values = numpy.round(values)
+    # Zero values remain zero, so only stored values are transformed
+    values.data = numpy.round(numpy.power(2, values.data) - 1)
+    values.eliminate_zeros()
 
     example_names = numpy.array(column_headers)
 
@@ -340,19 +396,47 @@ def _load_gtex_data_set(paths):
 
 
 @_register_loader("loom")
-def _load_loom_data_set(paths):
+def _load_loom_data_set(paths, column_attribute_filters=None,
+                        row_attribute_filters=None):
 
     values = labels = example_names = feature_names = batch_indices = None
 
-    with loompy.connect(paths["all"]["full"]) as data_file:
+    with loompy.connect(paths["all"]["full"], mode="r") as data_file:
 
-        values = data_file[:, :].T
-        n_examples, n_features = values.shape
+        n_features, n_examples = data_file.shape
+
+        example_mask = _loom_attribute_filter_mask(
+            data_file.ca, column_attribute_filters, n_examples,
+            kind="column")
+        feature_mask = _loom_attribute_filter_mask(
+            data_file.ra, row_attribute_filters,
+            n_features, kind="row")
+        feature_indices = numpy.flatnonzero(feature_mask)
+
+        # Read the matrix in batches of examples (columns), so that only
+        # one dense batch is held in memory at a time
+        batch_size = max(1, LOOM_BLOCK_SIZE // n_features)
+        value_blocks = []
+
+        for start in range(0, n_examples, batch_size):
+            stop = min(start + batch_size, n_examples)
+            batch_mask = example_mask[start:stop]
+            if not batch_mask.any():
+                continue
+            value_block = data_file[:, start:stop]
+            value_block = value_block[feature_indices][:, batch_mask]
+            value_blocks.append(scipy.sparse.csr_matrix(value_block.T))
+
+        if value_blocks:
+            values = scipy.sparse.vstack(value_blocks, format="csr")
+        else:
+            values = scipy.sparse.csr_matrix(
+                (0, feature_indices.size), dtype=data_file.layers[""].dtype)
 
         if "ClusterName" in data_file.ca:
-            labels = data_file.ca["ClusterName"].flatten()
+            labels = data_file.ca["ClusterName"].flatten()[example_mask]
         elif "ClusterID" in data_file.ca:
-            cluster_ids = data_file.ca["ClusterID"].flatten()
+            cluster_ids = data_file.ca["ClusterID"].flatten()[example_mask]
             if "CellTypes" in data_file.attrs:
                 class_names = numpy.array(data_file.attrs["CellTypes"])
                 class_name_from_class_id = numpy.vectorize(
@@ -363,21 +447,25 @@ def _load_loom_data_set(paths):
                 labels = cluster_ids
 
         if "CellID" in data_file.ca:
-            example_names = data_file.ca["CellID"].flatten().astype("U")
+            example_names = data_file.ca["CellID"].flatten().astype("U")[
+                example_mask]
         elif "Cell" in data_file.ca:
-            example_names = data_file.ca["Cell"].flatten()
+            example_names = data_file.ca["Cell"].flatten()[example_mask]
         else:
             example_names = numpy.array([
-                "Cell {}".format(j + 1) for j in range(n_examples)])
+                "Cell {}".format(j + 1)
+                for j in numpy.flatnonzero(example_mask)
+            ])
 
         if "Gene" in data_file.ra:
-            feature_names = data_file.ra["Gene"].flatten().astype("U")
+            feature_names = data_file.ra["Gene"].flatten().astype("U")[
+                feature_mask]
         else:
             feature_names = numpy.array([
-                "Gene {}".format(j + 1) for j in range(n_features)])
+                "Gene {}".format(j + 1) for j in feature_indices])
 
         if "BatchID" in data_file.ca:
-            batch_indices = data_file.ca["BatchID"].flatten()
+            batch_indices = data_file.ca["BatchID"].flatten()[example_mask]
 
     data_dictionary = {
         "values": values,
@@ -652,15 +740,23 @@ def _load_values_from_10x_data_set(path):
 
                     with tarball.extractfile(member) as data_file:
                         if filename == "matrix.mtx":
-                            values = scipy.io.mmread(data_file)
+                            values = (
+                                _load_sparse_matrix_in_matrix_market_format(
+                                    data_file, transpose=True)
+                            )
                         elif extension == ".tsv":
-                            names = numpy.array(data_file.read().splitlines())
+                            names = numpy.array(
+                                data_file.read().decode().splitlines(),
+                                dtype="U"
+                            )
                             if name == "barcodes":
                                 example_names = names
                             elif name == "genes":
                                 feature_names = names
 
-    values = values.T
+    if path.endswith(".h5"):
+        values = values.T
+
     example_names = example_names.astype("U")
     feature_names = feature_names.astype("U")
 
@@ -681,6 +777,124 @@ def _load_values_from_10x_data_set(path):
     return data_dictionary
 
 
+def _load_sparse_matrix_in_matrix_market_format(matrix_file,
+                                                transpose=False):
+
+    header = matrix_file.readline()
+    if isinstance(header, bytes):
+        header = header.decode()
+    header = header.lower().split()
+
+    if header[:3] != ["%%matrixmarket", "matrix", "coordinate"]:
+        raise NotImplementedError(
+            "Loading Matrix Market files other than coordinate matrices "
+            "not implemented."
+        )
+
+    field, symmetry = header[3:5]
+
+    if symmetry != "general":
+        raise NotImplementedError(
+            "Loading {} Matrix Market matrices not implemented.".format(
+                symmetry)
+        )
+
+    if field == "integer":
+        data_type = numpy.int64
+    elif field in ["real", "double"]:
+        data_type = numpy.float64
+    elif field == "pattern":
+        data_type = None
+    else:
+        raise NotImplementedError(
+            "Loading Matrix Market matrices with {} values not implemented."
+            .format(field)
+        )
+
+    size_line = matrix_file.readline()
+    while size_line.lstrip().startswith(
+            b"%" if isinstance(size_line, bytes) else "%"):
+        size_line = matrix_file.readline()
+    n_rows, n_columns, n_values = map(int, size_line.split())
+
+    if transpose:
+        n_rows, n_columns = n_columns, n_rows
+        row_column, column_column = 1, 0
+    else:
+        row_column, column_column = 0, 1
+
+    if max(n_rows, n_columns, n_values) < numpy.iinfo(numpy.int32).max:
+        index_type = numpy.int32
+    else:
+        index_type = numpy.int64
+
+    # Triplets are written directly into the arrays of the sparse
+    # matrix, which is correct without reordering, when they are sorted
+    # by row as is the case for matrices from Cell Ranger
+    rows = numpy.empty(n_values, dtype=index_type)
+    indices = numpy.empty(n_values, dtype=index_type)
+    if data_type:
+        data = numpy.empty(n_values, dtype=data_type)
+    else:
+        data = numpy.ones(n_values, dtype=numpy.float64)
+
+    column_data_types = {0: index_type, 1: index_type}
+    if data_type:
+        column_data_types[2] = data_type
+
+    offset = 0
+
+    if n_values > 0:
+        blocks = pandas.read_csv(
+            matrix_file,
+            sep=r"\s+",
+            header=None,
+            usecols=list(column_data_types),
+            dtype=column_data_types,
+            comment="%",
+            na_filter=False,
+            chunksize=MATRIX_MARKET_BLOCK_SIZE
+        )
+        for block in blocks:
+            block_size = block.shape[0]
+            if offset + block_size > n_values:
+                raise ValueError(
+                    "Matrix Market file has more values than the {} "
+                    "declared.".format(n_values)
+                )
+            block_slice = slice(offset, offset + block_size)
+            # Matrix Market indices are one-based
+            rows[block_slice] = block[row_column].to_numpy() - 1
+            indices[block_slice] = block[column_column].to_numpy() - 1
+            if data_type:
+                data[block_slice] = block[2].to_numpy()
+            offset += block_size
+
+    if offset != n_values:
+        raise ValueError(
+            "Matrix Market file has {} values, but {} were declared."
+            .format(offset, n_values)
+        )
+
+    if numpy.any(rows[1:] < rows[:-1]):
+        order = numpy.argsort(rows, kind="stable")
+        rows = rows[order]
+        indices = indices[order]
+        data = data[order]
+
+    indptr = numpy.zeros(n_rows + 1, dtype=index_type)
+    numpy.cumsum(
+        numpy.bincount(rows, minlength=n_rows), out=indptr[1:])
+
+    values = scipy.sparse.csr_matrix(
+        (data, indices, indptr),
+        shape=(n_rows, n_columns),
+        copy=False
+    )
+
+    return values
+
+
 def _load_sparse_matrix_in_hdf5_format(path, example_names_key=None,
                                        feature_names_key=None):
 
@@ -761,7 +975,7 @@ def _load_sparse_matrix_in_hdf5_format(path, example_names_key=None,
 def _load_tab_separated_matrix(tsv_path, data_type=None):
 
     tsv_extension = tsv_path.split(os.extsep, 1)[-1]
-    print(" lets dooo it "+tsv_extension)
+
     if tsv_extension == "tsv":
         open_file = open
     elif tsv_extension.endswith("gz"):
@@ -772,8 +986,11 @@ def _load_tab_separated_matrix(tsv_path, data_type=None):
                 tsv_extension)
         )
 
-    values = []
-    row_indices = []
+    if data_type is None:
+        data_type = numpy.float64
+
+    value_blocks = []
+    row_index_blocks = []
     column_headers = None
 
     with open_file(tsv_path, mode="rt") as tsv_file:
@@ -781,7 +998,7 @@ def _load_tab_separated_matrix(tsv_path, data_type=None):
         while not column_headers:
 
             row_elements = next(tsv_file).split()
-            print("row number "+ str(len(row_elements)))
+
             # Skip, if row could not be split into elements
             if len(row_elements) <= 1:
                 continue
@@ -796,7 +1013,7 @@ def _load_tab_separated_matrix(tsv_path, data_type=None):
                 break
 
             column_headers = row_elements
-        print("mama 5alast ta3aly shatafiny ")
+
         if column_headers:
             row_elements = next(tsv_file).split()
 
@@ -810,29 +1027,56 @@ def _load_tab_separated_matrix(tsv_path, data_type=None):
                 len(row_elements) - len(column_headers)
             )
             column_headers = column_headers[column_header_offset:]
-            print(len(column_headers))
-
-
-        def parse_row_elements(row_elements):
-            row_index = row_elements[:column_offset]
-            if row_index:
-                row_indices.append(row_index)
-            row_values = list(map(float, row_elements[column_offset:]))
-            values.append(row_values)
-
-        parse_row_elements(row_elements)
-        print("lets loop")
-        lim = 0
-        for row in tsv_file:
-            parse_row_elements(row.split())
-            lim += 1
-            if lim > 5000:
-                break
-        print("wasalt")
 
-    values = numpy.array(values, data_type)
+        number_of_columns = len(row_elements)
+
+        def add_block(row_indices, values):
+            if column_offset:
+                row_index_blocks.append(row_indices)
+            value_blocks.append(scipy.sparse.csr_matrix(values))
+
+        add_block(
+            numpy.array([row_elements[:column_offset]], dtype="U"),
+            numpy.array([row_elements[column_offset:]], dtype=data_type)
+        )
+
+        # Tokenise remaining rows in blocks of roughly fixed size, so
+        # that only one dense block is held in memory at a time
+        block_size = max(
+            1, TAB_SEPARATED_MATRIX_BLOCK_SIZE // number_of_columns)
+        column_data_types = {
+            j: (str if j < column_offset else data_type)
+            for j in range(number_of_columns)
+        }
+
+        try:
+            blocks = pandas.read_csv(
+                tsv_file,
+                sep=r"\s+",
+                header=None,
+                dtype=column_data_types,
+                quoting=csv.QUOTE_NONE,
+                na_filter=False,
+                chunksize=block_size
+            )
+            for block in blocks:
+                if block.shape[1] != number_of_columns:
+                    raise ValueError(
+                        "Rows in `{}` do not all have {} columns.".format(
+                            tsv_path, number_of_columns)
+                    )
+                add_block(
+                    block.iloc[:, :column_offset].to_numpy(dtype="U"),
+                    block.iloc[:, column_offset:].to_numpy(dtype=data_type)
+                )
+        except pandas.errors.EmptyDataError:
+            pass
 
-    if not row_indices:
+    values = scipy.sparse.vstack(value_blocks, format="csr")
+
+    if row_index_blocks:
+        row_indices = numpy.concatenate(row_index_blocks)
+    else:
         row_indices = None
 
     return values, column_headers, row_indices
@@ -886,10 +1130,17 @@ def _load_labels_from_delimiter_separeted_values(
 
     if example_names is not None:
 
-        labels = numpy.zeros(example_names.shape, unordered_labels.dtype)
+        # Join labels to examples by name using the index of the labels,
+        # letting later rows take precedence for repeated names
+        unordered_labels = unordered_labels[
+            ~unordered_labels.index.duplicated(keep="last")]
+        label_indices = unordered_labels.index.get_indexer(example_names)
+        examples_with_labels = label_indices >= 0
+        label_values = unordered_labels.to_numpy()
 
-        for example_name, label in unordered_labels.items():
-            labels[example_names == example_name] = label
+        labels = numpy.zeros(example_names.shape, label_values.dtype)
+        labels[examples_with_labels] = label_values[
+            label_indices[examples_with_labels]]
 
         if default_label:
             labels[labels == 0] = default_label
@@ -989,6 +1240,27 @@ def _create_development_data_set(
     return data_dictionary
 
 
+def _loom_attribute_filter_mask(attributes, attribute_filters, size, kind):
+
+    mask = numpy.ones(size, dtype=bool)
+
+    if not attribute_filters:
+        return mask
+
+    for attribute_name, included_values in attribute_filters.items():
+        if attribute_name not in attributes:
+            raise ValueError(
+                "{} attribute `{}` not found.".format(
+                    kind.capitalize(), attribute_name)
+            )
+        if not isinstance(included_values, list):
+            included_values = [included_values]
+        attribute_values = attributes[attribute_name].flatten()
+        mask &= numpy.isin(attribute_values, included_values)
+
+    return mask
+
+
 def _is_float(value):
     try:
         float(value)
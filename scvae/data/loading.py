@@ -49,16 +49,18 @@ def acquire_data_set(title, urls, directory):
                 paths[values_or_labels][kind] = None
                 continue
 
-            url_filename = os.path.split(url)[-1]
-            file_extension = extension(url_filename)
-
-            filename = "-".join(
-                map(normalise_string, [title, values_or_labels, kind]))
-            path = os.path.join(directory, filename) + file_extension
+            path = _acquired_path(
+                title, values_or_labels, kind, url, directory)
 
             paths[values_or_labels][kind] = path
 
-            if not os.path.isfile(path):
+            # Copy local source files again if they have changed
+            copy_is_outdated = (
+                os.path.isfile(path) and os.path.isfile(url)
+                and os.path.getmtime(url) > os.path.getmtime(path)
+            )
+
+            if not os.path.isfile(path) or copy_is_outdated:
 
                 if url.startswith("."):
                     raise Exception(
@@ -94,7 +96,31 @@ def acquire_data_set(title, urls, directory):
     return paths
 
 
-def load_original_data_set(paths, data_format):
+def acquired_data_set_paths(title, urls, directory):
+    """Paths of the source files of a data set once they are acquired.
+
+    The paths are the ones returned by `acquire_data_set`, but no files
+    are acquired.
+    """
+
+    paths = {}
+
+    if not urls:
+        return paths
+
+    for values_or_labels, kind_urls in urls.items():
+        paths[values_or_labels] = {}
+        for kind, url in kind_urls.items():
+            if url:
+                paths[values_or_labels][kind] = _acquired_path(
+                    title, values_or_labels, kind, url, directory)
+            else:
+                paths[values_or_labels][kind] = None
+
+    return paths
+
+
+def load_original_data_set(paths, data_format, **loader_options):
 
     print("Loading original data set.")
     loading_time_start = time()
@@ -109,8 +135,7 @@ def load_original_data_set(paths, data_format):
     if load is None:
         raise ValueError("Data format `{}` not recognised.".format(
             data_format))
-    print("loading Dataaaaaaaaa")
-    data_dictionary = load(paths=paths)
+    data_dictionary = load(paths=paths, **loader_options)
 
     loading_duration = time() - loading_time_start
     print("Original data set loaded ({}).".format(format_duration(
@@ -131,3 +156,14 @@ def load_original_data_set(paths, data_format):
             sparse_duration)))
 
     return data_dictionary
+
+
+def _acquired_path(title, values_or_labels, kind, url, directory):
+
+    url_filename = os.path.split(url)[-1]
+    file_extension = extension(url_filename)
+
+    filename = "-".join(
+        map(normalise_string, [title, values_or_labels, kind]))
+
+    return os.path.join(directory, filename) + file_extension
@@ -20,22 +20,37 @@ from functools import reduce
 from time import time
 
 import numpy
-import scipy
+import scipy.sparse
 import sklearn.preprocessing
 
-from scvae.data.sparse import SparseRowMatrix
+from scvae.data.sparse import (
+    SparseRowMatrix, column_statistics, compact_dtypes, select_rows)
+from scvae.data.utilities import LabelIndex
 from scvae.defaults import defaults
-from scvae.utilities import normalise_string, format_duration
+from scvae.utilities import (
+    normalise_string, format_duration, map_in_threads
+)
+
+# Number of bins of mean values, within which dispersions are normalised,
+# when selecting highly variable features
+NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS = 20
+
+# Preprocessing methods sampling values randomly, which are therefore
+# applied anew to every minibatch when preprocessing noisily
+STOCHASTIC_PREPROCESSING_METHODS = ["bernoulli_sample"]
+
+# Number of stored values of sparse matrices to preprocess at a time
+PREPROCESSING_BLOCK_SIZE = 2 ** 16
 
 PREPROCESSERS = {}
+IN_PLACE_PREPROCESSERS = {}
 
 
-def map_features(values, feature_ids, feature_mapping):
+def map_features(values, feature_ids, feature_mapping, compact=False):
 
-    values = scipy.sparse.csc_matrix(values)
+    values = scipy.sparse.csr_matrix(values)
 
-    n_examples, n_ids = values.shape
-    n_features = len(feature_mapping)
+    n_ids = values.shape[1]
 
     feature_name_from_id = {
         v: k for k, vs in feature_mapping.items() for v in vs
@@ -54,9 +69,10 @@ def map_features(values, feature_ids, feature_mapping):
             .format(n_unknown_ids, "s" if n_unknown_ids > 1 else "")
         )
 
-    n_features += n_unknown_ids
-
-    aggregated_values = numpy.zeros((n_examples, n_features), values.dtype)
+    # Each original feature ID is aggregated into the column of its new
+    # feature, so the mapped values are the product of the values and a
+    # sparse aggregation matrix with a one for each ID
+    feature_indices = numpy.empty(n_ids, dtype=numpy.int64)
     feature_names_with_index = dict()
 
     for i, feature_id in enumerate(feature_ids):
@@ -69,14 +85,29 @@ def map_features(values, feature_ids, feature_mapping):
             index = len(feature_names_with_index)
             feature_names_with_index[feature_name] = index
 
-        aggregated_values[:, index] += values[:, i].A.flatten()
+        feature_indices[i] = index
+
+    # Sums of counts stored in narrow integer types can overflow these,
+    # so they are aggregated in a wide type
+    aggregation_dtype = values.dtype
+    if numpy.issubdtype(aggregation_dtype, numpy.integer):
+        aggregation_dtype = numpy.promote_types(
+            aggregation_dtype, numpy.int64)
+
+    aggregation_matrix = scipy.sparse.csr_matrix(
+        (
+            numpy.ones(n_ids, dtype=aggregation_dtype),
+            (numpy.arange(n_ids), feature_indices)
+        ),
+        shape=(n_ids, len(feature_names_with_index))
+    )
+
+    aggregated_values = values @ aggregation_matrix
 
     feature_names = list(feature_names_with_index.keys())
 
     feature_names_not_found = set(feature_mapping.keys()) - set(feature_names)
     n_feature_names_not_found = len(feature_names_not_found)
-    n_features -= n_feature_names_not_found
-    aggregated_values = aggregated_values[:, :n_features]
 
     if n_feature_names_not_found > 0:
         print(
@@ -87,13 +118,22 @@ def map_features(values, feature_ids, feature_mapping):
         )
 
     aggregated_values = SparseRowMatrix(aggregated_values)
+
+    # Aggregated counts are stored in the most compact types if asked to,
+    # and otherwise in the original type, if they still fit in it
+    if compact:
+        aggregated_values = compact_dtypes(aggregated_values)
+    elif aggregation_dtype != values.dtype:
+        if aggregated_values.max() <= numpy.iinfo(values.dtype).max:
+            aggregated_values = aggregated_values.astype(values.dtype)
+
     feature_names = numpy.array(feature_names)
 
     return aggregated_values, feature_names
 
 
 def select_features(values_dictionary, feature_names, method=None,
-                    parameters=None):
+                    parameters=None, number_of_threads=None):
 
     method = normalise_string(method)
 
@@ -105,16 +145,14 @@ def select_features(values_dictionary, feature_names, method=None,
 
     n_examples, n_features = values.shape
 
+    statistics = column_statistics(
+        values, number_of_threads=number_of_threads)
+
     if method == "remove_zeros":
-        total_feature_sum = values.sum(axis=0)
-        if isinstance(total_feature_sum, numpy.matrix):
-            total_feature_sum = total_feature_sum.A.squeeze()
-        indices = total_feature_sum != 0
+        indices = statistics.sums != 0
 
     elif method == "keep_variances_above":
-        variances = values.var(axis=0)
-        if isinstance(variances, numpy.matrix):
-            variances = variances.A.squeeze()
+        variances = statistics.variances()
         if parameters:
             threshold = float(parameters[0])
         else:
@@ -122,9 +160,7 @@ def select_features(values_dictionary, feature_names, method=None,
         indices = variances > threshold
 
     elif method == "keep_highest_variances":
-        variances = values.var(axis=0)
-        if isinstance(variances, numpy.matrix):
-            variances = variances.A.squeeze()
+        variances = statistics.variances()
         variance_sorted_indices = numpy.argsort(variances)
         if parameters:
             number_to_keep = int(parameters[0])
@@ -132,6 +168,23 @@ def select_features(values_dictionary, feature_names, method=None,
             number_to_keep = int(n_examples/2)
         indices = numpy.sort(variance_sorted_indices[-number_to_keep:])
 
+    elif method == "keep_dispersions_above":
+        dispersions = _normalised_dispersions(statistics)
+        if parameters:
+            threshold = float(parameters[0])
+        else:
+            threshold = 0.5
+        indices = dispersions > threshold
+
+    elif method == "keep_highest_dispersions":
+        dispersions = _normalised_dispersions(statistics)
+        dispersion_sorted_indices = numpy.argsort(dispersions)
+        if parameters:
+            number_to_keep = int(parameters[0])
+        else:
+            number_to_keep = int(n_examples/2)
+        indices = numpy.sort(dispersion_sorted_indices[-number_to_keep:])
+
     else:
         raise ValueError(
             "Feature selection `{}` not found.".format(method))
@@ -166,11 +219,75 @@ def select_features(values_dictionary, feature_names, method=None,
     return feature_selected_values, feature_selected_feature_names
 
 
+def _normalised_dispersions(statistics):
+    """Normalise dispersions of features with similar means.
+
+    Log-dispersions are standardised within bins of the log-means of the
+    features, so that the selection of highly variable features does not
+    favour highly expressed ones. Features without values have
+    dispersions of minus infinity, and features alone in their bin have
+    normalised dispersions of one.
+    """
+
+    means = statistics.means
+    dispersions = statistics.dispersions()
+
+    expressed = means > 0
+    log_means = numpy.log(means[expressed])
+    log_dispersions = numpy.log(
+        numpy.maximum(dispersions[expressed], numpy.finfo(float).tiny))
+
+    bin_edges = numpy.linspace(
+        log_means.min(), log_means.max(),
+        NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS + 1
+    )
+    bin_indices = numpy.clip(
+        numpy.digitize(log_means, bin_edges[1:-1]),
+        0, NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS - 1
+    )
+
+    bin_counts = numpy.bincount(
+        bin_indices, minlength=NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS)
+    bin_sums = numpy.bincount(
+        bin_indices, weights=log_dispersions,
+        minlength=NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS
+    )
+    bin_squared_sums = numpy.bincount(
+        bin_indices, weights=numpy.square(log_dispersions),
+        minlength=NUMBER_OF_MEAN_BINS_FOR_DISPERSIONS
+    )
+
+    bin_means = bin_sums / numpy.maximum(bin_counts, 1)
+    bin_standard_deviations = numpy.sqrt(numpy.maximum(
+        (bin_squared_sums - bin_counts * numpy.square(bin_means))
+        / numpy.maximum(bin_counts - 1, 1),
+        0
+    ))
+
+    feature_bin_means = bin_means[bin_indices]
+    feature_bin_standard_deviations = bin_standard_deviations[bin_indices]
+
+    normalised_log_dispersions = numpy.zeros_like(log_dispersions)
+    numpy.divide(
+        log_dispersions - feature_bin_means,
+        feature_bin_standard_deviations,
+        out=normalised_log_dispersions,
+        where=feature_bin_standard_deviations > 0
+    )
+    normalised_log_dispersions[bin_counts[bin_indices] == 1] = 1
+
+    normalised_dispersions = numpy.full_like(means, -numpy.inf)
+    normalised_dispersions[expressed] = normalised_log_dispersions
+
+    return normalised_dispersions
+
+
 def filter_examples(values_dictionary, example_names,
                     method=None, parameters=None,
                     labels=None, excluded_classes=None,
                     superset_labels=None, excluded_superset_classes=None,
-                    batch_indices=None, count_sum=None):
+                    batch_indices=None, count_sum=None,
+                    label_index=None, superset_label_index=None):
 
     print("Filtering examples.")
     start_time = time()
@@ -178,15 +295,17 @@ def filter_examples(values_dictionary, example_names,
     method = normalise_string(method)
 
     if superset_labels is not None:
-        filter_labels = superset_labels.copy()
+        filter_label_index = superset_label_index
+        if filter_label_index is None:
+            filter_label_index = LabelIndex(superset_labels)
         filter_excluded_classes = excluded_superset_classes
     elif labels is not None:
-        filter_labels = labels.copy()
+        filter_label_index = label_index
+        if filter_label_index is None:
+            filter_label_index = LabelIndex(labels)
         filter_excluded_classes = excluded_classes
     else:
-        filter_labels = None
-
-    filter_class_names = numpy.unique(filter_labels)
+        filter_label_index = None
 
     if type(values_dictionary) == dict:
         values = values_dictionary["original"]
@@ -211,7 +330,7 @@ def filter_examples(values_dictionary, example_names,
 
     elif method in ["keep", "remove", "excluded_classes"]:
 
-        if filter_labels is None:
+        if filter_label_index is None:
             raise ValueError(
                 "Cannot filter examples based on labels, "
                 "since data set is unlabelled."
@@ -221,33 +340,22 @@ def filter_examples(values_dictionary, example_names,
             method = "remove"
             parameters = filter_excluded_classes
 
-        if method == "keep":
-            label_indices = set()
-
-            for parameter in parameters:
-                for class_name in filter_class_names:
-
-                    normalised_class_name = normalise_string(str(class_name))
-                    normalised_parameter = normalise_string(str(parameter))
+        normalised_parameters = {
+            normalise_string(str(parameter)) for parameter in parameters}
+        filter_class_ids = [
+            class_id
+            for class_id, class_name in enumerate(
+                filter_label_index.class_names)
+            if normalise_string(str(class_name)) in normalised_parameters
+        ]
 
-                    if normalised_class_name == normalised_parameter:
-                        class_indices = filter_labels == class_name
-                        label_indices.update(filter_indices[class_indices])
-
-            filter_indices = filter_indices[list(label_indices)]
+        if method == "keep":
+            filter_indices = filter_label_index.indices_for_classes(
+                filter_class_ids)
 
         elif method == "remove":
-
-            for parameter in parameters:
-                for class_name in filter_class_names:
-
-                    normalised_class_name = normalise_string(str(class_name))
-                    normalised_parameter = normalise_string(str(parameter))
-
-                    if normalised_class_name == normalised_parameter:
-                        label_indices = filter_labels != class_name
-                        filter_labels = filter_labels[label_indices]
-                        filter_indices = filter_indices[label_indices]
+            filter_indices = filter_indices[
+                filter_label_index.mask_excluding_classes(filter_class_ids)]
 
     elif method == "remove_count_sum_above":
         threshold = int(parameters[0])
@@ -302,14 +410,28 @@ def filter_examples(values_dictionary, example_names,
             example_filtered_labels, example_filtered_batch_indices)
 
 
-def build_preprocessor(preprocessing_methods, noisy=False):
+def build_preprocessor(preprocessing_methods, noisy=False,
+                       number_of_threads=None):
+    """Build function applying preprocessing methods in turn.
+
+    Sparse row matrices are preprocessed by applying the methods
+    directly to their stored values in blocks, in parallel threads, by
+    default as many as there are processors, with consecutive
+    element-wise methods applied together to each block. The values are
+    copied once beforehand as floating-point numbers, so the original
+    values are never changed. Other values are preprocessed by each
+    method in turn.
+    """
 
     preprocessers = []
 
-    for preprocessing_method in preprocessing_methods:
+    if noisy:
+        preprocessing_methods = [
+            "bernoulli_sample" if method == "binarise" else method
+            for method in preprocessing_methods
+        ]
 
-        if noisy and preprocessing_method == "binarise":
-            preprocessing_method = "bernoulli_sample"
+    for preprocessing_method in preprocessing_methods:
 
         preprocesser = PREPROCESSERS.get(preprocessing_method)
 
@@ -323,7 +445,21 @@ def build_preprocessor(preprocessing_methods, noisy=False):
     if not preprocessing_methods:
         preprocessers.append(lambda x: x)
 
+    can_preprocess_in_place = all(
+        method in IN_PLACE_PREPROCESSERS for method in preprocessing_methods)
+
     def preprocess(values):
+
+        if (preprocessing_methods and can_preprocess_in_place
+                and scipy.sparse.issparse(values) and values.format == "csr"):
+
+            values = _copy_as_floating_point(values)
+
+            _preprocess_in_place(
+                values, preprocessing_methods, number_of_threads)
+
+            return values
+
         return reduce(
             lambda v, p: p(v),
             preprocessers,
@@ -333,25 +469,100 @@ def build_preprocessor(preprocessing_methods, noisy=False):
     return preprocess
 
 
+def build_noisy_preprocessors(preprocessing_methods, number_of_threads=None):
+    """Build preprocessors for noisy preprocessing.
+
+    Noisy preprocessing is split at the first stochastic preprocessing
+    method into a deterministic preprocessor, which only has to be
+    applied once to all values, and a stochastic one, which is applied
+    to each minibatch of these. The deterministic preprocessor is `None`
+    if there are no deterministic methods before the stochastic ones.
+    """
+
+    preprocessing_methods = [
+        "bernoulli_sample" if method == "binarise" else method
+        for method in preprocessing_methods
+    ]
+
+    stochastic_start = len(preprocessing_methods)
+    for i, method in enumerate(preprocessing_methods):
+        if method in STOCHASTIC_PREPROCESSING_METHODS:
+            stochastic_start = i
+            break
+
+    deterministic_methods = preprocessing_methods[:stochastic_start]
+    stochastic_methods = preprocessing_methods[stochastic_start:]
+
+    if deterministic_methods:
+        deterministic_preprocess = build_preprocessor(
+            deterministic_methods, number_of_threads=number_of_threads)
+    else:
+        deterministic_preprocess = None
+
+    # Minibatches can be views of the values, so they are not
+    # preprocessed in place
+    stochastic_preprocess = build_preprocessor(
+        stochastic_methods, number_of_threads=number_of_threads)
+
+    return deterministic_preprocess, stochastic_preprocess
+
+
 def split_data_set(data_dictionary, method=None, fraction=None):
 
+    print("Splitting data set.")
+    start_time = time()
+
+    subset_indices = split_data_set_indices(
+        number_of_examples=data_dictionary["values"].shape[0],
+        method=method,
+        fraction=fraction,
+        split_indices=data_dictionary.get("split indices"),
+        values=data_dictionary["values"]
+    )
+
+    split_data_dictionary = {
+        "feature names": data_dictionary["feature names"],
+        "class names": data_dictionary["class names"]
+    }
+
+    for subset_kind, indices in subset_indices.items():
+        subset_dictionary = {}
+        for key in [
+                "values", "preprocessed values", "binarised values",
+                "labels", "example names", "batch indices"]:
+            subset_dictionary[key] = select_rows(
+                data_dictionary.get(key), indices)
+        split_data_dictionary["{} set".format(subset_kind)] = (
+            subset_dictionary)
+
+    duration = time() - start_time
+    print("Data set split ({}).".format(format_duration(duration)))
+
+    return split_data_dictionary
+
+
+def split_data_set_indices(number_of_examples, method=None, fraction=None,
+                           split_indices=None, values=None):
+    """Find indices of examples in training, validation, and test sets.
+
+    Contiguous ranges of examples are returned as slices and other
+    examples as arrays of indices.
+    """
+
     if method is None:
         method = defaults["data"]["splitting_method"]
     if fraction is None:
         fraction = defaults["data"]["splitting_fraction"]
 
-    print("Splitting data set.")
-    start_time = time()
-
     if method == "default":
-        if "split indices" in data_dictionary:
+        if split_indices is not None:
             method = "indices"
         else:
             method = "random"
 
     method = normalise_string(method)
 
-    n = data_dictionary["values"].shape[0]
+    n = number_of_examples
 
     random_state = numpy.random.RandomState(42)
 
@@ -362,17 +573,16 @@ def split_data_set(data_dictionary, method=None, fraction=None):
 
         if method == "random":
             indices = random_state.permutation(n)
+            training_indices = indices[:n_training]
+            validation_indices = indices[n_training:n_training_validation]
+            test_indices = indices[n_training_validation:]
         else:
-            indices = numpy.arange(n)
-
-        training_indices = indices[:n_training]
-        validation_indices = indices[n_training:n_training_validation]
-        test_indices = indices[n_training_validation:]
+            training_indices = slice(0, n_training)
+            validation_indices = slice(n_training, n_training_validation)
+            test_indices = slice(n_training_validation, n)
 
     elif method == "indices":
 
-        split_indices = data_dictionary["split indices"]
-
         training_indices = split_indices["training"]
         test_indices = split_indices["test"]
 
@@ -390,10 +600,9 @@ def split_data_set(data_dictionary, method=None, fraction=None):
 
     elif method == "macosko":
 
-        values = data_dictionary["values"]
-
         minimum_number_of_non_zero_elements = 900
-        number_of_non_zero_elements = (values != 0).sum(axis=1)
+        number_of_non_zero_elements = numpy.asarray(
+            (values != 0).sum(axis=1)).reshape(-1)
 
         training_indices = numpy.nonzero(
             number_of_non_zero_elements > minimum_number_of_non_zero_elements
@@ -414,76 +623,115 @@ def split_data_set(data_dictionary, method=None, fraction=None):
     else:
         raise ValueError("Splitting method `{}` not found.".format(method))
 
-    split_data_dictionary = {
-        "training set": {
-            "values": data_dictionary["values"][training_indices],
-            "preprocessed values": None,
-            "binarised values": None,
-            "labels": None,
-            "example names":
-                data_dictionary["example names"][training_indices],
-            "batch indices": None
-        },
-        "validation set": {
-            "values": data_dictionary["values"][validation_indices],
-            "preprocessed values": None,
-            "binarised values": None,
-            "labels": None,
-            "example names":
-                data_dictionary["example names"][validation_indices],
-            "batch indices": None
-        },
-        "test set": {
-            "values": data_dictionary["values"][test_indices],
-            "preprocessed values": None,
-            "binarised values": None,
-            "labels": None,
-            "example names": data_dictionary["example names"][test_indices],
-            "batch indices": None
-        },
-        "feature names": data_dictionary["feature names"],
-        "class names": data_dictionary["class names"]
+    return {
+        "training": training_indices,
+        "validation": validation_indices,
+        "test": test_indices
     }
 
-    if "labels" in data_dictionary and data_dictionary["labels"] is not None:
-        split_data_dictionary["training set"]["labels"] = (
-            data_dictionary["labels"][training_indices])
-        split_data_dictionary["validation set"]["labels"] = (
-            data_dictionary["labels"][validation_indices])
-        split_data_dictionary["test set"]["labels"] = (
-            data_dictionary["labels"][test_indices])
-
-    if ("preprocessed values" in data_dictionary
-            and data_dictionary["preprocessed values"] is not None):
-        split_data_dictionary["training set"]["preprocessed values"] = (
-            data_dictionary["preprocessed values"][training_indices])
-        split_data_dictionary["validation set"]["preprocessed values"] = (
-            data_dictionary["preprocessed values"][validation_indices])
-        split_data_dictionary["test set"]["preprocessed values"] = (
-            data_dictionary["preprocessed values"][test_indices])
-
-    if ("binarised values" in data_dictionary
-            and data_dictionary["binarised values"] is not None):
-        split_data_dictionary["training set"]["binarised values"] = (
-            data_dictionary["binarised values"][training_indices])
-        split_data_dictionary["validation set"]["binarised values"] = (
-            data_dictionary["binarised values"][validation_indices])
-        split_data_dictionary["test set"]["binarised values"] = (
-            data_dictionary["binarised values"][test_indices])
-
-    if ("batch indices" in data_dictionary
-            and data_dictionary["batch indices"] is not None):
-        split_data_dictionary["training set"]["batch indices"] = (
-            data_dictionary["batch indices"][training_indices])
-        split_data_dictionary["validation set"]["batch indices"] = (
-            data_dictionary["batch indices"][validation_indices])
-        split_data_dictionary["test set"]["batch indices"] = (
-            data_dictionary["batch indices"][test_indices])
 
-    duration = time() - start_time
-    print("Data set split ({}).".format(format_duration(duration)))
+def _preprocess_in_place(values, preprocessing_methods,
+                         number_of_threads=None):
 
-    return split_data_dictionary
+    element_wise_preprocessers = []
+
+    def apply_element_wise_preprocessers():
+        preprocessers = list(element_wise_preprocessers)
+        element_wise_preprocessers.clear()
+
+        def preprocess_block(start, stop):
+            data_block = values.data[start:stop]
+            for preprocesser in preprocessers:
+                preprocesser(data_block)
+
+        _apply_to_blocks(preprocess_block, values.nnz, number_of_threads)
+
+    for preprocessing_method in preprocessing_methods:
+        preprocesser, element_wise = IN_PLACE_PREPROCESSERS[
+            preprocessing_method]
+        if element_wise:
+            element_wise_preprocessers.append(preprocesser)
+        else:
+            if element_wise_preprocessers:
+                apply_element_wise_preprocessers()
+            preprocesser(values, number_of_threads)
+
+    if element_wise_preprocessers:
+        apply_element_wise_preprocessers()
+
+    values.eliminate_zeros()
+
+
+def _apply_to_blocks(function, size, number_of_threads=None):
+
+    block_bounds = [
+        (start, min(start + PREPROCESSING_BLOCK_SIZE, size))
+        for start in range(0, size, PREPROCESSING_BLOCK_SIZE)
+    ]
+
+    # Values of minibatches usually fit in one block, which is processed
+    # without starting any threads
+    if len(block_bounds) <= 1:
+        number_of_threads = 1
+
+    for _ in map_in_threads(
+            lambda bounds: function(*bounds), block_bounds,
+            number_of_threads):
+        pass
+
+
+def _copy_as_floating_point(values):
+
+    # Counts in narrow integer types are exactly representable as
+    # single-precision floating-point numbers
+    data = values.data.astype(
+        numpy.promote_types(values.dtype, numpy.float32))
+
+    return type(values)(
+        (data, values.indices.copy(), values.indptr.copy()),
+        shape=values.shape
+    )
+
+
+def _register_in_place_preprocessor(name, element_wise=True):
+    def decorator(function):
+        IN_PLACE_PREPROCESSERS[name] = (function, element_wise)
+        return function
+    return decorator
+
+
+@_register_in_place_preprocessor("log")
+def _log_in_place(data):
+    numpy.log1p(data, out=data)
+
+
+@_register_in_place_preprocessor("exp")
+def _exp_in_place(data):
+    numpy.expm1(data, out=data)
+
+
+@_register_in_place_preprocessor("binarise")
+def _binarise_in_place(data):
+    numpy.greater(data, 0.5, out=data)
+
+
+@_register_in_place_preprocessor("bernoulli_sample")
+def _bernoulli_sample_in_place(data):
+    data[:] = numpy.random.binomial(1, data)
+
+
+@_register_in_place_preprocessor("normalise", element_wise=False)
+def _normalise_in_place(values, number_of_threads=None):
+
+    column_norms = numpy.sqrt(column_statistics(
+        values, number_of_threads=number_of_threads).squared_sums)
+    column_norms[column_norms == 0] = 1
+    column_scales = (1 / column_norms).astype(values.dtype)
+
+    def normalise_block(start, stop):
+        values.data[start:stop] *= column_scales[values.indices[start:stop]]
+
+    _apply_to_blocks(normalise_block, values.nnz, number_of_threads)
 
 
 def _register_preprocessor(name):
@@ -515,4 +763,11 @@ def _binarise(values):
 
 @_register_preprocessor("bernoulli_sample")
 def _bernoulli_sample(values):
+    if scipy.sparse.issparse(values):
+        # Only non-zero values can be sampled as ones
+        sampled_values = values.copy()
+        sampled_values.data = numpy.random.binomial(
+            1, values.data).astype(values.dtype)
+        sampled_values.eliminate_zeros()
+        return sampled_values
     return numpy.random.binomial(1, values)
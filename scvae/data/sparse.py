@@ -16,9 +16,26 @@
 #
 # ======================================================================== #
 
+import collections
+import threading
+
 import numpy
 import scipy.sparse
 
+from scvae.utilities import map_in_threads
+
+DEFAULT_NUMBER_OF_ROWS_PER_CHUNK = 4096
+DEFAULT_NUMBER_OF_CACHED_CHUNKS = 32
+
+# Number of rows to compute column statistics for at a time
+COLUMN_STATISTICS_NUMBER_OF_ROWS_PER_BLOCK = 2 ** 14
+
+# Unsigned integer types for counts from narrowest to widest
+COMPACT_COUNT_DTYPES = [numpy.uint16, numpy.uint32]
+
+# Number of stored values to check for counts at a time
+COMPACT_DTYPES_BLOCK_SIZE = 2 ** 20
+
 
 class SparseRowMatrix(scipy.sparse.csr_matrix):
     def __init__(self, arg1, shape=None, dtype=None, copy=False):
@@ -50,7 +67,16 @@ class SparseRowMatrix(scipy.sparse.csr_matrix):
 
     def var(self, axis=None, ddof=0):
 
-        self_squared_mean = self.power(2).mean(axis)
+        if axis in [0, -2]:
+            return column_statistics(self).variances(ddof=ddof)
+
+        if axis is None:
+            # Squared values are summed without being stored
+            data = self.data.astype(numpy.float64, copy=False)
+            self_squared_mean = numpy.dot(data, data) / self.size
+        else:
+            self_squared_mean = self.astype(numpy.float64).power(2).mean(
+                axis)
         self_mean_squared = numpy.power(self.mean(axis), 2)
 
         var = self_squared_mean - self_mean_squared
@@ -62,28 +88,414 @@ class SparseRowMatrix(scipy.sparse.csr_matrix):
         return var
 
 
-def sparsity(a, tolerance=1e-3, batch_size=None):
+class ChunkedSparseRowMatrix:
+    """Sparse row matrix stored out of core and read in chunks of rows.
 
-    def count_nonzero_values(b):
-        return (b >= tolerance).sum()
+    Rows are read from disk a chunk at a time with `read_values`, which
+    is given the start and stop positions of the stored values of a
+    chunk and returns their values and column indices. The most recently
+    used chunks are kept in memory, and selecting rows returns them as a
+    `SparseRowMatrix`.
+    """
 
-    if scipy.sparse.issparse(a):
-        size = numpy.prod(a.shape)
-    else:
-        size = a.size
+    ndim = 2
+
+    def __init__(self, indptr, read_values, shape, dtype,
+                 number_of_rows_per_chunk=None,
+                 number_of_cached_chunks=None):
+
+        if number_of_rows_per_chunk is None:
+            number_of_rows_per_chunk = DEFAULT_NUMBER_OF_ROWS_PER_CHUNK
+        if number_of_cached_chunks is None:
+            number_of_cached_chunks = DEFAULT_NUMBER_OF_CACHED_CHUNKS
+
+        self.indptr = numpy.asarray(indptr)
+        self.shape = tuple(int(length) for length in shape)
+        self.dtype = numpy.dtype(dtype)
+        self.number_of_rows_per_chunk = number_of_rows_per_chunk
+        self.number_of_cached_chunks = number_of_cached_chunks
+
+        self._read_values = read_values
+        self._chunks = collections.OrderedDict()
+        self._chunks_lock = threading.Lock()
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def number_of_chunks(self):
+        return -(-self.shape[0] // self.number_of_rows_per_chunk)
+
+    def chunk(self, chunk_index):
+
+        # Chunks can be read from several threads, so the cached chunks
+        # are only changed by one thread at a time
+        with self._chunks_lock:
+            chunk = self._chunks.get(chunk_index)
+            if chunk is not None:
+                self._chunks.move_to_end(chunk_index)
+                return chunk
+
+        start = chunk_index * self.number_of_rows_per_chunk
+        stop = min(start + self.number_of_rows_per_chunk, self.shape[0])
+        value_start = int(self.indptr[start])
+        value_stop = int(self.indptr[stop])
+
+        data, indices = self._read_values(value_start, value_stop)
+        indptr = self.indptr[start:stop + 1] - value_start
+
+        chunk = SparseRowMatrix(
+            (data, indices, indptr),
+            shape=(stop - start, self.shape[1])
+        )
 
-    if batch_size:
+        with self._chunks_lock:
+            self._chunks[chunk_index] = chunk
+            if len(self._chunks) > self.number_of_cached_chunks:
+                self._chunks.popitem(last=False)
 
-        number_of_rows = a.shape[0]
+        return chunk
 
-        nonzero_count = 0
+    def __getitem__(self, key):
 
-        for i in range(0, number_of_rows, batch_size):
-            nonzero_count += count_nonzero_values(a[i:i+batch_size])
+        if isinstance(key, tuple):
+            raise NotImplementedError(
+                "Only rows can be selected from chunked sparse matrices.")
 
+        if isinstance(key, slice):
+            rows = numpy.arange(*key.indices(self.shape[0]))
+        else:
+            rows = numpy.asarray(key)
+            if rows.dtype == bool:
+                rows = numpy.flatnonzero(rows)
+            rows = rows.reshape(-1)
+            rows = numpy.where(rows < 0, rows + self.shape[0], rows)
+
+        if rows.size == 0:
+            return SparseRowMatrix(
+                (0, self.shape[1]), dtype=self.dtype)
+
+        # Select rows chunk by chunk, and then restore the requested
+        # order of the rows
+        chunk_indices = rows // self.number_of_rows_per_chunk
+        order = numpy.argsort(chunk_indices, kind="stable")
+        chunk_boundaries = numpy.flatnonzero(
+            numpy.diff(chunk_indices[order])) + 1
+
+        row_sets = []
+
+        for positions in numpy.split(order, chunk_boundaries):
+            chunk_index = chunk_indices[positions[0]]
+            chunk_rows = (
+                rows[positions] - chunk_index * self.number_of_rows_per_chunk)
+            row_sets.append(self.chunk(chunk_index)[chunk_rows])
+
+        selected_rows = scipy.sparse.vstack(row_sets, format="csr")
+
+        inverse_order = numpy.empty_like(order)
+        inverse_order[order] = numpy.arange(order.size)
+
+        return SparseRowMatrix(selected_rows[inverse_order])
+
+    def sum(self, axis=None):
+
+        chunk_sums = [
+            self.chunk(chunk_index).sum(axis=axis)
+            for chunk_index in range(self.number_of_chunks)
+        ]
+
+        if axis is None:
+            return sum(chunk_sums)
+        elif axis in [1, -1]:
+            return numpy.concatenate([
+                numpy.asarray(chunk_sum) for chunk_sum in chunk_sums])
+        else:
+            return numpy.asarray(sum(chunk_sums))
+
+    def shuffled_row_indices(self):
+        """Return all row indices in a random order suited for chunks.
+
+        The order of the chunks is shuffled, and the rows are shuffled
+        within consecutive groups of as many chunks as are kept in
+        memory. Selecting rows in this order reads each chunk only once.
+        """
+
+        chunk_indices = numpy.random.permutation(self.number_of_chunks)
+        shuffled_indices = [numpy.empty(0, dtype=int)]
+
+        for i in range(0, self.number_of_chunks, self.number_of_cached_chunks):
+            row_indices = numpy.concatenate([
+                numpy.arange(
+                    chunk_index * self.number_of_rows_per_chunk,
+                    min((chunk_index + 1) * self.number_of_rows_per_chunk,
+                        self.shape[0])
+                )
+                for chunk_index in chunk_indices[
+                    i:i + self.number_of_cached_chunks]
+            ])
+            shuffled_indices.append(numpy.random.permutation(row_indices))
+
+        return numpy.concatenate(shuffled_indices)
+
+    def to_sparse_row_matrix(self):
+        return self[:]
+
+
+class ColumnStatistics:
+    """Per-column statistics of a matrix.
+
+    Sums, sums of squares, numbers of non-zero values, and maxima are
+    accumulated for each column, from which means, variances, and
+    dispersions (variance-to-mean ratios) are derived.
+    """
+
+    def __init__(self, number_of_rows, sums, squared_sums, non_zero_counts,
+                 maxima):
+        self.number_of_rows = number_of_rows
+        self.sums = sums
+        self.squared_sums = squared_sums
+        self.non_zero_counts = non_zero_counts
+        self.maxima = maxima
+
+    @property
+    def means(self):
+        return self.sums / self.number_of_rows
+
+    def variances(self, ddof=0):
+        variances = (
+            self.squared_sums / self.number_of_rows
+            - numpy.square(self.means)
+        )
+        # Rounding errors can make variances of constant columns negative
+        numpy.maximum(variances, 0, out=variances)
+        if ddof > 0:
+            variances *= self.number_of_rows / (self.number_of_rows - ddof)
+        return variances
+
+    def standard_deviations(self, ddof=0):
+        return numpy.sqrt(self.variances(ddof=ddof))
+
+    def dispersions(self):
+        means = self.means
+        dispersions = numpy.full_like(means, numpy.nan)
+        numpy.divide(
+            self.variances(), means, out=dispersions, where=means > 0)
+        return dispersions
+
+
+def column_statistics(values, number_of_threads=None):
+    """Compute per-column statistics of a matrix in one pass.
+
+    Sparse matrices are processed in blocks of rows directly from their
+    stored values and column indices, so memory use only depends on the
+    size of a block. Chunked sparse matrices are processed a chunk at a
+    time. Blocks are processed in parallel threads, by default as many
+    as there are processors.
+    """
+
+    number_of_rows, number_of_columns = values.shape
+
+    if isinstance(values, ChunkedSparseRowMatrix):
+        def blocks():
+            for chunk_index in range(values.number_of_chunks):
+                yield values.chunk(chunk_index)
+    elif scipy.sparse.issparse(values):
+        values = scipy.sparse.csr_matrix(values)
+        block_size = COLUMN_STATISTICS_NUMBER_OF_ROWS_PER_BLOCK
+
+        def blocks():
+            for start in range(0, number_of_rows, block_size):
+                stop = min(start + block_size, number_of_rows)
+                value_start = values.indptr[start]
+                value_stop = values.indptr[stop]
+                yield scipy.sparse.csr_matrix(
+                    (
+                        values.data[value_start:value_stop],
+                        values.indices[value_start:value_stop],
+                        values.indptr[start:stop + 1] - value_start
+                    ),
+                    shape=(stop - start, number_of_columns),
+                    copy=False
+                )
     else:
-        nonzero_count = count_nonzero_values(a)
+        values = numpy.asarray(values)
+        return ColumnStatistics(
+            number_of_rows=number_of_rows,
+            sums=values.sum(axis=0, dtype=numpy.float64),
+            squared_sums=numpy.einsum(
+                "ij,ij->j", values, values, dtype=numpy.float64),
+            non_zero_counts=numpy.count_nonzero(values, axis=0),
+            maxima=values.max(axis=0).astype(numpy.float64)
+        )
+
+    def block_statistics(block):
+
+        data = block.data.astype(numpy.float64, copy=False)
+        ones = numpy.ones(block.shape[0])
+
+        # Column sums are computed as products of the transposed block
+        # with a vector of ones, replacing the stored values in turn by
+        # the values themselves, their squares, and non-zero indicators
+        def column_sums(block_data):
+            return scipy.sparse.csr_matrix(
+                (block_data, block.indices, block.indptr),
+                shape=block.shape, copy=False
+            ).T.dot(ones)
+
+        sums = column_sums(data)
+        squared_sums = column_sums(numpy.square(data))
+        non_zero_counts = column_sums(
+            (data != 0).astype(numpy.float64)).astype(numpy.int64)
+
+        maxima = numpy.full(number_of_columns, -numpy.inf)
+        numpy.maximum.at(maxima, block.indices, data)
+
+        return sums, squared_sums, non_zero_counts, maxima
+
+    sums = numpy.zeros(number_of_columns)
+    squared_sums = numpy.zeros(number_of_columns)
+    non_zero_counts = numpy.zeros(number_of_columns, dtype=numpy.int64)
+    maxima = numpy.full(number_of_columns, -numpy.inf)
+
+    def accumulate(statistics):
+        block_sums, block_squared_sums, block_non_zero_counts, block_maxima = (
+            statistics)
+        numpy.add(sums, block_sums, out=sums)
+        numpy.add(squared_sums, block_squared_sums, out=squared_sums)
+        numpy.add(non_zero_counts, block_non_zero_counts, out=non_zero_counts)
+        numpy.maximum(maxima, block_maxima, out=maxima)
+
+    for statistics in map_in_threads(
+            block_statistics, blocks(), number_of_threads):
+        accumulate(statistics)
+
+    # Columns, which are not non-zero everywhere, have zero values
+    numpy.maximum(
+        maxima,
+        numpy.where(non_zero_counts < number_of_rows, 0, -numpy.inf),
+        out=maxima
+    )
+
+    return ColumnStatistics(
+        number_of_rows=number_of_rows,
+        sums=sums,
+        squared_sums=squared_sums,
+        non_zero_counts=non_zero_counts,
+        maxima=maxima
+    )
+
+
+def compact_dtypes(values):
+    """Store sparse row matrix in the most compact exact data types.
+
+    Stored values, which are all non-negative integers such as counts,
+    are stored in the narrowest unsigned integer type able to hold them.
+    Column indices and row pointers are stored as 32-bit integers,
+    unless there are too many rows, columns, or stored values, in which
+    case both are stored as 64-bit integers as required by SciPy. Arrays
+    already in these types are not copied.
+    """
+
+    if not scipy.sparse.isspmatrix_csr(values):
+        return values
+
+    data_dtype = _compact_count_dtype(values.data)
+    if data_dtype is None:
+        data_dtype = values.dtype
+
+    index_dtype = numpy.int32
+    if max(values.nnz, *values.shape) > numpy.iinfo(numpy.int32).max:
+        index_dtype = numpy.int64
+
+    # Arrays are assigned after constructing the matrix, since the
+    # constructor may copy them again
+    compact_values = SparseRowMatrix(values.shape, dtype=data_dtype)
+    compact_values.data = values.data.astype(data_dtype, copy=False)
+    compact_values.indices = values.indices.astype(index_dtype, copy=False)
+    compact_values.indptr = values.indptr.astype(index_dtype, copy=False)
+
+    return compact_values
+
+
+def _compact_count_dtype(data):
+
+    if data.size == 0:
+        return COMPACT_COUNT_DTYPES[0]
+
+    if numpy.issubdtype(data.dtype, numpy.floating):
+        for start in range(0, data.size, COMPACT_DTYPES_BLOCK_SIZE):
+            block = data[start:start + COMPACT_DTYPES_BLOCK_SIZE]
+            if not numpy.array_equal(block, numpy.floor(block)):
+                return None
+    elif not numpy.issubdtype(data.dtype, numpy.integer):
+        return None
+
+    if data.min() < 0:
+        return None
+
+    maximum = data.max()
+
+    for dtype in COMPACT_COUNT_DTYPES:
+        if maximum <= numpy.iinfo(dtype).max:
+            return dtype
+
+    return None
+
+
+def select_rows(values, indices):
+    """Select rows of values given as a slice or an array of indices.
+
+    Consecutive rows of sparse row matrices and arrays are returned as
+    views sharing memory with the original values instead of copies.
+    """
+
+    if values is None:
+        return None
+
+    indices = _as_contiguous_slice(indices)
+
+    if (isinstance(indices, slice) and scipy.sparse.isspmatrix_csr(values)
+            and indices.step in [None, 1]):
+        start, stop, _ = indices.indices(values.shape[0])
+        stop = max(start, stop)
+        value_start = values.indptr[start]
+        value_stop = values.indptr[stop]
+        # Stored values are assigned after constructing the matrix, since
+        # the constructor copies views of a small part of an array
+        rows = SparseRowMatrix(
+            (stop - start, values.shape[1]), dtype=values.dtype)
+        rows.data = values.data[value_start:value_stop]
+        rows.indices = values.indices[value_start:value_stop]
+        rows.indptr = values.indptr[start:stop + 1] - value_start
+        return rows
+
+    return values[indices]
+
+
+def stack_rows(row_sets):
+    """Stack sets of rows of sparse row matrices or arrays in order."""
+    if any(scipy.sparse.issparse(rows) for rows in row_sets):
+        return SparseRowMatrix(scipy.sparse.vstack(row_sets, format="csr"))
+    return numpy.concatenate(row_sets)
+
+
+def _as_contiguous_slice(indices):
+
+    if isinstance(indices, slice):
+        return indices
+
+    indices = numpy.asarray(indices)
 
-    a_sparsity = 1 - nonzero_count / size
+    if (indices.ndim == 1 and indices.size > 0
+            and numpy.issubdtype(indices.dtype, numpy.integer)
+            and indices[0] >= 0
+            and indices[-1] - indices[0] == indices.size - 1
+            and (indices.size == 1 or numpy.all(numpy.diff(indices) == 1))):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
 
-    return a_sparsity
+    return indices
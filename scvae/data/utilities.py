@@ -27,42 +27,64 @@ EVALUATION_SUBSET_MAXIMUM_NUMBER_OF_EXAMPLES = 25
 EVALUATION_SUBSET_MAXIMUM_NUMBER_OF_EXAMPLES_PER_CLASS = 3
 
 
-def standard_deviation(a, axis=None, ddof=0, batch_size=None):
-    if (not isinstance(a, numpy.ndarray) or axis is not None
-            or batch_size is None):
-        return a.std(axis=axis, ddof=ddof)
-    return numpy.sqrt(variance(
-        a=a,
-        axis=axis,
-        ddof=ddof,
-        batch_size=batch_size
-    ))
+class LabelIndex:
+    """Index of the examples with each class label.
 
+    Labels are encoded once as class IDs, which are the positions of
+    their class names in `class_names` (or -1 for labels without a class
+    name), and the examples are grouped by class ID, so that examples
+    with a given label can be looked up without scanning all labels.
+    """
 
-def variance(a, axis=None, ddof=0, batch_size=None):
+    def __init__(self, labels, class_names=None):
 
-    if (not isinstance(a, numpy.ndarray) or axis is not None
-            or batch_size is None):
-        return a.var(axis=axis, ddof=ddof)
+        labels = numpy.asarray(labels).reshape(-1)
 
-    number_of_rows = a.shape[0]
+        if class_names is None:
+            class_names = numpy.unique(labels).tolist()
 
-    mean_squared = numpy.power(a.mean(axis=None), 2)
+        self.class_names = list(class_names)
+        self.label_ids = pandas.Index(self.class_names).get_indexer(labels)
 
-    squared_sum = 0
+        labelled_indices = numpy.flatnonzero(self.label_ids >= 0)
 
-    for i in range(0, number_of_rows, batch_size):
-        squared_sum += numpy.power(a[i:i+batch_size], 2).sum()
-
-    squared_mean = squared_sum / a.size
-
-    var = squared_mean - mean_squared
-
-    if ddof > 0:
-        size = a.size
-        var = var * size / (size - ddof)
-
-    return var
+        self.class_counts = numpy.bincount(
+            self.label_ids[labelled_indices],
+            minlength=len(self.class_names)
+        )
+        self.class_pointers = numpy.concatenate(
+            [[0], numpy.cumsum(self.class_counts)])
+        self.example_indices = labelled_indices[numpy.argsort(
+            self.label_ids[labelled_indices], kind="stable")]
+
+    @property
+    def number_of_examples(self):
+        return self.label_ids.shape[0]
+
+    def class_ids(self, class_names):
+        """Return class IDs of class names, skipping unknown ones."""
+        class_ids = pandas.Index(self.class_names).get_indexer(
+            numpy.asarray(class_names).reshape(-1))
+        return class_ids[class_ids >= 0]
+
+    def indices_for_class(self, class_id):
+        """Return indices of examples with a class ID in ascending order."""
+        return self.example_indices[
+            self.class_pointers[class_id]:self.class_pointers[class_id + 1]]
+
+    def indices_for_classes(self, class_ids):
+        """Return indices of examples with any of the class IDs."""
+        return numpy.sort(numpy.concatenate(
+            [numpy.empty(0, dtype=self.example_indices.dtype)]
+            + [self.indices_for_class(class_id) for class_id in class_ids]
+        ))
+
+    def mask_excluding_classes(self, class_ids):
+        """Return mask of examples without any of the class IDs."""
+        # The last entry is for labels without a class name (class ID -1)
+        excluded = numpy.zeros(len(self.class_names) + 1, dtype=bool)
+        excluded[numpy.asarray(class_ids, dtype=int)] = True
+        return ~excluded[self.label_ids]
 
 
 def build_directory_path(base_directory, data_set, splitting_method=None,
@@ -160,19 +182,18 @@ def indices_for_evaluation_subset(evaluation_set,
     if evaluation_set.has_labels:
 
         if evaluation_set.label_superset:
-            class_names = evaluation_set.superset_class_names
-            labels = evaluation_set.superset_labels
+            label_index = evaluation_set.superset_label_index
         else:
-            class_names = evaluation_set.class_names
-            labels = evaluation_set.labels
+            label_index = evaluation_set.label_index
 
         subset = set()
 
-        for class_name in class_names:
-            class_label_indices = numpy.argwhere(labels == class_name)
+        for class_id in range(len(label_index.class_names)):
+            class_label_indices = label_index.indices_for_class(
+                class_id).copy()
             random_state.shuffle(class_label_indices)
             subset.update(
-                *class_label_indices[:maximum_number_of_examples_per_class])
+                class_label_indices[:maximum_number_of_examples_per_class])
 
     else:
         subset = numpy.random.permutation(evaluation_set.number_of_examples)[
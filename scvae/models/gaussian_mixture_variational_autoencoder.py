@@ -42,7 +42,10 @@ from scvae.models.utilities import (
     correct_model_checkpoint_path, remove_old_checkpoints,
     copy_model_directory, clear_log_directory,
     parse_numbers_of_samples, validate_model_parameters,
-    batch_indices_for_subset)
+    batch_indices_for_subset, MinibatchIterator, build_input_iterator,
+    TRAINING_EVALUATION_METHODS,
+    build_input_dataset, build_sparse_input, SPARSE_VALUE_INPUT_NAMES)
+from scvae.models.profiling import StepProfiler
 from scvae.utilities import (
     format_duration, format_time,
     normalise_string, capitalise_string)
@@ -311,6 +314,11 @@ class GaussianMixtureVariationalAutoencoder:
             or "multinomial" in self.reconstruction_distribution_name
         )
 
+        sparse_input = kwargs.get("sparse_input")
+        if sparse_input is None:
+            sparse_input = defaults["models"]["sparse_input"]
+        self.sparse_input = sparse_input
+
         kl_weight = kwargs.get("kl_weight")
         if kl_weight is None:
             kl_weight = defaults["models"]["kl_weight"]
@@ -340,13 +348,42 @@ class GaussianMixtureVariationalAutoencoder:
         print("GMVAE starting model graph")
         with self.graph.as_default():
 
-            self.x = tf.placeholder(
-                dtype=tf.float32,
-                shape=[None, self.feature_size],
-                name="X"
+            # Inputs are read from an input pipeline, unless fed directly
+            if self.sparse_input:
+                input_names = SPARSE_VALUE_INPUT_NAMES + ["t"]
+            else:
+                input_names = ["x", "t"]
+            if self.batch_correction:
+                input_names.append("batch_indices")
+            if self.use_count_sum_as_parameter:
+                input_names.append("count_sum_parameter")
+            if self.use_count_sum_as_feature:
+                input_names.append("count_sum_feature")
+            input_names.append("example_indices")
+
+            self.input_iterator = build_input_iterator(
+                feature_size=self.feature_size,
+                input_names=input_names
             )
-            self.t = tf.placeholder(
-                dtype=tf.float32,
+            inputs = self.input_iterator.get_next()
+
+            # Indices of examples in minibatches from an input pipeline
+            self.example_indices = inputs["example_indices"]
+
+            if self.sparse_input:
+                self.x = build_sparse_input(
+                    inputs,
+                    feature_size=self.feature_size,
+                    name="X"
+                )
+            else:
+                self.x = tf.placeholder_with_default(
+                    inputs["x"],
+                    shape=[None, self.feature_size],
+                    name="X"
+                )
+            self.t = tf.placeholder_with_default(
+                inputs["t"],
                 shape=[None, self.feature_size],
                 name="T"
             )
@@ -403,21 +440,21 @@ class GaussianMixtureVariationalAutoencoder:
             )
 
             if self.batch_correction:
-                self.batch_indices = tf.placeholder(
-                    dtype=tf.int32,
+                self.batch_indices = tf.placeholder_with_default(
+                    inputs["batch_indices"],
                     shape=[None, 1],
                     name="batch_indices"
                 )
 
             if self.use_count_sum_as_feature:
-                self.count_sum_feature = tf.placeholder(
-                    dtype=tf.float32,
+                self.count_sum_feature = tf.placeholder_with_default(
+                    inputs["count_sum_feature"],
                     shape=[None, 1],
                     name="count_sum_feature"
                 )
             if self.use_count_sum_as_parameter:
-                self.count_sum_parameter = tf.placeholder(
-                    dtype=tf.float32,
+                self.count_sum_parameter = tf.placeholder_with_default(
+                    inputs["count_sum_parameter"],
                     shape=[None, 1],
                     name="count_sum"
                 )
@@ -426,6 +463,15 @@ class GaussianMixtureVariationalAutoencoder:
                     multiples=[self.n_iw_samples * self.n_mc_samples, 1]
                 )
 
+            # Model inputs by name for feeding minibatches to them
+            self.inputs = {"x": self.x, "t": self.t}
+            if self.batch_correction:
+                self.inputs["batch_indices"] = self.batch_indices
+            if self.use_count_sum_as_parameter:
+                self.inputs["count_sum_parameter"] = self.count_sum_parameter
+            if self.use_count_sum_as_feature:
+                self.inputs["count_sum_feature"] = self.count_sum_feature
+
             self.sample_size = tf.placeholder(
                 dtype=tf.int32,
                 shape=[],
@@ -722,6 +768,37 @@ class GaussianMixtureVariationalAutoencoder:
         if analyses_directory is None:
             analyses_directory = defaults["analyses"]["directory"]
 
+        input_pipeline = kwargs.get("input_pipeline")
+        if input_pipeline is None:
+            input_pipeline = defaults["models"]["input_pipeline"]
+
+        number_of_input_workers = kwargs.get("number_of_input_workers")
+        if number_of_input_workers is None:
+            number_of_input_workers = defaults["models"][
+                "number_of_input_workers"]
+
+        training_evaluation = kwargs.get("training_evaluation")
+        if training_evaluation is None:
+            training_evaluation = defaults["models"]["training_evaluation"]
+        if training_evaluation not in TRAINING_EVALUATION_METHODS:
+            raise ValueError(
+                "Training evaluation method `{}` not found.".format(
+                    training_evaluation))
+
+        training_evaluation_subsample_size = kwargs.get(
+            "training_evaluation_subsample_size")
+        if training_evaluation_subsample_size is None:
+            training_evaluation_subsample_size = defaults["models"][
+                "training_evaluation_subsample_size"]
+
+        profile = kwargs.get("profile")
+        if profile is None:
+            profile = defaults["models"]["profile"]
+
+        profile_trace_window = kwargs.get("profile_trace_window")
+        if profile_trace_window is None:
+            profile_trace_window = defaults["models"]["profile_trace_window"]
+
         start_time = time()
 
         if run_id is None:
@@ -752,7 +829,8 @@ class GaussianMixtureVariationalAutoencoder:
             "training duration": None,
             "last epoch duration": None,
             "learning rate": learning_rate,
-            "minibatch size": minibatch_size
+            "minibatch size": minibatch_size,
+            "training evaluation": training_evaluation
         }
 
         # Earlier model
@@ -852,31 +930,40 @@ class GaussianMixtureVariationalAutoencoder:
         print("Preparing data.")
         preparing_data_time_start = time()
 
+        # Other inputs for each example
+        training_inputs = {}
+        validation_inputs = {}
+
         # Batch indices for batch correction
         if self.batch_correction:
-            batch_indices_train = batch_indices_for_subset(training_set)
+            training_inputs["batch_indices"] = batch_indices_for_subset(
+                training_set)
             if validation_set:
-                batch_indices_valid = batch_indices_for_subset(validation_set)
+                validation_inputs["batch_indices"] = (
+                    batch_indices_for_subset(validation_set))
 
         # Count sum for distributions
         if self.use_count_sum_as_parameter:
-            count_sum_parameter_train = training_set.count_sum
+            training_inputs["count_sum_parameter"] = training_set.count_sum
             if validation_set:
-                count_sum_parameter_valid = validation_set.count_sum
+                validation_inputs["count_sum_parameter"] = (
+                    validation_set.count_sum)
 
         # Normalised count sum as a feature to the decoder
         if self.use_count_sum_as_feature:
-            count_sum_feature_train = training_set.normalised_count_sum
+            training_inputs["count_sum_feature"] = (
+                training_set.normalised_count_sum)
             if validation_set:
-                count_sum_feature_valid = validation_set.normalised_count_sum
+                validation_inputs["count_sum_feature"] = (
+                    validation_set.normalised_count_sum)
 
         # Numbers of examples for data subsets
         n_examples_train = training_set.number_of_examples
         if validation_set:
             n_examples_valid = validation_set.number_of_examples
 
-        # Preprocessing function at every epoch
-        noisy_preprocess = training_set.noisy_preprocess
+        # Noisy preprocessing function for every minibatch
+        noisy_preprocess = training_set.noisy_preprocess_minibatch
 
         # Input and output
         if not noisy_preprocess:
@@ -898,49 +985,128 @@ class GaussianMixtureVariationalAutoencoder:
                 t_train = training_set.values
                 if validation_set:
                     t_valid = validation_set.values
+        else:
+            x_train = training_set.values_for_noisy_preprocessing
+            t_train = x_train
+            if validation_set:
+                x_valid = validation_set.values_for_noisy_preprocessing
+                t_valid = x_valid
 
         # Use label IDs instead of labels
         if training_set.has_labels:
-
-            class_names_to_class_ids = numpy.vectorize(
-                lambda class_name:
-                    training_set.class_name_to_class_id[class_name]
-            )
-
-            training_label_ids = class_names_to_class_ids(training_set.labels)
+            training_label_ids = training_set.label_index.label_ids
             if validation_set:
-                validation_label_ids = class_names_to_class_ids(
-                    validation_set.labels)
-
-            if training_set.excluded_classes:
-                excluded_class_ids = class_names_to_class_ids(
-                    training_set.excluded_classes)
-            else:
-                excluded_class_ids = []
+                validation_label_ids = validation_set.label_index.label_ids
+            excluded_class_ids = training_set.label_index.class_ids(
+                training_set.excluded_classes)
 
         # Use superset label IDs instead of superset labels
         if training_set.has_superset_labels:
-
-            superset_class_names_to_superset_class_ids = numpy.vectorize(
-                lambda superset_class_name:
-                    training_set.superset_class_name_to_superset_class_id[
-                        superset_class_name]
-            )
-
             training_superset_label_ids = (
-                superset_class_names_to_superset_class_ids(
-                    training_set.superset_labels))
+                training_set.superset_label_index.label_ids)
             if validation_set:
                 validation_superset_label_ids = (
-                    superset_class_names_to_superset_class_ids(
-                        validation_set.superset_labels))
+                    validation_set.superset_label_index.label_ids)
+            excluded_superset_class_ids = (
+                training_set.superset_label_index.class_ids(
+                    training_set.excluded_superset_classes))
+
+        # Minibatches of model inputs assembled in the background
+        training_minibatches = MinibatchIterator(
+            inputs=self.inputs,
+            values=x_train,
+            target_values=t_train,
+            minibatch_size=minibatch_size,
+            example_inputs=training_inputs,
+            noisy_preprocess=noisy_preprocess,
+            sparse_values=self.sparse_input
+        )
+        if validation_set:
+            validation_minibatches = MinibatchIterator(
+                inputs=self.inputs,
+                values=x_valid,
+                target_values=t_valid,
+                minibatch_size=minibatch_size,
+                example_inputs=validation_inputs,
+                noisy_preprocess=noisy_preprocess,
+                sparse_values=self.sparse_input
+            )
 
-            if training_set.excluded_superset_classes:
-                excluded_superset_class_ids = (
-                    superset_class_names_to_superset_class_ids(
-                        training_set.excluded_superset_classes))
-            else:
-                excluded_superset_class_ids = []
+        # Training set evaluated after each epoch, either in full, on a
+        # fixed random subsample, or streamed from the training steps
+        training_evaluation_fetches = [
+            self.lower_bound, self.reconstruction_error,
+            self.kl_divergence_z, self.kl_divergence_y,
+            self.kl_divergence_neurons, self.q_y_probabilities,
+            self.q_z_means, self.q_z_variances,
+            self.p_y_probabilities, self.p_z_means,
+            self.p_z_variances, self.q_z_covariances,
+            self.p_z_covariances, self.q_y_logits, self.z_mean
+        ]
+        training_evaluation_feed_dict = {
+            self.is_training: False,
+            self.warm_up_weight: 1.0,
+            self.n_iw_samples: self.number_of_importance_samples["training"],
+            self.n_mc_samples: self.number_of_monte_carlo_samples["training"]
+        }
+        if training_evaluation == "subsample":
+            training_evaluation_indices = numpy.sort(numpy.random.choice(
+                n_examples_train,
+                size=min(training_evaluation_subsample_size, n_examples_train),
+                replace=False
+            ))
+            training_evaluation_minibatches = MinibatchIterator(
+                inputs=self.inputs,
+                values=x_train,
+                target_values=t_train,
+                minibatch_size=minibatch_size,
+                example_inputs=training_inputs,
+                noisy_preprocess=noisy_preprocess,
+                sparse_values=self.sparse_input,
+                example_indices=training_evaluation_indices
+            )
+            n_examples_train_evaluation = training_evaluation_indices.size
+            metadata_log["training evaluation"] = (
+                "subsample of {} examples".format(
+                    n_examples_train_evaluation))
+            # Training accuracies are also only found for the subsample
+            if training_set.has_labels:
+                training_label_ids = training_label_ids[
+                    training_evaluation_indices]
+            if training_set.has_superset_labels:
+                training_superset_label_ids = training_superset_label_ids[
+                    training_evaluation_indices]
+        else:
+            training_evaluation_minibatches = training_minibatches
+            n_examples_train_evaluation = n_examples_train
+
+        # Input pipeline assembling minibatches in parallel
+        if input_pipeline:
+            with self.graph.as_default():
+                training_input_initialiser = (
+                    self.input_iterator.make_initializer(
+                        build_input_dataset(
+                            values=x_train,
+                            target_values=t_train,
+                            minibatch_size=minibatch_size,
+                            example_inputs=training_inputs,
+                            noisy_preprocess=noisy_preprocess,
+                            number_of_workers=number_of_input_workers,
+                            sparse_values=self.sparse_input
+                        )
+                    )
+                )
+
+        # Profiling of training and evaluation steps
+        step_profiler = StepProfiler(
+            log_directory=log_directory,
+            enabled=profile,
+            trace_window=profile_trace_window
+        )
+        if input_pipeline:
+            training_step_minibatches = None
+        else:
+            training_step_minibatches = training_minibatches
 
         preparing_data_duration = time() - preparing_data_time_start
         print("Data prepared ({}).".format(format_duration(
@@ -1036,6 +1202,10 @@ class GaussianMixtureVariationalAutoencoder:
 
             metadata_log["epochs trained"] = (epoch_start, number_of_epochs)
 
+            # The global step is only read once and then counted, since
+            # the optimiser increments it by one at each step
+            step = session.run(self.global_step)
+
             print(training_string)
             print()
             training_time_start = time()
@@ -1043,24 +1213,6 @@ class GaussianMixtureVariationalAutoencoder:
             number_of_epochs = 20
             for epoch in range(epoch_start, number_of_epochs):
 
-                if noisy_preprocess:
-                    print("Noisily preprocess values.")
-                    noisy_time_start = time()
-
-                    x_train = noisy_preprocess(
-                        training_set.values)
-                    t_train = x_train
-
-                    if validation_set:
-                        x_valid = noisy_preprocess(
-                            validation_set.values)
-                        t_valid = x_valid
-
-                    noisy_duration = time() - noisy_time_start
-                    print("Values noisily preprocessed ({}).".format(
-                        format_duration(noisy_duration)))
-                    print()
-
                 epoch_time_start = time()
 
                 if self.number_of_warm_up_epochs:
@@ -1069,24 +1221,25 @@ class GaussianMixtureVariationalAutoencoder:
                 else:
                     warm_up_weight = 1.0
 
-                shuffled_indices = numpy.random.permutation(n_examples_train)
+                if input_pipeline:
+                    session.run(training_input_initialiser)
+                    # Minibatches are read from the input pipeline
+                    training_minibatch_feeds = (
+                        (None, {}) for _ in range(
+                            0, n_examples_train, minibatch_size))
+                else:
+                    training_minibatch_feeds = (
+                        training_minibatches.shuffled())
+
+                streamed_training_evaluations = []
 
-                for i in range(0, n_examples_train, minibatch_size):
+                for minibatch_indices, feed_dict_batch in (
+                        training_minibatch_feeds):
 
                     # Internal setup
                     step_time_start = time()
-                    step = session.run(self.global_step)
-
-                    # Prepare minibatch
-                    minibatch_indices = shuffled_indices[
-                        i:(i + minibatch_size)]
-
-                    x_batch = x_train[minibatch_indices].toarray()
-                    t_batch = t_train[minibatch_indices].toarray()
 
-                    feed_dict_batch = {
-                        self.x: x_batch,
-                        self.t: t_batch,
+                    feed_dict_batch.update({
                         self.is_training: True,
                         self.learning_rate: learning_rate,
                         self.warm_up_weight: warm_up_weight,
@@ -1094,25 +1247,29 @@ class GaussianMixtureVariationalAutoencoder:
                             self.number_of_importance_samples["training"],
                         self.n_mc_samples:
                             self.number_of_monte_carlo_samples["training"]
-                    }
-
-                    if self.batch_correction:
-                        feed_dict_batch[self.batch_indices] = (
-                            batch_indices_train[minibatch_indices])
-
-                    if self.use_count_sum_as_parameter:
-                        feed_dict_batch[self.count_sum_parameter] = (
-                            count_sum_parameter_train[minibatch_indices])
-
-                    if self.use_count_sum_as_feature:
-                        feed_dict_batch[self.count_sum_feature] = (
-                            count_sum_feature_train[minibatch_indices])
+                    })
 
                     # Run the stochastic minibatch training operation
-                    _, minibatch_loss = session.run(
-                        [self.optimiser, self.lower_bound],
-                        feed_dict=feed_dict_batch
+                    fetches = [self.optimiser, self.lower_bound]
+                    if training_evaluation == "streaming":
+                        # Also evaluate the minibatch in the same forward
+                        # pass for the training evaluation
+                        fetches.append(training_evaluation_fetches)
+                        if input_pipeline:
+                            fetches.append(self.example_indices)
+                    step_results = step_profiler.run(
+                        session,
+                        fetches,
+                        feed_dict=feed_dict_batch,
+                        minibatches=training_step_minibatches
                     )
+                    _, minibatch_loss = step_results[:2]
+                    if training_evaluation == "streaming":
+                        training_evaluation_i = step_results[2]
+                        if input_pipeline:
+                            minibatch_indices = step_results[3]
+                        streamed_training_evaluations.append(
+                            (minibatch_indices, training_evaluation_i))
 
                     # Compute step duration
                     step_duration = time() - step_time_start
@@ -1129,6 +1286,8 @@ class GaussianMixtureVariationalAutoencoder:
                                 "Aborting. The ELBO for the last batch became "
                                 "indefinite.")
 
+                    step += 1
+
                 print()
 
                 epoch_duration = time() - epoch_time_start
@@ -1180,11 +1339,11 @@ class GaussianMixtureVariationalAutoencoder:
                                self.latent_size))
 
                 q_y_logits_train = numpy.zeros(
-                    shape=(n_examples_train, self.n_clusters),
+                    shape=(n_examples_train_evaluation, self.n_clusters),
                     dtype=numpy.float32
                 )
                 z_mean_train = numpy.zeros(
-                    shape=(n_examples_train, self.latent_size),
+                    shape=(n_examples_train_evaluation, self.latent_size),
                     dtype=numpy.float32
                 )
 
@@ -1193,33 +1352,25 @@ class GaussianMixtureVariationalAutoencoder:
                 else:
                     kl_divergence_neurons = numpy.zeros(self.latent_size)
 
-                for i in range(0, n_examples_train, minibatch_size):
-                    subset = slice(
-                        i, min(i + minibatch_size, n_examples_train))
-                    x_batch = x_train[subset].toarray()
-                    t_batch = t_train[subset].toarray()
-                    feed_dict_batch = {
-                        self.x: x_batch,
-                        self.t: t_batch,
-                        self.is_training: False,
-                        self.warm_up_weight: 1.0,
-                        self.n_iw_samples:
-                            self.number_of_importance_samples["training"],
-                        self.n_mc_samples:
-                            self.number_of_monte_carlo_samples["training"]
-                    }
-
-                    if self.batch_correction:
-                        feed_dict_batch[self.batch_indices] = (
-                            batch_indices_train[subset])
-
-                    if self.use_count_sum_as_parameter:
-                        feed_dict_batch[self.count_sum_parameter] = (
-                            count_sum_parameter_train[subset])
+                if training_evaluation == "streaming":
+                    training_evaluations = streamed_training_evaluations
+                else:
+                    training_evaluations = (
+                        (subset, step_profiler.run(
+                            session,
+                            training_evaluation_fetches,
+                            feed_dict={
+                                **feed_dict_batch,
+                                **training_evaluation_feed_dict
+                            },
+                            kind="evaluation",
+                            minibatches=training_evaluation_minibatches
+                        ))
+                        for subset, feed_dict_batch in (
+                            training_evaluation_minibatches)
+                    )
 
-                    if self.use_count_sum_as_feature:
-                        feed_dict_batch[self.count_sum_feature] = (
-                            count_sum_feature_train[subset])
+                for subset, training_evaluation_i in training_evaluations:
 
                     (
                         lower_bound_i, reconstruction_error_i,
@@ -1229,18 +1380,7 @@ class GaussianMixtureVariationalAutoencoder:
                         p_y_probabilities_i, p_z_means_i, p_z_variances_i,
                         q_z_covariances_i, p_z_covariances_i,
                         q_y_logits_train_i, z_mean_i
-                    ) = session.run(
-                        [
-                            self.lower_bound, self.reconstruction_error,
-                            self.kl_divergence_z, self.kl_divergence_y,
-                            self.kl_divergence_neurons, self.q_y_probabilities,
-                            self.q_z_means, self.q_z_variances,
-                            self.p_y_probabilities, self.p_z_means,
-                            self.p_z_variances, self.q_z_covariances,
-                            self.p_z_covariances, self.q_y_logits, self.z_mean
-                        ],
-                        feed_dict=feed_dict_batch
-                    )
+                    ) = training_evaluation_i
 
                     lower_bound_train += lower_bound_i
                     kl_divergence_z_train += kl_divergence_z_i
@@ -1264,24 +1404,27 @@ class GaussianMixtureVariationalAutoencoder:
                     q_y_logits_train[subset] = q_y_logits_train_i
                     z_mean_train[subset] = z_mean_i
 
-                lower_bound_train /= n_examples_train / minibatch_size
-                kl_divergence_z_train /= n_examples_train / minibatch_size
-                kl_divergence_y_train /= n_examples_train / minibatch_size
-                reconstruction_error_train /= n_examples_train / minibatch_size
+                number_of_minibatches_train = (
+                    n_examples_train_evaluation / minibatch_size)
+
+                lower_bound_train /= number_of_minibatches_train
+                kl_divergence_z_train /= number_of_minibatches_train
+                kl_divergence_y_train /= number_of_minibatches_train
+                reconstruction_error_train /= number_of_minibatches_train
 
-                kl_divergence_neurons /= n_examples_train / minibatch_size
+                kl_divergence_neurons /= number_of_minibatches_train
 
-                q_y_probabilities /= n_examples_train / minibatch_size
-                q_z_means /= n_examples_train / minibatch_size
-                q_z_variances /= n_examples_train / minibatch_size
+                q_y_probabilities /= number_of_minibatches_train
+                q_z_means /= number_of_minibatches_train
+                q_z_variances /= number_of_minibatches_train
 
-                p_y_probabilities /= n_examples_train / minibatch_size
-                p_z_means /= n_examples_train / minibatch_size
-                p_z_variances /= n_examples_train / minibatch_size
+                p_y_probabilities /= number_of_minibatches_train
+                p_z_means /= number_of_minibatches_train
+                p_z_variances /= number_of_minibatches_train
 
                 if "full-covariance" in self.latent_distribution_name:
-                    q_z_covariances /= n_examples_train / minibatch_size
-                    p_z_covariances /= n_examples_train / minibatch_size
+                    q_z_covariances /= number_of_minibatches_train
+                    p_z_covariances /= number_of_minibatches_train
 
                 if numpy.isnan(lower_bound_train):
                     raise ArithmeticError(
@@ -1484,33 +1627,15 @@ class GaussianMixtureVariationalAutoencoder:
                         dtype=numpy.float32
                     )
 
-                    for i in range(0, n_examples_valid, minibatch_size):
-                        subset = slice(
-                            i, min(i + minibatch_size, n_examples_valid))
-                        x_batch = x_valid[subset].toarray()
-                        t_batch = t_valid[subset].toarray()
-                        feed_dict_batch = {
-                            self.x: x_batch,
-                            self.t: t_batch,
+                    for subset, feed_dict_batch in validation_minibatches:
+                        feed_dict_batch.update({
                             self.is_training: False,
                             self.warm_up_weight: 1.0,
                             self.n_iw_samples:
                                 self.number_of_importance_samples["training"],
                             self.n_mc_samples:
                                 self.number_of_monte_carlo_samples["training"]
-                        }
-
-                        if self.batch_correction:
-                            feed_dict_batch[self.batch_indices] = (
-                                batch_indices_valid[subset])
-
-                        if self.use_count_sum_as_parameter:
-                            feed_dict_batch[self.count_sum_parameter] = (
-                                count_sum_parameter_valid[subset])
-
-                        if self.use_count_sum_as_feature:
-                            feed_dict_batch[self.count_sum_feature] = (
-                                count_sum_feature_valid[subset])
+                        })
 
                         (
                             lower_bound_i, reconstruction_error_i,
@@ -1519,7 +1644,8 @@ class GaussianMixtureVariationalAutoencoder:
                             p_y_probabilities_i, p_z_means_i, p_z_variances_i,
                             q_z_covariances_i, p_z_covariances_i,
                             q_y_logits_i, z_mean_i
-                        ) = session.run(
+                        ) = step_profiler.run(
+                            session,
                             [
                                 self.lower_bound, self.reconstruction_error,
                                 self.kl_divergence_z, self.kl_divergence_y,
@@ -1529,7 +1655,9 @@ class GaussianMixtureVariationalAutoencoder:
                                 self.q_z_covariances, self.p_z_covariances,
                                 self.q_y_logits, self.z_mean
                             ],
-                            feed_dict=feed_dict_batch
+                            feed_dict=feed_dict_batch,
+                            kind="evaluation",
+                            minibatches=validation_minibatches
                         )
 
                         lower_bound_valid += lower_bound_i
@@ -1868,6 +1996,10 @@ class GaussianMixtureVariationalAutoencoder:
                         if validation_set:
                             intermediate_latent_values = z_mean_valid
                             intermediate_data_set = validation_set
+                        elif training_evaluation == "subsample":
+                            # Latent values are only found for a subsample
+                            intermediate_latent_values = None
+                            intermediate_data_set = None
                         else:
                             intermediate_latent_values = z_mean_train
                             intermediate_data_set = training_set
@@ -1947,6 +2079,9 @@ class GaussianMixtureVariationalAutoencoder:
                     if metadata_value
                 ))
 
+            step_profiler.save_summary(
+                log_directory=self.log_directory(run_id=run_id))
+
             return 0
 
     def sample(self, sample_size=None, minibatch_size=None, run_id=None,
@@ -2222,19 +2357,25 @@ class GaussianMixtureVariationalAutoencoder:
 
         evaluation_set_transformed = False
 
+        evaluation_inputs = {}
+
         if self.batch_correction:
-            batch_indices_eval = batch_indices_for_subset(evaluation_set)
+            evaluation_inputs["batch_indices"] = batch_indices_for_subset(
+                evaluation_set)
 
         if self.use_count_sum_as_parameter:
-            count_sum_parameter_eval = evaluation_set.count_sum
+            evaluation_inputs["count_sum_parameter"] = (
+                evaluation_set.count_sum)
 
         if self.use_count_sum_as_feature:
-            count_sum_feature_eval = evaluation_set.normalised_count_sum
+            evaluation_inputs["count_sum_feature"] = (
+                evaluation_set.normalised_count_sum)
 
         n_examples_eval = evaluation_set.number_of_examples
         n_feature_eval = evaluation_set.number_of_features
 
-        noisy_preprocess = evaluation_set.noisy_preprocess
+        # Noisy preprocessing function for every minibatch
+        noisy_preprocess = evaluation_set.noisy_preprocess_minibatch
 
         if not noisy_preprocess:
 
@@ -2250,61 +2391,38 @@ class GaussianMixtureVariationalAutoencoder:
                 t_eval = evaluation_set.values
 
         else:
-            print("Noisily preprocess values.")
-            noisy_time_start = time()
-            x_eval = noisy_preprocess(evaluation_set.values)
+            x_eval = evaluation_set.values_for_noisy_preprocessing
             t_eval = x_eval
             evaluation_set_transformed = True
-            noisy_duration = time() - noisy_time_start
-            print("Values noisily preprocessed ({}).".format(
-                format_duration(noisy_duration)))
-            print()
+
+        # Noisily preprocessed values of minibatches are only kept, if the
+        # transformed evaluation set is output
+        evaluation_minibatches = MinibatchIterator(
+            inputs=self.inputs,
+            values=x_eval,
+            target_values=t_eval,
+            minibatch_size=minibatch_size,
+            example_inputs=evaluation_inputs,
+            noisy_preprocess=noisy_preprocess,
+            sparse_values=self.sparse_input,
+            keep_noisy_values=(
+                noisy_preprocess is not None
+                and "transformed" in output_versions)
+        )
 
         # Use label IDs instead of labels
         if evaluation_set.has_labels:
-
-            class_names_to_class_ids = numpy.vectorize(
-                lambda class_name:
-                    evaluation_set.class_name_to_class_id[class_name]
-            )
-            class_ids_to_class_names = numpy.vectorize(
-                lambda class_id:
-                    evaluation_set.class_id_to_class_name[class_id]
-            )
-
-            evaluation_label_ids = class_names_to_class_ids(
-                evaluation_set.labels)
-
-            if evaluation_set.excluded_classes:
-                excluded_class_ids = class_names_to_class_ids(
-                    evaluation_set.excluded_classes)
-            else:
-                excluded_class_ids = []
+            evaluation_label_ids = evaluation_set.label_index.label_ids
+            excluded_class_ids = evaluation_set.label_index.class_ids(
+                evaluation_set.excluded_classes)
 
         # Use superset label IDs instead of superset labels
         if evaluation_set.label_superset:
-
-            superset_class_names_to_superset_class_ids = numpy.vectorize(
-                lambda superset_class_name:
-                    evaluation_set.superset_class_name_to_superset_class_id[
-                        superset_class_name]
-            )
-            superset_class_ids_to_superset_class_names = numpy.vectorize(
-                lambda superset_class_id:
-                    evaluation_set.superset_class_id_to_superset_class_name[
-                        superset_class_id]
-            )
-
             evaluation_superset_label_ids = (
-                superset_class_names_to_superset_class_ids(
-                    evaluation_set.superset_labels))
-
-            if evaluation_set.excluded_superset_classes:
-                excluded_superset_class_ids = (
-                    superset_class_names_to_superset_class_ids(
-                        evaluation_set.excluded_superset_classes))
-            else:
-                excluded_superset_class_ids = []
+                evaluation_set.superset_label_index.label_ids)
+            excluded_superset_class_ids = (
+                evaluation_set.superset_label_index.class_ids(
+                    evaluation_set.excluded_superset_classes))
 
         log_directory = self.log_directory(
             run_id=run_id,
@@ -2398,36 +2516,22 @@ class GaussianMixtureVariationalAutoencoder:
                     dtype=numpy.float32
                 )
 
-            for i in range(0, n_examples_eval, minibatch_size):
+            for subset, feed_dict_batch in evaluation_minibatches:
 
-                indices = numpy.arange(
-                    i, min(i + minibatch_size, n_examples_eval))
+                i = subset.start
+                indices = numpy.arange(subset.start, subset.stop)
 
                 subset_indices = numpy.array(list(
                     evaluation_subset_indices.intersection(indices)))
 
-                feed_dict_batch = {
-                    self.x: x_eval[indices].toarray(),
-                    self.t: t_eval[indices].toarray(),
+                feed_dict_batch.update({
                     self.is_training: False,
                     self.warm_up_weight: 1.0,
                     self.n_iw_samples:
                         self.number_of_importance_samples["evaluation"],
                     self.n_mc_samples:
                         self.number_of_monte_carlo_samples["evaluation"]
-                }
-
-                if self.batch_correction:
-                    feed_dict_batch[self.batch_indices] = (
-                        batch_indices_eval[indices])
-
-                if self.use_count_sum_as_parameter:
-                    feed_dict_batch[self.count_sum_parameter] = (
-                        count_sum_parameter_eval[indices])
-
-                if self.use_count_sum_as_feature:
-                    feed_dict_batch[self.count_sum_feature] = (
-                        count_sum_feature_eval[indices])
+                })
 
                 (
                     lower_bound_i, reconstruction_error_i,
@@ -2645,6 +2749,8 @@ class GaussianMixtureVariationalAutoencoder:
 
             if "transformed" in output_versions:
                 if evaluation_set_transformed:
+                    if noisy_preprocess:
+                        t_eval = evaluation_minibatches.noisy_values()
                     transformed_evaluation_set = DataSet(
                         evaluation_set.name,
                         title=evaluation_set.title,
@@ -2755,15 +2861,16 @@ class GaussianMixtureVariationalAutoencoder:
             )
 
             if evaluation_set.has_labels:
-                predicted_evaluation_labels = class_ids_to_class_names(
-                    predicted_evaluation_label_ids)
+                predicted_evaluation_labels = numpy.array(
+                    evaluation_set.class_names)[
+                        predicted_evaluation_label_ids]
             else:
                 predicted_evaluation_labels = None
 
             if evaluation_set.has_superset_labels:
-                predicted_evaluation_superset_labels = (
-                    superset_class_ids_to_superset_class_names(
-                        predicted_evaluation_superset_label_ids))
+                predicted_evaluation_superset_labels = numpy.array(
+                    evaluation_set.superset_class_names)[
+                        predicted_evaluation_superset_label_ids]
             else:
                 predicted_evaluation_superset_labels = None
 
@@ -2945,8 +3052,18 @@ class GaussianMixtureVariationalAutoencoder:
         # Encoder for q(z|x,y_i=1) = N(mu(x,y_i=1), sigma^2(x,y_i=1))
         with tf.variable_scope("Q"):
             distribution = DISTRIBUTIONS[distribution_name]
-            y = tf.broadcast_to(y, shape=(tf.shape(self.x)[0], tf.shape(y)[1]))
-            xy = tf.concat((self.x, y), axis=-1)
+            if self.sparse_input:
+                # Sparse x is concatenated with y in the first layer
+                number_of_examples = tf.cast(
+                    self.x.dense_shape[0], dtype=tf.int32)
+            else:
+                number_of_examples = tf.shape(self.x)[0]
+            y = tf.broadcast_to(
+                y, shape=(number_of_examples, tf.shape(y)[1]))
+            if self.sparse_input:
+                xy = [self.x, y]
+            else:
+                xy = tf.concat((self.x, y), axis=-1)
             encoder = dense_layers(
                 inputs=xy,
                 num_outputs=self.hidden_sizes,
@@ -0,0 +1,205 @@
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+import os
+from time import time
+
+import numpy
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from scvae.utilities import capitalise_string
+
+PROFILE_DIRECTORY_NAME = "profile"
+PROFILE_SUMMARY_FILENAME = "summary.log"
+STEP_PHASES = ["index", "gather", "densify", "feed", "run"]
+MAXIMUM_NUMBER_OF_LISTED_OPERATIONS = 50
+
+
+class StepProfiler:
+    """Profiler for the steps of training and evaluating a model.
+
+    Steps are run through `run`, which, when profiling is enabled,
+    records the duration of each host-side phase of a step: indexing,
+    gathering, and densifying its minibatch, handing the minibatch over
+    to the step (feed), and running the session (run). The first three
+    phases are measured while the minibatch is assembled and are taken
+    from the `phase_durations` of the minibatches given for the step.
+
+    Steps of each kind, such as training and evaluation, are counted
+    separately, and for those within `trace_window`, the first step
+    included and the last step excluded, a full trace is captured. The
+    trace is saved as a Chrome trace in the profile directory within
+    `log_directory`, and the time spent by each operation is added to
+    the summary saved by `save_summary`.
+
+    When profiling is disabled, steps are run as is.
+    """
+
+    def __init__(self, log_directory, enabled=False, trace_window=None):
+
+        if trace_window is None:
+            trace_window = [0, 0]
+
+        self.directory = os.path.join(log_directory, PROFILE_DIRECTORY_NAME)
+        self.enabled = enabled
+        self.first_traced_step, self.last_traced_step = trace_window
+
+        self.number_of_steps = {}
+        self.phase_durations = {}
+        self.operation_durations = {}
+
+    def run(self, session, fetches, feed_dict=None, kind="training",
+            minibatches=None):
+        """Run a step of the kind given and profile it if enabled."""
+
+        if not self.enabled:
+            return session.run(fetches, feed_dict=feed_dict)
+
+        step = self.number_of_steps.get(kind, 0)
+        self.number_of_steps[kind] = step + 1
+
+        if self.first_traced_step <= step < self.last_traced_step:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+        else:
+            options = None
+            run_metadata = None
+
+        running_time_start = time()
+        results = session.run(
+            fetches,
+            feed_dict=feed_dict,
+            options=options,
+            run_metadata=run_metadata
+        )
+        running_duration = time() - running_time_start
+
+        phase_durations = dict.fromkeys(STEP_PHASES, 0.)
+        if minibatches is not None:
+            phase_durations.update(minibatches.phase_durations)
+        phase_durations["run"] = running_duration
+
+        kind_phase_durations = self.phase_durations.setdefault(
+            kind, {phase: [] for phase in STEP_PHASES})
+        for phase, duration in phase_durations.items():
+            kind_phase_durations[phase].append(duration)
+
+        if run_metadata is not None:
+            self._record_trace(run_metadata, kind, step)
+
+        return results
+
+    def save_summary(self, log_directory=None):
+        """Save summary of step phases and operations to profile directory.
+
+        The summary is saved in the profile directory within
+        `log_directory`, if given, for instance if the log directory has
+        been moved since profiling started.
+        """
+
+        if not self.phase_durations:
+            return
+
+        if log_directory is None:
+            directory = self.directory
+        else:
+            directory = os.path.join(log_directory, PROFILE_DIRECTORY_NAME)
+        os.makedirs(directory, exist_ok=True)
+
+        lines = []
+
+        for kind, kind_phase_durations in self.phase_durations.items():
+            lines.append("{} steps: {}".format(
+                capitalise_string(kind), self.number_of_steps[kind]))
+            lines.append("    {:<10}{:>14}{:>14}{:>14}".format(
+                "Phase", "Total (s)", "Mean (ms)", "Maximum (ms)"))
+            for phase in STEP_PHASES:
+                durations = numpy.array(kind_phase_durations[phase])
+                lines.append("    {:<10}{:>14.3f}{:>14.3f}{:>14.3f}".format(
+                    phase,
+                    durations.sum(),
+                    1000 * durations.mean(),
+                    1000 * durations.max()
+                ))
+            lines.append("")
+
+        for kind, kind_operation_durations in (
+                self.operation_durations.items()):
+
+            number_of_traced_steps = min(
+                self.number_of_steps[kind], self.last_traced_step
+            ) - self.first_traced_step
+
+            lines.append(
+                "{} operations over {} traced steps "
+                "(by total duration):".format(
+                    capitalise_string(kind), number_of_traced_steps))
+            lines.append("    {:>14}{:>14}{:>10}  {:<24}{}".format(
+                "Total (ms)", "Mean (ms)", "Count", "Type", "Name"))
+
+            sorted_operations = sorted(
+                kind_operation_durations.items(),
+                key=lambda item: item[1]["total"],
+                reverse=True
+            )[:MAXIMUM_NUMBER_OF_LISTED_OPERATIONS]
+
+            for (name, operation_type), durations in sorted_operations:
+                lines.append("    {:>14.3f}{:>14.3f}{:>10d}  {:<24}{}".format(
+                    durations["total"] / 1000,
+                    durations["total"] / 1000 / durations["count"],
+                    durations["count"],
+                    operation_type,
+                    name
+                ))
+            lines.append("")
+
+        summary_path = os.path.join(directory, PROFILE_SUMMARY_FILENAME)
+        with open(summary_path, "w") as summary_file:
+            summary_file.write("\n".join(lines))
+
+    def _record_trace(self, run_metadata, kind, step):
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        trace_path = os.path.join(
+            self.directory, "{}-step-{}.json".format(kind, step))
+        with open(trace_path, "w") as trace_file:
+            trace_file.write(trace.generate_chrome_trace_format())
+
+        kind_operation_durations = self.operation_durations.setdefault(
+            kind, {})
+
+        for device_step_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in device_step_stats.node_stats:
+                key = (
+                    node_stats.node_name,
+                    _operation_type(node_stats.timeline_label)
+                )
+                durations = kind_operation_durations.setdefault(
+                    key, {"total": 0, "count": 0})
+                durations["total"] += node_stats.all_end_rel_micros
+                durations["count"] += 1
+
+
+def _operation_type(timeline_label):
+    # Timeline labels have the form "name = Type(inputs)"
+    if " = " not in timeline_label:
+        return ""
+    return timeline_label.split(" = ", 1)[1].split("(", 1)[0]
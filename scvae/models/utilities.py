@@ -17,21 +17,50 @@
 # ======================================================================== #
 
 import os
+import queue
 import random
 import re
 import shutil
+import threading
 import time
 from collections import namedtuple
 from datetime import datetime
 from string import ascii_uppercase
 
 import numpy
+import scipy.sparse
 import tensorflow as tf
-from tensorflow.contrib.layers import fully_connected, batch_norm, dropout
+from tensorflow.contrib.framework import model_variable
+from tensorflow.contrib.layers import (
+    fully_connected, batch_norm, dropout, xavier_initializer)
 
+from scvae.data.sparse import (
+    ChunkedSparseRowMatrix, select_rows, stack_rows)
 from scvae.utilities import (
     capitalise_string, enumerate_strings, normalise_string)
 
+# Data types of model inputs for minibatches
+MINIBATCH_INPUT_DTYPES = {
+    "x": tf.float32,
+    "x_indices": tf.int64,
+    "x_values": tf.float32,
+    "x_dense_shape": tf.int64,
+    "t": tf.float32,
+    "batch_indices": tf.int32,
+    "count_sum_parameter": tf.float32,
+    "count_sum_feature": tf.float32,
+    "example_indices": tf.int64
+}
+
+# Names of model inputs for the components of sparse minibatches of values
+SPARSE_VALUE_INPUT_NAMES = ["x_indices", "x_values", "x_dense_shape"]
+
+# Number of sets of arrays that minibatches are assembled in alternately
+NUMBER_OF_BUFFERS = 2
+
+# Methods for evaluating models on the training set after each epoch
+TRAINING_EVALUATION_METHODS = ["full", "streaming", "subsample"]
+
 
 # Wrapper layer for inserting batch normalisation in between linear and
 # nonlinear activation layers
@@ -40,23 +69,42 @@ def dense_layer(inputs, num_outputs, is_training=True, scope="layer",
                 center=True, scale=False, reuse=False,
                 dropout_keep_probability=False):
 
+    # Inputs can also be sparse or a list of inputs to concatenate, in
+    # which case they are transformed part by part without densifying them
+    if isinstance(inputs, (list, tuple)):
+        input_parts = list(inputs)
+    else:
+        input_parts = [inputs]
+
     with tf.variable_scope(scope):
         # Dropout input connections with rate = (1- dropout_keep_probability)
         if dropout_keep_probability and dropout_keep_probability != 1:
-            inputs = dropout(
-                inputs=inputs,
-                keep_prob=dropout_keep_probability,
-                is_training=is_training
-            )
+            input_parts = [
+                _dropout(
+                    inputs=input_part,
+                    keep_prob=dropout_keep_probability,
+                    is_training=is_training
+                )
+                for input_part in input_parts
+            ]
 
         # Set up weights for and transform inputs through neural network
-        outputs = fully_connected(
-            inputs=inputs,
-            num_outputs=num_outputs,
-            activation_fn=None,
-            scope="DENSE",
-            reuse=reuse
-        )
+        if (len(input_parts) == 1
+                and not isinstance(input_parts[0], tf.SparseTensor)):
+            outputs = fully_connected(
+                inputs=input_parts[0],
+                num_outputs=num_outputs,
+                activation_fn=None,
+                scope="DENSE",
+                reuse=reuse
+            )
+        else:
+            outputs = _fully_connected_for_input_parts(
+                input_parts=input_parts,
+                num_outputs=num_outputs,
+                scope="DENSE",
+                reuse=reuse
+            )
 
         # Set up normalisation across examples with learned center and scale
         if minibatch_normalisation:
@@ -198,7 +246,7 @@ def build_data_string(data_set, reconstruction_distribution_name):
             data_string = "new Bernoulli-sampled values"
         else:
             data_string = "new preprocessed values"
-        data_string += " at every epoch"
+        data_string += " for every minibatch"
 
     return data_string
 
@@ -905,6 +953,494 @@ def batch_indices_for_subset(subset):
     return batch_indices
 
 
+def shuffled_indices_for_values(values):
+    # Values stored out of core are shuffled so that each chunk of them
+    # is only read once per epoch
+    if isinstance(values, ChunkedSparseRowMatrix):
+        return values.shuffled_row_indices()
+    return numpy.random.permutation(values.shape[0])
+
+
+def minibatch_values(values, target_values, indices, noisy_preprocess=None,
+                     sparse_values=False):
+    """Select a minibatch of values and target values as dense arrays.
+
+    If a noisy preprocessing function is given, it is applied to the
+    selected values only, which then also serve as target values. Values
+    are only converted to single-precision floating-point numbers here,
+    so that counts can be stored more compactly as integers. If
+    `sparse_values` is true, the values are instead returned as a sparse
+    tensor value of their nonzero entries, which can be fed to a sparse
+    input.
+    """
+
+    value_batch = values[indices]
+
+    if noisy_preprocess:
+        value_batch = noisy_preprocess(value_batch)
+        target_batch = value_batch
+    else:
+        target_batch = target_values[indices]
+
+    if sparse_values:
+        value_batch = _sparse_tensor_value(value_batch)
+    else:
+        value_batch = _dense_array(value_batch)
+
+    return value_batch, _dense_array(target_batch)
+
+
+class MinibatchIterator:
+    """Iterator over minibatches of model inputs for a data subset.
+
+    Each minibatch is yielded as the indices of its examples together
+    with a feed dictionary for the model inputs, `inputs`, given by name.
+    Values and target values are written into dense arrays, which are
+    allocated once and reused, directly from the rows of sparse values,
+    and target values that are the same as the values are only written
+    once. Other inputs for each example, such as batch indices and count
+    sums, are given by name in `example_inputs` and are selected in the
+    same way. If `example_indices` are given, only these examples are
+    iterated over, and minibatch indices are positions among them.
+
+    Values are noisily preprocessed for each minibatch using
+    `noisy_preprocess`, if given, in which case target values are the
+    same as the values. If `keep_noisy_values` is true, the noisily
+    preprocessed values of every minibatch are kept, so that they can be
+    retrieved together using `noisy_values`.
+
+    The next minibatch is assembled on a background thread while the
+    current one is in use, alternating between two sets of arrays. A
+    minibatch is therefore only valid until the next one is requested,
+    and only one iteration over a data subset can be in progress at a
+    time.
+
+    The durations of the host-side phases of the most recently yielded
+    minibatch are kept in `phase_durations`: indexing the examples,
+    gathering their rows, densifying these into the arrays, and waiting
+    for the minibatch to be handed over (feed).
+    """
+
+    def __init__(self, inputs, values, target_values, minibatch_size,
+                 example_inputs=None, noisy_preprocess=None,
+                 sparse_values=False, example_indices=None,
+                 keep_noisy_values=False):
+
+        if example_inputs is None:
+            example_inputs = {}
+
+        self.inputs = inputs
+        self.values = values
+        self.target_values = target_values
+        self.minibatch_size = minibatch_size
+        self.example_inputs = {
+            input_name: numpy.asarray(example_input)
+            for input_name, example_input in example_inputs.items()
+        }
+        self.noisy_preprocess = noisy_preprocess
+        self.noisy_value_batches = [] if keep_noisy_values else None
+        self.sparse_values = sparse_values
+        self.example_indices = example_indices
+
+        if example_indices is None:
+            self.number_of_examples = values.shape[0]
+        else:
+            self.number_of_examples = len(example_indices)
+
+        self.target_values_are_values = (
+            noisy_preprocess is not None or target_values is values)
+
+        self._buffers = [
+            self._allocate_buffers() for _ in range(NUMBER_OF_BUFFERS)]
+
+        self.phase_durations = {}
+
+    def __iter__(self):
+        """Iterate over minibatches in order."""
+        return self._iterate(
+            slice(i, min(i + self.minibatch_size, self.number_of_examples))
+            for i in range(0, self.number_of_examples, self.minibatch_size)
+        )
+
+    def shuffled(self):
+        """Iterate over minibatches in shuffled order."""
+        if self.example_indices is None:
+            shuffled_indices = shuffled_indices_for_values(self.values)
+        else:
+            shuffled_indices = numpy.random.permutation(
+                self.number_of_examples)
+        return self._iterate(
+            shuffled_indices[i:(i + self.minibatch_size)]
+            for i in range(0, self.number_of_examples, self.minibatch_size)
+        )
+
+    def noisy_values(self):
+        """Return noisily preprocessed values of minibatches kept."""
+        if not self.noisy_value_batches:
+            return None
+        return stack_rows(self.noisy_value_batches)
+
+    def _allocate_buffers(self):
+
+        shape = (self.minibatch_size, self.values.shape[1])
+        buffers = {}
+
+        if not self.sparse_values:
+            buffers["x"] = numpy.empty(shape, dtype=numpy.float32)
+
+        if self.sparse_values or not self.target_values_are_values:
+            buffers["t"] = numpy.empty(shape, dtype=numpy.float32)
+
+        for input_name, example_input in self.example_inputs.items():
+            buffers[input_name] = numpy.empty(
+                (self.minibatch_size,) + example_input.shape[1:],
+                dtype=example_input.dtype
+            )
+
+        return buffers
+
+    def _assemble_minibatch(self, buffers, indices):
+
+        minibatch = {}
+        phase_durations = {}
+
+        gathering_time_start = time.time()
+
+        value_batch = select_rows(self.values, indices)
+        number_of_examples = value_batch.shape[0]
+
+        if self.noisy_preprocess:
+            value_batch = self.noisy_preprocess(value_batch)
+            if self.noisy_value_batches is not None:
+                self.noisy_value_batches.append(value_batch)
+
+        if self.target_values_are_values:
+            target_value_batch = value_batch
+        else:
+            target_value_batch = select_rows(self.target_values, indices)
+
+        example_input_batches = {
+            input_name: select_rows(example_input, indices)
+            for input_name, example_input in self.example_inputs.items()
+        }
+
+        phase_durations["gather"] = time.time() - gathering_time_start
+        densifying_time_start = time.time()
+
+        if self.sparse_values:
+            minibatch["x"] = _sparse_tensor_value(value_batch)
+        else:
+            minibatch["x"] = _fill_dense_array(
+                buffers["x"][:number_of_examples], value_batch)
+
+        if self.sparse_values or not self.target_values_are_values:
+            minibatch["t"] = _fill_dense_array(
+                buffers["t"][:number_of_examples], target_value_batch)
+        else:
+            minibatch["t"] = minibatch["x"]
+
+        for input_name, example_input_batch in example_input_batches.items():
+            minibatch[input_name] = _fill_dense_array(
+                buffers[input_name][:number_of_examples],
+                example_input_batch
+            )
+
+        phase_durations["densify"] = time.time() - densifying_time_start
+
+        feed_dict = {
+            self.inputs[input_name]: input_values
+            for input_name, input_values in minibatch.items()
+        }
+
+        return feed_dict, phase_durations
+
+    def _iterate(self, minibatch_indices):
+
+        free_buffers = queue.Queue()
+        for buffers in self._buffers:
+            free_buffers.put(buffers)
+
+        assembled_minibatches = queue.Queue()
+
+        def assemble_minibatches():
+            try:
+                minibatch_indices_iterator = iter(minibatch_indices)
+                while True:
+                    buffers = free_buffers.get()
+                    if buffers is None:
+                        return
+                    indexing_time_start = time.time()
+                    indices = next(minibatch_indices_iterator, None)
+                    if indices is None:
+                        return
+                    if self.example_indices is None:
+                        example_indices = indices
+                    else:
+                        example_indices = self.example_indices[indices]
+                    indexing_duration = time.time() - indexing_time_start
+                    feed_dict, phase_durations = self._assemble_minibatch(
+                        buffers, example_indices)
+                    phase_durations["index"] = indexing_duration
+                    assembled_minibatches.put(
+                        (indices, buffers, feed_dict, phase_durations))
+            except Exception as exception:
+                assembled_minibatches.put(exception)
+            finally:
+                assembled_minibatches.put(None)
+
+        assembler = threading.Thread(target=assemble_minibatches, daemon=True)
+        assembler.start()
+
+        try:
+            while True:
+                waiting_time_start = time.time()
+                assembled_minibatch = assembled_minibatches.get()
+                if assembled_minibatch is None:
+                    break
+                elif isinstance(assembled_minibatch, Exception):
+                    raise assembled_minibatch
+                indices, buffers, feed_dict, phase_durations = (
+                    assembled_minibatch)
+                phase_durations["feed"] = time.time() - waiting_time_start
+                self.phase_durations = phase_durations
+                yield indices, feed_dict
+                free_buffers.put(buffers)
+        finally:
+            # Stop assembling minibatches, if iteration ended early
+            free_buffers.put(None)
+            assembler.join()
+
+
+def build_input_iterator(feature_size, input_names):
+    """Build iterator over minibatches of model inputs.
+
+    The iterator is not tied to a data set, so it can be initialised
+    with an input pipeline for each epoch using `build_input_dataset`.
+    """
+    output_types, output_shapes = _minibatch_input_structure(
+        feature_size, input_names)
+    return tf.data.Iterator.from_structure(output_types, output_shapes)
+
+
+def build_sparse_input(inputs, feature_size, name):
+    """Build sparse input tensor from its components.
+
+    Each component defaults to the corresponding input in `inputs`, but
+    the sparse tensor can also be fed directly, for instance with a
+    minibatch from `minibatch_values`.
+    """
+    indices = tf.placeholder_with_default(
+        inputs["x_indices"],
+        shape=[None, 2],
+        name=name + "_indices"
+    )
+    values = tf.placeholder_with_default(
+        inputs["x_values"],
+        shape=[None],
+        name=name + "_values"
+    )
+    dense_shape = tf.placeholder_with_default(
+        inputs["x_dense_shape"],
+        shape=[2],
+        name=name + "_dense_shape"
+    )
+    # The feature size is kept static for the weights of the first layer
+    dense_shape = tf.stack(
+        [dense_shape[0], tf.constant(feature_size, dtype=tf.int64)])
+    return tf.SparseTensor(
+        indices=indices, values=values, dense_shape=dense_shape)
+
+
+def build_input_dataset(values, target_values, minibatch_size,
+                        example_inputs=None, noisy_preprocess=None,
+                        number_of_workers=None, sparse_values=False):
+    """Build input pipeline of shuffled minibatches for one epoch.
+
+    Minibatch indices are generated in shuffled order, and minibatches
+    of values and target values as well as of any other inputs for each
+    example are assembled by parallel workers and prefetched, so that
+    training steps do not wait for them. If `sparse_values` is true,
+    minibatches of values are provided as the components of sparse
+    tensors for `build_sparse_input`. The indices of the examples in
+    each minibatch are provided as well.
+    """
+
+    if example_inputs is None:
+        example_inputs = {}
+
+    if number_of_workers is None:
+        number_of_workers = tf.data.experimental.AUTOTUNE
+
+    example_input_names = sorted(example_inputs)
+
+    if sparse_values:
+        value_input_names = SPARSE_VALUE_INPUT_NAMES
+    else:
+        value_input_names = ["x"]
+
+    input_names = (
+        value_input_names + ["t"] + example_input_names + ["example_indices"])
+    output_types, output_shapes = _minibatch_input_structure(
+        feature_size=values.shape[1],
+        input_names=input_names
+    )
+
+    def generate_minibatch_indices():
+        shuffled_indices = shuffled_indices_for_values(values)
+        for i in range(0, shuffled_indices.shape[0], minibatch_size):
+            yield shuffled_indices[i:(i + minibatch_size)]
+
+    def assemble_minibatch(indices):
+        x_batch, t_batch = minibatch_values(
+            values, target_values, indices, noisy_preprocess,
+            sparse_values=sparse_values)
+        if sparse_values:
+            minibatch = [
+                x_batch.indices, x_batch.values, x_batch.dense_shape, t_batch]
+        else:
+            minibatch = [x_batch, t_batch]
+        for input_name in example_input_names:
+            minibatch.append(numpy.asarray(
+                example_inputs[input_name][indices],
+                dtype=output_types[input_name].as_numpy_dtype
+            ))
+        minibatch.append(numpy.asarray(indices, dtype=numpy.int64))
+        return minibatch
+
+    def assemble_minibatch_tensors(indices):
+        tensors = tf.py_func(
+            assemble_minibatch,
+            [indices],
+            [output_types[input_name] for input_name in input_names],
+            stateful=True
+        )
+        for tensor, input_name in zip(tensors, input_names):
+            tensor.set_shape(output_shapes[input_name])
+        return dict(zip(input_names, tensors))
+
+    dataset = tf.data.Dataset.from_generator(
+        generate_minibatch_indices,
+        output_types=tf.int64,
+        output_shapes=tf.TensorShape([None])
+    )
+    dataset = dataset.map(
+        assemble_minibatch_tensors,
+        num_parallel_calls=number_of_workers
+    )
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    return dataset
+
+
+def _minibatch_input_structure(feature_size, input_names):
+
+    output_types = {}
+    output_shapes = {}
+
+    for input_name in input_names:
+        output_types[input_name] = MINIBATCH_INPUT_DTYPES[input_name]
+        if input_name in ["x", "t"]:
+            output_shapes[input_name] = tf.TensorShape([None, feature_size])
+        elif input_name == "x_indices":
+            output_shapes[input_name] = tf.TensorShape([None, 2])
+        elif input_name in ["x_values", "example_indices"]:
+            output_shapes[input_name] = tf.TensorShape([None])
+        elif input_name == "x_dense_shape":
+            output_shapes[input_name] = tf.TensorShape([2])
+        else:
+            output_shapes[input_name] = tf.TensorShape([None, 1])
+
+    return output_types, output_shapes
+
+
+def _fill_dense_array(array, values):
+    # Nonzero entries of sparse row matrices are written directly into the
+    # array without densifying the matrices first
+    if scipy.sparse.issparse(values):
+        values = values.tocsr()
+        if not values.has_canonical_format:
+            values = values.copy()
+            values.sum_duplicates()
+        array.fill(0)
+        row_indices = numpy.repeat(
+            numpy.arange(values.shape[0]), numpy.diff(values.indptr))
+        array[row_indices, values.indices] = values.data
+    else:
+        array[...] = values
+    return array
+
+
+def _dense_array(values):
+    if scipy.sparse.issparse(values):
+        values = values.toarray()
+    return numpy.asarray(values, dtype=numpy.float32)
+
+
+def _dropout(inputs, keep_prob, is_training):
+    # Only the stored values of sparse inputs are dropped out, since the
+    # remaining values are zero either way
+    if isinstance(inputs, tf.SparseTensor):
+        return tf.SparseTensor(
+            indices=inputs.indices,
+            values=dropout(
+                inputs=inputs.values,
+                keep_prob=keep_prob,
+                is_training=is_training
+            ),
+            dense_shape=inputs.dense_shape
+        )
+    return dropout(inputs=inputs, keep_prob=keep_prob, is_training=is_training)
+
+
+def _fully_connected_for_input_parts(input_parts, num_outputs, scope="DENSE",
+                                     reuse=False):
+    # Same weights and biases as for `fully_connected` applied to the
+    # concatenated input parts, so that models can be restored either way
+    input_sizes = [int(input_part.shape[-1]) for input_part in input_parts]
+
+    with tf.variable_scope(scope, reuse=reuse):
+        weights = model_variable(
+            "weights",
+            shape=[sum(input_sizes), num_outputs],
+            initializer=xavier_initializer()
+        )
+        biases = model_variable(
+            "biases",
+            shape=[num_outputs],
+            initializer=tf.zeros_initializer()
+        )
+
+    outputs = biases
+    part_weights = tf.split(weights, input_sizes, axis=0)
+
+    for input_part, weights in zip(input_parts, part_weights):
+        if isinstance(input_part, tf.SparseTensor):
+            outputs += tf.sparse.sparse_dense_matmul(input_part, weights)
+        else:
+            outputs += tf.matmul(input_part, weights)
+
+    return outputs
+
+
+def _sparse_tensor_value(values):
+    # Nonzero entries in compressed sparse row format are converted to
+    # coordinates without densifying them
+    if scipy.sparse.issparse(values):
+        values = values.tocsr()
+    else:
+        values = scipy.sparse.csr_matrix(values)
+    row_indices = numpy.repeat(
+        numpy.arange(values.shape[0], dtype=numpy.int64),
+        numpy.diff(values.indptr)
+    )
+    return tf.SparseTensorValue(
+        indices=numpy.column_stack(
+            (row_indices, values.indices.astype(numpy.int64))),
+        values=numpy.asarray(values.data, dtype=numpy.float32),
+        dense_shape=numpy.array(values.shape, dtype=numpy.int64)
+    )
+
+
 def _summary_reader(log_directory, data_set_kinds, tag_searches):
 
     scalars = None
@@ -38,7 +38,10 @@ from scvae.models.utilities import (
     correct_model_checkpoint_path, remove_old_checkpoints,
     copy_model_directory, clear_log_directory,
     parse_numbers_of_samples, validate_model_parameters,
-    batch_indices_for_subset)
+    batch_indices_for_subset, MinibatchIterator, build_input_iterator,
+    TRAINING_EVALUATION_METHODS,
+    build_input_dataset, build_sparse_input, SPARSE_VALUE_INPUT_NAMES)
+from scvae.models.profiling import StepProfiler
 from scvae.utilities import (
     format_duration, format_time,
     normalise_string, capitalise_string)
@@ -277,6 +280,11 @@ class VariationalAutoencoder:
             or "multinomial" in self.reconstruction_distribution_name
         )
 
+        sparse_input = kwargs.get("sparse_input")
+        if sparse_input is None:
+            sparse_input = defaults["models"]["sparse_input"]
+        self.sparse_input = sparse_input
+
         kl_weight = kwargs.get("kl_weight")
         if kl_weight is None:
             kl_weight = defaults["models"]["kl_weight"]
@@ -309,38 +317,76 @@ class VariationalAutoencoder:
 
         with self.graph.as_default():
 
-            self.x = tf.placeholder(
-                dtype=tf.float32,
-                shape=[None, self.feature_size],
-                name="X"
+            # Inputs are read from an input pipeline, unless fed directly
+            if self.sparse_input:
+                input_names = SPARSE_VALUE_INPUT_NAMES + ["t"]
+            else:
+                input_names = ["x", "t"]
+            if self.batch_correction:
+                input_names.append("batch_indices")
+            if self.use_count_sum_as_parameter:
+                input_names.append("count_sum_parameter")
+            if self.use_count_sum_as_feature:
+                input_names.append("count_sum_feature")
+            input_names.append("example_indices")
+
+            self.input_iterator = build_input_iterator(
+                feature_size=self.feature_size,
+                input_names=input_names
             )
-            self.t = tf.placeholder(
-                dtype=tf.float32,
+            inputs = self.input_iterator.get_next()
+
+            # Indices of examples in minibatches from an input pipeline
+            self.example_indices = inputs["example_indices"]
+
+            if self.sparse_input:
+                self.x = build_sparse_input(
+                    inputs,
+                    feature_size=self.feature_size,
+                    name="X"
+                )
+            else:
+                self.x = tf.placeholder_with_default(
+                    inputs["x"],
+                    shape=[None, self.feature_size],
+                    name="X"
+                )
+            self.t = tf.placeholder_with_default(
+                inputs["t"],
                 shape=[None, self.feature_size],
                 name="T"
             )
 
             if self.batch_correction:
-                self.batch_indices = tf.placeholder(
-                    dtype=tf.int32,
+                self.batch_indices = tf.placeholder_with_default(
+                    inputs["batch_indices"],
                     shape=[None, 1],
                     name="batch_indices"
                 )
 
             if self.use_count_sum_as_feature:
-                self.count_sum_feature = tf.placeholder(
-                    dtype=tf.float32,
+                self.count_sum_feature = tf.placeholder_with_default(
+                    inputs["count_sum_feature"],
                     shape=[None, 1],
                     name="count_sum_feature"
                 )
 
             if self.use_count_sum_as_parameter:
-                self.count_sum_parameter = tf.placeholder(
-                    dtype=tf.float32,
+                self.count_sum_parameter = tf.placeholder_with_default(
+                    inputs["count_sum_parameter"],
                     shape=[None, 1],
                     name="count_sum"
                 )
 
+            # Model inputs by name for feeding minibatches to them
+            self.inputs = {"x": self.x, "t": self.t}
+            if self.batch_correction:
+                self.inputs["batch_indices"] = self.batch_indices
+            if self.use_count_sum_as_parameter:
+                self.inputs["count_sum_parameter"] = self.count_sum_parameter
+            if self.use_count_sum_as_feature:
+                self.inputs["count_sum_feature"] = self.count_sum_feature
+
             self.learning_rate = tf.placeholder(
                 dtype=tf.float32,
                 shape=[],
@@ -677,6 +723,37 @@ class VariationalAutoencoder:
         if analyses_directory is None:
             analyses_directory = defaults["analyses"]["directory"]
 
+        input_pipeline = kwargs.get("input_pipeline")
+        if input_pipeline is None:
+            input_pipeline = defaults["models"]["input_pipeline"]
+
+        number_of_input_workers = kwargs.get("number_of_input_workers")
+        if number_of_input_workers is None:
+            number_of_input_workers = defaults["models"][
+                "number_of_input_workers"]
+
+        training_evaluation = kwargs.get("training_evaluation")
+        if training_evaluation is None:
+            training_evaluation = defaults["models"]["training_evaluation"]
+        if training_evaluation not in TRAINING_EVALUATION_METHODS:
+            raise ValueError(
+                "Training evaluation method `{}` not found.".format(
+                    training_evaluation))
+
+        training_evaluation_subsample_size = kwargs.get(
+            "training_evaluation_subsample_size")
+        if training_evaluation_subsample_size is None:
+            training_evaluation_subsample_size = defaults["models"][
+                "training_evaluation_subsample_size"]
+
+        profile = kwargs.get("profile")
+        if profile is None:
+            profile = defaults["models"]["profile"]
+
+        profile_trace_window = kwargs.get("profile_trace_window")
+        if profile_trace_window is None:
+            profile_trace_window = defaults["models"]["profile_trace_window"]
+
         start_time = time()
 
         if run_id is None:
@@ -707,7 +784,8 @@ class VariationalAutoencoder:
             "training duration": None,
             "last epoch duration": None,
             "learning rate": learning_rate,
-            "minibatch size": minibatch_size
+            "minibatch size": minibatch_size,
+            "training evaluation": training_evaluation
         }
         print("done setting up training data")
         # Earlier model
@@ -814,31 +892,40 @@ class VariationalAutoencoder:
         print("Preparing data.")
         preparing_data_time_start = time()
 
+        # Other inputs for each example
+        training_inputs = {}
+        validation_inputs = {}
+
         # Batch indices for batch correction
         if self.batch_correction:
-            batch_indices_train = batch_indices_for_subset(training_set)
+            training_inputs["batch_indices"] = batch_indices_for_subset(
+                training_set)
             if validation_set:
-                batch_indices_valid = batch_indices_for_subset(validation_set)
+                validation_inputs["batch_indices"] = (
+                    batch_indices_for_subset(validation_set))
 
         # Count sum for distributions
         if self.use_count_sum_as_parameter:
-            count_sum_parameter_train = training_set.count_sum
+            training_inputs["count_sum_parameter"] = training_set.count_sum
             if validation_set:
-                count_sum_parameter_valid = validation_set.count_sum
+                validation_inputs["count_sum_parameter"] = (
+                    validation_set.count_sum)
 
         # Normalised count sum as a feature to the decoder
         if self.use_count_sum_as_feature:
-            count_sum_feature_train = training_set.normalised_count_sum
+            training_inputs["count_sum_feature"] = (
+                training_set.normalised_count_sum)
             if validation_set:
-                count_sum_feature_valid = validation_set.normalised_count_sum
+                validation_inputs["count_sum_feature"] = (
+                    validation_set.normalised_count_sum)
 
         # Numbers of examples for data subsets
         n_examples_train = training_set.number_of_examples
         if validation_set:
             n_examples_valid = validation_set.number_of_examples
 
-        # Preprocessing function at every epoch
-        noisy_preprocess = training_set.noisy_preprocess
+        # Noisy preprocessing function for every minibatch
+        noisy_preprocess = training_set.noisy_preprocess_minibatch
 
         # Input and output
         if not noisy_preprocess:
@@ -860,6 +947,103 @@ class VariationalAutoencoder:
                 t_train = training_set.values
                 if validation_set:
                     t_valid = validation_set.values
+        else:
+            x_train = training_set.values_for_noisy_preprocessing
+            t_train = x_train
+            if validation_set:
+                x_valid = validation_set.values_for_noisy_preprocessing
+                t_valid = x_valid
+
+        # Minibatches of model inputs assembled in the background
+        training_minibatches = MinibatchIterator(
+            inputs=self.inputs,
+            values=x_train,
+            target_values=t_train,
+            minibatch_size=minibatch_size,
+            example_inputs=training_inputs,
+            noisy_preprocess=noisy_preprocess,
+            sparse_values=self.sparse_input
+        )
+        if validation_set:
+            validation_minibatches = MinibatchIterator(
+                inputs=self.inputs,
+                values=x_valid,
+                target_values=t_valid,
+                minibatch_size=minibatch_size,
+                example_inputs=validation_inputs,
+                noisy_preprocess=noisy_preprocess,
+                sparse_values=self.sparse_input
+            )
+
+        # Training set evaluated after each epoch, either in full, on a
+        # fixed random subsample, or streamed from the training steps
+        training_evaluation_fetches = [
+            self.lower_bound,
+            self.kl_divergence,
+            self.reconstruction_error,
+            self.q_z_mean,
+            self.kl_divergence_neurons
+        ]
+        training_evaluation_feed_dict = {
+            self.is_training: False,
+            self.use_deterministic_z: False,
+            self.warm_up_weight: 1.0,
+            self.number_of_iw_samples:
+                self.number_of_importance_samples["training"],
+            self.number_of_mc_samples:
+                self.number_of_monte_carlo_samples["training"]
+        }
+        if training_evaluation == "subsample":
+            training_evaluation_indices = numpy.sort(numpy.random.choice(
+                n_examples_train,
+                size=min(training_evaluation_subsample_size, n_examples_train),
+                replace=False
+            ))
+            training_evaluation_minibatches = MinibatchIterator(
+                inputs=self.inputs,
+                values=x_train,
+                target_values=t_train,
+                minibatch_size=minibatch_size,
+                example_inputs=training_inputs,
+                noisy_preprocess=noisy_preprocess,
+                sparse_values=self.sparse_input,
+                example_indices=training_evaluation_indices
+            )
+            n_examples_train_evaluation = training_evaluation_indices.size
+            metadata_log["training evaluation"] = (
+                "subsample of {} examples".format(
+                    n_examples_train_evaluation))
+        else:
+            training_evaluation_minibatches = training_minibatches
+            n_examples_train_evaluation = n_examples_train
+
+        # Input pipeline assembling minibatches in parallel
+        if input_pipeline:
+            with self.graph.as_default():
+                training_input_initialiser = (
+                    self.input_iterator.make_initializer(
+                        build_input_dataset(
+                            values=x_train,
+                            target_values=t_train,
+                            minibatch_size=minibatch_size,
+                            example_inputs=training_inputs,
+                            noisy_preprocess=noisy_preprocess,
+                            number_of_workers=number_of_input_workers,
+                            sparse_values=self.sparse_input
+                        )
+                    )
+                )
+
+        # Profiling of training and evaluation steps
+        step_profiler = StepProfiler(
+            log_directory=log_directory,
+            enabled=profile,
+            trace_window=profile_trace_window
+        )
+        if input_pipeline:
+            training_step_minibatches = None
+        else:
+            training_step_minibatches = training_minibatches
 
         preparing_data_duration = time() - preparing_data_time_start
         print("Data prepared ({}).".format(format_duration(
@@ -952,29 +1136,16 @@ class VariationalAutoencoder:
 
             metadata_log["epochs trained"] = (epoch_start, number_of_epochs)
 
+            # The global step is only read once and then counted, since
+            # the optimiser increments it by one at each step
+            step = session.run(self.global_step)
+
             print(training_string)
             print("started epochs here ")
             training_time_start = time()
 
             for epoch in range(epoch_start, number_of_epochs):
 
-                if noisy_preprocess:
-                    print("Noisily preprocess values.")
-                    noisy_time_start = time()
-
-                    x_train = noisy_preprocess(training_set.values)
-                    t_train = x_train
-
-                    if validation_set:
-                        x_valid = noisy_preprocess(
-                            validation_set.values)
-                        t_valid = x_valid
-
-                    noisy_duration = time() - noisy_time_start
-                    print("Values noisily preprocessed ({}).".format(
-                        format_duration(noisy_duration)))
-                    print()
-
                 epoch_time_start = time()
 
                 if self.number_of_warm_up_epochs:
@@ -983,24 +1154,24 @@ class VariationalAutoencoder:
                 else:
                     warm_up_weight = 1.0
 
-                shuffled_indices = numpy.random.permutation(n_examples_train)
+                if input_pipeline:
+                    session.run(training_input_initialiser)
+                    # Minibatches are read from the input pipeline
+                    training_minibatch_feeds = (
+                        (None, {}) for _ in range(
+                            0, n_examples_train, minibatch_size))
+                else:
+                    training_minibatch_feeds = (
+                        training_minibatches.shuffled())
                 print("in epoch {} , training examples are {}, at batch size {}".format(epoch,n_examples_train,minibatch_size))
-                for i in range(0, n_examples_train, minibatch_size):
+                streamed_training_evaluations = []
+                for minibatch_indices, feed_dict_batch in (
+                        training_minibatch_feeds):
 
                     # Internal setup
                     step_time_start = time()
-                    step = session.run(self.global_step)
-
-                    # Prepare minibatch
-                    minibatch_indices = shuffled_indices[
-                        i:(i + minibatch_size)]
-
-                    x_batch = x_train[minibatch_indices].toarray()
-                    t_batch = t_train[minibatch_indices].toarray()
 
-                    feed_dict_batch = {
-                        self.x: x_batch,
-                        self.t: t_batch,
+                    feed_dict_batch.update({
                         self.is_training: True,
                         self.use_deterministic_z: False,
                         self.learning_rate: learning_rate,
@@ -1009,25 +1180,29 @@ class VariationalAutoencoder:
                             self.number_of_importance_samples["training"],
                         self.number_of_mc_samples:
                             self.number_of_monte_carlo_samples["training"]
-                    }
-
-                    if self.batch_correction:
-                        feed_dict_batch[self.batch_indices] = (
-                            batch_indices_train[minibatch_indices])
-
-                    if self.use_count_sum_as_parameter:
-                        feed_dict_batch[self.count_sum_parameter] = (
-                            count_sum_parameter_train[minibatch_indices])
-
-                    if self.use_count_sum_as_feature:
-                        feed_dict_batch[self.count_sum_feature] = (
-                            count_sum_feature_train[minibatch_indices])
+                    })
 
                     # Run the stochastic minibatch training operation
-                    _, minibatch_loss = session.run(
-                        [self.optimiser, self.lower_bound],
-                        feed_dict=feed_dict_batch
+                    fetches = [self.optimiser, self.lower_bound]
+                    if training_evaluation == "streaming":
+                        # Also evaluate the minibatch in the same forward
+                        # pass for the training evaluation
+                        fetches.append(training_evaluation_fetches)
+                        if input_pipeline:
+                            fetches.append(self.example_indices)
+                    step_results = step_profiler.run(
+                        session,
+                        fetches,
+                        feed_dict=feed_dict_batch,
+                        minibatches=training_step_minibatches
                     )
+                    _, minibatch_loss = step_results[:2]
+                    if training_evaluation == "streaming":
+                        training_evaluation_i = step_results[2]
+                        if input_pipeline:
+                            minibatch_indices = step_results[3]
+                        streamed_training_evaluations.append(
+                            (minibatch_indices, training_evaluation_i))
 
                     # Compute step duration
                     step_duration = time() - step_time_start
@@ -1044,6 +1219,8 @@ class VariationalAutoencoder:
                                 "Aborting. The ELBO for the last batch became "
                                 "indefinite.")
 
+                    step += 1
+
                 print()
 
                 epoch_duration = time() - epoch_time_start
@@ -1081,7 +1258,7 @@ class VariationalAutoencoder:
                 reconstruction_error_train = 0
 
                 q_z_mean_train = numpy.empty(
-                    shape=[n_examples_train, self.latent_size],
+                    shape=[n_examples_train_evaluation, self.latent_size],
                     dtype=numpy.float32
                 )
 
@@ -1090,34 +1267,25 @@ class VariationalAutoencoder:
                 else:
                     kl_divergence_neurons = numpy.zeros(shape=self.latent_size)
 
-                for i in range(0, n_examples_train, minibatch_size):
-                    subset = slice(
-                        i, min(i + minibatch_size, n_examples_train))
-                    x_batch = x_train[subset].toarray()
-                    t_batch = t_train[subset].toarray()
-                    feed_dict_batch = {
-                        self.x: x_batch,
-                        self.t: t_batch,
-                        self.is_training: False,
-                        self.use_deterministic_z: False,
-                        self.warm_up_weight: 1.0,
-                        self.number_of_iw_samples:
-                            self.number_of_importance_samples["training"],
-                        self.number_of_mc_samples:
-                            self.number_of_monte_carlo_samples["training"]
-                    }
-
-                    if self.batch_correction:
-                        feed_dict_batch[self.batch_indices] = (
-                            batch_indices_train[subset])
-
-                    if self.use_count_sum_as_parameter:
-                        feed_dict_batch[self.count_sum_parameter] = (
-                            count_sum_parameter_train[subset])
+                if training_evaluation == "streaming":
+                    training_evaluations = streamed_training_evaluations
+                else:
+                    training_evaluations = (
+                        (subset, step_profiler.run(
+                            session,
+                            training_evaluation_fetches,
+                            feed_dict={
+                                **feed_dict_batch,
+                                **training_evaluation_feed_dict
+                            },
+                            kind="evaluation",
+                            minibatches=training_evaluation_minibatches
+                        ))
+                        for subset, feed_dict_batch in (
+                            training_evaluation_minibatches)
+                    )
 
-                    if self.use_count_sum_as_feature:
-                        feed_dict_batch[self.count_sum_feature] = (
-                            count_sum_feature_train[subset])
+                for subset, training_evaluation_i in training_evaluations:
 
                     (
                         lower_bound_i,
@@ -1125,16 +1293,7 @@ class VariationalAutoencoder:
                         reconstruction_error_i,
                         q_z_mean_i,
                         kl_divergence_neurons_i
-                    ) = session.run(
-                        [
-                            self.lower_bound,
-                            self.kl_divergence,
-                            self.reconstruction_error,
-                            self.q_z_mean,
-                            self.kl_divergence_neurons
-                        ],
-                        feed_dict=feed_dict_batch
-                    )
+                    ) = training_evaluation_i
 
                     lower_bound_train += lower_bound_i
                     kl_divergence_train += kl_divergence_i
@@ -1144,11 +1303,14 @@ class VariationalAutoencoder:
 
                     kl_divergence_neurons += kl_divergence_neurons_i
 
-                lower_bound_train /= n_examples_train / minibatch_size
-                kl_divergence_train /= n_examples_train / minibatch_size
-                reconstruction_error_train /= n_examples_train / minibatch_size
+                number_of_minibatches_train = (
+                    n_examples_train_evaluation / minibatch_size)
+
+                lower_bound_train /= number_of_minibatches_train
+                kl_divergence_train /= number_of_minibatches_train
+                reconstruction_error_train /= number_of_minibatches_train
 
-                kl_divergence_neurons /= n_examples_train / minibatch_size
+                kl_divergence_neurons /= number_of_minibatches_train
 
                 if numpy.isnan(lower_bound_train):
                     raise ArithmeticError(
@@ -1249,14 +1411,8 @@ class VariationalAutoencoder:
                         dtype=numpy.float32
                     )
 
-                    for i in range(0, n_examples_valid, minibatch_size):
-                        subset = slice(
-                            i, min(i + minibatch_size, n_examples_valid))
-                        x_batch = x_valid[subset].toarray()
-                        t_batch = t_valid[subset].toarray()
-                        feed_dict_batch = {
-                            self.x: x_batch,
-                            self.t: t_batch,
+                    for subset, feed_dict_batch in validation_minibatches:
+                        feed_dict_batch.update({
                             self.is_training: False,
                             self.use_deterministic_z: False,
                             self.warm_up_weight: 1.0,
@@ -1264,33 +1420,24 @@ class VariationalAutoencoder:
                                 self.number_of_importance_samples["training"],
                             self.number_of_mc_samples:
                                 self.number_of_monte_carlo_samples["training"]
-                        }
-
-                        if self.batch_correction:
-                            feed_dict_batch[self.batch_indices] = (
-                                batch_indices_valid[subset])
-
-                        if self.use_count_sum_as_parameter:
-                            feed_dict_batch[self.count_sum_parameter] = (
-                                count_sum_parameter_valid[subset])
-
-                        if self.use_count_sum_as_feature:
-                            feed_dict_batch[self.count_sum_feature] = (
-                                count_sum_feature_valid[subset])
+                        })
 
                         (
                             lower_bound_i,
                             kl_divergence_i,
                             reconstruction_error_i,
                             q_z_mean_i
-                        ) = session.run(
+                        ) = step_profiler.run(
+                            session,
                             [
                                 self.lower_bound,
                                 self.kl_divergence,
                                 self.reconstruction_error,
                                 self.q_z_mean
                             ],
-                            feed_dict=feed_dict_batch
+                            feed_dict=feed_dict_batch,
+                            kind="evaluation",
+                            minibatches=validation_minibatches
                         )
 
                         lower_bound_valid += lower_bound_i
@@ -1518,6 +1665,10 @@ class VariationalAutoencoder:
                         if validation_set:
                             intermediate_latent_values = q_z_mean_valid
                             intermediate_data_set = validation_set
+                        elif training_evaluation == "subsample":
+                            # Latent values are only found for a subsample
+                            intermediate_latent_values = None
+                            intermediate_data_set = None
                         else:
                             intermediate_latent_values = q_z_mean_train
                             intermediate_data_set = training_set
@@ -1597,6 +1748,9 @@ class VariationalAutoencoder:
                     if metadata_value
                 ))
 
+            step_profiler.save_summary(
+                log_directory=self.log_directory(run_id=run_id))
+
             return 0
 
     def sample(self, sample_size=None, minibatch_size=None, run_id=None,
@@ -1847,19 +2001,25 @@ class VariationalAutoencoder:
         )
         minibatch_size = int(numpy.ceil(minibatch_size))
 
+        evaluation_inputs = {}
+
         if self.batch_correction:
-            batch_indices_eval = batch_indices_for_subset(evaluation_set)
+            evaluation_inputs["batch_indices"] = batch_indices_for_subset(
+                evaluation_set)
 
         if self.use_count_sum_as_parameter:
-            count_sum_parameter_eval = evaluation_set.count_sum
+            evaluation_inputs["count_sum_parameter"] = (
+                evaluation_set.count_sum)
 
         if self.use_count_sum_as_feature:
-            count_sum_feature_eval = evaluation_set.normalised_count_sum
+            evaluation_inputs["count_sum_feature"] = (
+                evaluation_set.normalised_count_sum)
 
         n_examples_eval = evaluation_set.number_of_examples
         n_features_eval = evaluation_set.number_of_features
 
-        noisy_preprocess = evaluation_set.noisy_preprocess
+        # Noisy preprocessing function for every minibatch
+        noisy_preprocess = evaluation_set.noisy_preprocess_minibatch
 
         if not noisy_preprocess:
 
@@ -1875,15 +2035,24 @@ class VariationalAutoencoder:
                 t_eval = evaluation_set.values
 
         else:
-            print("Noisily preprocess values.")
-            noisy_time_start = time()
-            x_eval = noisy_preprocess(evaluation_set.values)
+            x_eval = evaluation_set.values_for_noisy_preprocessing
             t_eval = x_eval
             evaluation_set_transformed = True
-            noisy_duration = time() - noisy_time_start
-            print("Values noisily preprocessed ({}).".format(
-                format_duration(noisy_duration)))
-            print()
+
+        # Noisily preprocessed values of minibatches are only kept, if the
+        # transformed evaluation set is output
+        evaluation_minibatches = MinibatchIterator(
+            inputs=self.inputs,
+            values=x_eval,
+            target_values=t_eval,
+            minibatch_size=minibatch_size,
+            example_inputs=evaluation_inputs,
+            noisy_preprocess=noisy_preprocess,
+            sparse_values=self.sparse_input,
+            keep_noisy_values=(
+                noisy_preprocess is not None
+                and "transformed" in output_versions)
+        )
 
         # max_count = int(max(t_eval, axis = (0, 1)))
 
@@ -1967,35 +2136,21 @@ class VariationalAutoencoder:
                 number_of_mc_samples = self.number_of_monte_carlo_samples[
                     "evaluation"]
 
-            for i in range(0, n_examples_eval, minibatch_size):
+            for subset, feed_dict_batch in evaluation_minibatches:
 
-                indices = numpy.arange(
-                    i, min(i + minibatch_size, n_examples_eval))
+                i = subset.start
+                indices = numpy.arange(subset.start, subset.stop)
 
                 subset_indices = numpy.array(list(
                     evaluation_subset_indices.intersection(indices)))
 
-                feed_dict_batch = {
-                    self.x: x_eval[indices].toarray(),
-                    self.t: t_eval[indices].toarray(),
+                feed_dict_batch.update({
                     self.is_training: False,
                     self.use_deterministic_z: use_deterministic_z,
                     self.warm_up_weight: 1.0,
                     self.number_of_iw_samples: number_of_iw_samples,
                     self.number_of_mc_samples: number_of_mc_samples
-                }
-
-                if self.batch_correction:
-                    feed_dict_batch[self.batch_indices] = (
-                        batch_indices_eval[indices])
-
-                if self.use_count_sum_as_parameter:
-                    feed_dict_batch[self.count_sum_parameter] = (
-                        count_sum_parameter_eval[indices])
-
-                if self.use_count_sum_as_feature:
-                    feed_dict_batch[self.count_sum_feature] = (
-                        count_sum_feature_eval[indices])
+                })
 
                 (
                     lower_bound_i,
@@ -2135,6 +2290,8 @@ class VariationalAutoencoder:
 
             if "transformed" in output_versions:
                 if evaluation_set_transformed:
+                    if noisy_preprocess:
+                        t_eval = evaluation_minibatches.noisy_values()
                     transformed_evaluation_set = DataSet(
                         evaluation_set.name,
                         title=evaluation_set.title,
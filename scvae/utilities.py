@@ -16,9 +16,12 @@
 #
 # ======================================================================== #
 
+import collections
+import concurrent.futures
 import functools
 import importlib
 import importlib.util
+import itertools
 import os
 import re
 import sys
@@ -165,6 +168,37 @@ def suppress_stdout():
             sys.stdout = old_stdout
 
 
+def map_in_threads(function, iterable, number_of_threads=None):
+    """Map function over items in parallel threads, yielding in order.
+
+    Only a couple of items per thread are taken from `iterable` ahead
+    of the results, so items produced lazily, such as chunks read from
+    disk, are not all held in memory at once. By default, as many
+    threads as there are processors are used.
+    """
+
+    if number_of_threads is None:
+        number_of_threads = os.cpu_count() or 1
+
+    if number_of_threads <= 1:
+        yield from map(function, iterable)
+        return
+
+    items = iter(iterable)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=number_of_threads) as executor:
+        futures = collections.deque(
+            executor.submit(function, item)
+            for item in itertools.islice(items, 2 * number_of_threads)
+        )
+        while futures:
+            result = futures.popleft().result()
+            for item in itertools.islice(items, 1):
+                futures.append(executor.submit(function, item))
+            yield result
+
+
 def extension(filename):
     extension = None
     if not filename.startswith(os.extsep):
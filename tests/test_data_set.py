@@ -0,0 +1,163 @@
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+import os
+
+import numpy
+
+from scvae.data import data_set, processing, sparse
+
+
+def _write_count_matrix(path, values):
+    with open(path, "w") as tsv_file:
+        tsv_file.write("\t".join(
+            ["cell"] + ["gene_{}".format(j) for j in range(values.shape[1])]
+        ) + "\n")
+        for i, row in enumerate(values):
+            tsv_file.write("\t".join(
+                ["cell_{}".format(i)] + [str(value) for value in row]
+            ) + "\n")
+
+
+def _random_count_matrix(tmp_path, shape):
+    random_state = numpy.random.RandomState(0)
+    values = random_state.poisson(3, size=shape) * (
+        random_state.rand(*shape) < 0.5)
+    path = str(tmp_path / "counts.tsv")
+    _write_count_matrix(path, values)
+    return values, path
+
+
+def test_example_filter_resumes_from_cached_stage(tmp_path, monkeypatch):
+    # Save the results of every preprocessing stage
+    monkeypatch.setattr(
+        data_set, "MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING", -1)
+
+    values, path = _random_count_matrix(tmp_path, (30, 12))
+
+    # The second data set resumes from the cached preprocessing stage
+    for threshold in [20, 10]:
+        filtered_data_set = data_set.DataSet(
+            path,
+            directory=str(tmp_path / "data"),
+            preprocessing_methods=["log"],
+            example_filter=["remove_count_sum_above", str(threshold)]
+        )
+        filtered_data_set.load()
+
+        assert filtered_data_set.number_of_examples == (
+            values.sum(axis=1) <= threshold).sum()
+        assert (filtered_data_set.count_sum <= threshold).all()
+
+
+def test_split_only_reads_rows_of_subsets_asked_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        data_set, "MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING", -1)
+    monkeypatch.setattr(sparse, "DEFAULT_NUMBER_OF_ROWS_PER_CHUNK", 4)
+
+    values, path = _random_count_matrix(tmp_path, (40, 12))
+    options = dict(
+        directory=str(tmp_path / "data"),
+        preprocessing_methods=["log"],
+        binarise_values=True
+    )
+
+    full_data_set = data_set.DataSet(path, **options)
+    full_data_set.load()
+    __, __, expected_test_set = full_data_set.split(
+        method="sequential", fraction=0.8)
+
+    read_chunk_indices = set()
+    read_chunk = sparse.ChunkedSparseRowMatrix.chunk
+
+    def chunk(self, chunk_index):
+        read_chunk_indices.add(chunk_index)
+        return read_chunk(self, chunk_index)
+
+    monkeypatch.setattr(sparse.ChunkedSparseRowMatrix, "chunk", chunk)
+
+    unloaded_data_set = data_set.DataSet(path, **options)
+    training_set, __, test_set = unloaded_data_set.split(
+        method="sequential", fraction=0.8, kinds=["test"])
+
+    assert unloaded_data_set.values is None
+    assert training_set.values is None
+    assert read_chunk_indices == {8, 9}
+
+    for values_name in ["values", "preprocessed_values", "binarised_values"]:
+        assert numpy.array_equal(
+            getattr(test_set, values_name).toarray(),
+            getattr(expected_test_set, values_name).toarray()
+        )
+
+
+def test_cache_is_rebuilt_when_acquired_source_file_changes(
+        tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        data_set, "MINIMUM_NUMBER_OF_SECONDS_BEFORE_SAVING", -1)
+
+    values, path = _random_count_matrix(tmp_path, (10, 6))
+    directory = str(tmp_path / "data")
+
+    cached_data_set = data_set.DataSet(path, directory=directory)
+    cached_data_set.load()
+
+    # Replace the acquired copy of the source file, as when replacing a
+    # downloaded file
+    acquired_paths = [
+        os.path.join(directory_path, filename)
+        for directory_path, _, filenames in os.walk(
+            cached_data_set._original_directory)
+        for filename in filenames
+    ]
+    assert len(acquired_paths) == 1
+    _write_count_matrix(acquired_paths[0], 2 * values)
+
+    reloaded_data_set = data_set.DataSet(path, directory=directory)
+    reloaded_data_set.load()
+
+    assert numpy.array_equal(
+        reloaded_data_set.values.toarray(), 2 * values)
+
+
+def test_processing_threads_give_same_preprocessed_values(
+        tmp_path, monkeypatch):
+    # Preprocess values in many blocks
+    monkeypatch.setattr(processing, "PREPROCESSING_BLOCK_SIZE", 8)
+
+    values, path = _random_count_matrix(tmp_path, (30, 12))
+
+    preprocessed_values = []
+
+    for number_of_threads in [None, 4]:
+        threaded_data_set = data_set.DataSet(
+            path,
+            directory=str(tmp_path / "data-{}".format(number_of_threads)),
+            preprocessing_methods=["normalise", "log"],
+            feature_selection=["keep_highest_variances", "8"],
+            number_of_processing_threads=number_of_threads
+        )
+        threaded_data_set.load()
+        __, __, test_set = threaded_data_set.split(
+            method="sequential", fraction=0.8)
+
+        assert test_set.number_of_processing_threads == number_of_threads
+        preprocessed_values.append(
+            threaded_data_set.preprocessed_values.toarray())
+
+    assert numpy.allclose(*preprocessed_values)
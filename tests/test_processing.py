@@ -0,0 +1,141 @@
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+import numpy
+import scipy.sparse
+
+from scvae.data import loaders, processing
+from scvae.data.sparse import SparseRowMatrix, select_rows
+
+
+def _random_sparse_row_matrix(shape, density=0.3, seed=0):
+    values = scipy.sparse.random(
+        *shape, density=density, format="csr",
+        random_state=numpy.random.RandomState(seed)
+    )
+    return SparseRowMatrix(values)
+
+
+def _map_features_by_columns(values, feature_ids, feature_mapping):
+    # Implementation of `map_features` adding up one column at a time,
+    # which the aggregation matrix replaced
+
+    values = scipy.sparse.csc_matrix(values)
+
+    n_examples, n_ids = values.shape
+    n_features = len(feature_mapping)
+
+    feature_name_from_id = {
+        v: k for k, vs in feature_mapping.items() for v in vs
+    }
+
+    n_unknown_ids = 0
+
+    for feature_id in feature_ids:
+        if feature_id not in feature_name_from_id:
+            feature_name_from_id[feature_id] = feature_id
+            n_unknown_ids += 1
+
+    n_features += n_unknown_ids
+
+    aggregated_values = numpy.zeros((n_examples, n_features), values.dtype)
+    feature_names_with_index = dict()
+
+    for i, feature_id in enumerate(feature_ids):
+
+        feature_name = feature_name_from_id[feature_id]
+
+        if feature_name in feature_names_with_index:
+            index = feature_names_with_index[feature_name]
+        else:
+            index = len(feature_names_with_index)
+            feature_names_with_index[feature_name] = index
+
+        aggregated_values[:, index] += values[:, i].toarray().flatten()
+
+    feature_names = list(feature_names_with_index.keys())
+
+    feature_names_not_found = set(feature_mapping.keys()) - set(feature_names)
+    n_features -= len(feature_names_not_found)
+    aggregated_values = aggregated_values[:, :n_features]
+
+    return aggregated_values, numpy.array(feature_names)
+
+
+def test_map_features_matches_column_implementation():
+    data_dictionary = loaders._create_development_data_set()
+    values = data_dictionary["values"]
+    feature_ids = data_dictionary["feature names"].tolist()
+    feature_mapping = data_dictionary["feature mapping"]
+
+    # Also leave an ID unmapped and add a feature without any IDs
+    partial_feature_mapping = {
+        feature_name: [
+            feature_id for feature_id in feature_id_group
+            if feature_id != feature_ids[0]
+        ]
+        for feature_name, feature_id_group in feature_mapping.items()
+    }
+    partial_feature_mapping["feature without IDs"] = ["feature 0"]
+
+    for mapping in [feature_mapping, partial_feature_mapping]:
+
+        mapped_values, feature_names = processing.map_features(
+            values, feature_ids, mapping)
+        expected_values, expected_feature_names = _map_features_by_columns(
+            values, feature_ids, mapping)
+
+        assert feature_names.tolist() == expected_feature_names.tolist()
+        assert numpy.array_equal(mapped_values.toarray(), expected_values)
+
+
+def test_noisy_minibatch_preprocessing_keeps_values():
+    values = _random_sparse_row_matrix((10, 8))
+    original_data = values.data.copy()
+
+    _, noisy_preprocess = processing.build_noisy_preprocessors(["binarise"])
+
+    # Consecutive rows are selected as views sharing the stored values
+    minibatch = select_rows(values, numpy.arange(0, 3))
+    preprocessed_minibatch = noisy_preprocess(minibatch)
+
+    assert numpy.array_equal(values.data, original_data)
+    assert numpy.isin(preprocessed_minibatch.data, [0, 1]).all()
+
+
+def test_map_features_does_not_overflow_compact_counts():
+    values = SparseRowMatrix(
+        numpy.array([[40000, 40000, 1]], dtype=numpy.uint16))
+
+    mapped_values, feature_names = processing.map_features(
+        values, ["a", "b", "c"], {"A": ["a", "b"]}, compact=True)
+
+    assert feature_names.tolist() == ["A", "c"]
+    assert mapped_values.toarray().tolist() == [[80000, 1]]
+    assert mapped_values.dtype == numpy.uint32
+
+
+def test_map_features_keeps_data_type_unless_compacting():
+    values = SparseRowMatrix(
+        numpy.array([[40000, 40000, 1]], dtype=numpy.int32))
+
+    mapped_values, _ = processing.map_features(
+        values, ["a", "b", "c"], {"A": ["a", "b"]})
+
+    assert mapped_values.toarray().tolist() == [[80000, 1]]
+    assert mapped_values.dtype == numpy.int32
@@ -0,0 +1,36 @@
+# ======================================================================== #
+#
+# Copyright (c) 2017 - 2020 scVAE authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ======================================================================== #
+
+from scvae.utilities import map_in_threads
+
+
+def test_map_in_threads_yields_in_order_and_reads_ahead_little():
+    number_of_threads = 4
+    number_of_items_taken = 0
+
+    def items():
+        nonlocal number_of_items_taken
+        for item in range(100):
+            number_of_items_taken += 1
+            yield item
+
+    results = map_in_threads(lambda item: 2 * item, items(), number_of_threads)
+
+    assert next(results) == 0
+    assert number_of_items_taken <= 2 * number_of_threads + 1
+    assert list(results) == [2 * item for item in range(1, 100)]